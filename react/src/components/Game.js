@@ -52,11 +52,43 @@ function Game() {
         messageType: "game_info",
         callback: (message) => {
           console.log("game info:", message);
+          if (message.msg.itemlist_catalog !== undefined) {
+            webSocketService.itemlistCatalog = message.msg.itemlist_catalog;
+            webSocketService.itemlistVersion = message.msg.itemlist_version;
+          }
           updateMatchState(message.msg);
         }
       }
       webSocketService.addMessageHandler(gameinfo_handlerMessage);
 
+      webSocketService.addMessageHandler({
+        identifier: 'itemlist_delta_handler',
+        messageType: "itemlist_delta",
+        callback: (message) => {
+          const delta = message.msg;
+          const currentMatchState = matchStateRef.current;
+
+          if (delta.catalog !== webSocketService.itemlistCatalog || delta.from_version !== webSocketService.itemlistVersion) {
+            // missed some changes, the server will send the full list if our version is too old
+            webSocketService.sendMessage({
+              type: "GetGameInfo",
+              itemlist_catalog: webSocketService.itemlistCatalog,
+              itemlist_version: webSocketService.itemlistVersion
+            });
+            return;
+          }
+
+          const itemlist = {};
+          (currentMatchState.itemlist || []).forEach(item => { itemlist[item.id] = item; });
+          delta.added.forEach(item => { itemlist[item.id] = item; });
+          delta.changed.forEach(item => { itemlist[item.id] = item; });
+          delta.removed.forEach(id => { delete itemlist[id]; });
+
+          webSocketService.itemlistVersion = delta.version;
+          updateMatchState({ itemlist: Object.values(itemlist) });
+        }
+      });
+
       const registration_handlerMessage = {
         identifier: 'registration_handler',
         messageType: "register",
@@ -144,6 +176,60 @@ function Game() {
         }
       });
 
+      webSocketService.addMessageHandler({
+        identifier: 'loot_delta_handler',
+        messageType: "loot_list_delta",
+        callback: (message) => {
+          const delta = message.msg;
+          const loot = matchStateRef.current.loot;
+
+          if (!loot || loot.version !== delta.from_version) {
+            // missed some changes, get the whole list again
+            webSocketService.sendMessage({ type: "GetLootList" });
+            return;
+          }
+
+          delta.changes.forEach(change => {
+            switch (change.type) {
+              case "claim":
+                loot.items[change.lootid].ext.claims[change.playerid] = change.claim;
+                loot.items[change.lootid].ext.votes[change.playerid] = change.vote;
+                break;
+              case "vote":
+                loot.items[change.lootid].ext.votes[change.playerid] = change.vote;
+                break;
+              case "finished":
+                delete loot.waiting[change.playerid];
+                break;
+              case "phase":
+                loot.phase = change.phase;
+                loot.waiting = change.waiting;
+                break;
+              default:
+                break;
+            }
+          });
+
+          loot.version = delta.version;
+          updateMatchState([]); // stoopid
+        }
+      });
+
+      webSocketService.addMessageHandler({
+        identifier: 'loot_result_handler',
+        messageType: "loot_result",
+        callback: (message) => {
+          console.log("loot_result:", message.msg);
+          const currentMatchState = matchStateRef.current;
+          if (currentMatchState.isDM || !currentMatchState.player) {
+            return;
+          }
+          const received = message.msg.loot[currentMatchState.player] || [];
+          const gold = message.msg.gold[currentMatchState.player] || 0;
+          alert(`The loot has been distributed. You received ${received.length} items and ${gold} gold.`);
+        }
+      });
+
       webSocketService.retryHandlingCallback = retryHandlingCallback;
 
     });
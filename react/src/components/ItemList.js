@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useSSE } from './SSEContext';
 import ItemModal from './ItemModal';
 import './ItemList.css';
@@ -90,6 +90,10 @@ const ContextMenu = ({ position, options, onClose }) => {
   );
 };
 
+// the server ranks the matches of a search, this many of the best are shown
+const searchPageSize = 100;
+const searchDelay = 300; // ms without typing before the search is sent
+
 const ItemList = ({ items, players }) => {
   const [sortType, setSortType] = useState('name');
   const [filters, setFilters] = useState({
@@ -102,12 +106,47 @@ const ItemList = ({ items, players }) => {
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [editItem, setEditItem] = useState(null);
   const [selectedItem, setSelectedItem] = useState(null);
+  const [searchResult, setSearchResult] = useState(null); // {ids, total} of the current search term
+  const searchRequest = useRef(0);
   const webSocketService = useSSE();
 
   const handleSearchChange = (e) => {
-    setSearchTerm(e.target.value);
+    const term = e.target.value;
+    if (term.trim() && !searchTerm.trim()) {
+      setSortType('relevance');
+    } else if (!term.trim() && sortType === 'relevance') {
+      setSortType('name');
+    }
+    setSearchTerm(term);
   };
 
+  // searching goes through the server's index, only when the search term changes. The result is a list of ids
+  // which is looked up in the current items, so edits of matching items show up without searching again
+  useEffect(() => {
+    const request = ++searchRequest.current;
+    if (!searchTerm.trim()) {
+      setSearchResult(null);
+      return;
+    }
+
+    const timer = setTimeout(() => {
+      webSocketService.sendMessage({
+        type: 'SearchItems',
+        query: searchTerm,
+        page_size: searchPageSize,
+      }, (response) => {
+        if (request !== searchRequest.current || !response || response.type !== 'item_search') {
+          return; // an older search, or the search failed
+        }
+        setSearchResult({
+          ids: response.msg.items.map(item => item.id),
+          total: response.msg.total,
+        });
+      });
+    }, searchDelay);
+    return () => clearTimeout(timer);
+  }, [searchTerm, webSocketService]);
+
 
   // Add Item
   const handleAddNewItem = () => {
@@ -146,10 +185,16 @@ const ItemList = ({ items, players }) => {
     setSelectedItem(item);
   };
 
-  const sortedItems = [...items]
-    .filter(item => item.name.toLowerCase().includes(searchTerm.toLowerCase()))
+  // the search results in their ranking, with the current state of every item
+  const itemsById = {};
+  items.forEach(item => { itemsById[item.id] = item; });
+  const shownItems = searchResult ? searchResult.ids.map(id => itemsById[id]).filter(item => item) : items;
+
+  const sortedItems = [...shownItems]
     .sort((a, b) => {
-      if (sortType === 'name') {
+      if (sortType === 'relevance') {
+        return 0;
+      } else if (sortType === 'name') {
         return a.name.localeCompare(b.name);
       } else if (sortType === 'id') {
         return b.id - a.id;
@@ -198,11 +243,12 @@ const ItemList = ({ items, players }) => {
   return (
     <div className="inventory-container">
       <div className="inventory-header">
-        <h2>Items {`(${sortedItems.length})`}</h2>
+        <h2>Items {`(${searchResult ? searchResult.total : sortedItems.length})`}</h2>
 
         <div className='sort-div'>
           <div className="sort-label">Sort by:</div>
           <div className="sort-buttons">
+            {searchTerm.trim() && <button className={sortType === 'relevance' ? 'selected' : ''} onClick={() => setSortType('relevance')}>Relevance</button>}
             <button className={sortType === 'name' ? 'selected' : ''} onClick={() => setSortType('name')}>Name</button>
             <button className={sortType === 'rarity' ? 'selected' : ''} onClick={() => setSortType('rarity')}>Rarity</button>
             <button className={sortType === 'type' ? 'selected' : ''} onClick={() => setSortType('type')}>Type</button>
@@ -301,7 +301,7 @@ const LootList = ({ items, currentGold, isDM }) => {
         </div>
         {matchState.loot.phase >= 1 ? (
           <div className="loot-container centerLootContainer last red" onClick={sendAbortLoot}>
-            Abort loot distribution
+            {matchState.loot.phase === 3 ? "Clear distributed loot" : "Abort loot distribution"}
           </div>
         ) : (
           <div className="loot-container centerLootContainer last" onClick={handleOpenPlayerSelectModal}>
@@ -15,8 +15,13 @@ class SSEService {
     this.token = null;
     this.registration_token = null;
 
+    // itemlist catalog known by this client, lets the server send only the changes
+    this.itemlistCatalog = null;
+    this.itemlistVersion = null;
+
     this.connection_lost = false;
     this.callbackConnectionLost = null;
+    this.reconnectTimer = null;
 
   }
 
@@ -57,6 +62,18 @@ class SSEService {
 
       this.sendMessage({
         type: "GetGameInfo",
+        itemlist_catalog: this.itemlistCatalog,
+        itemlist_version: this.itemlistVersion
+      });
+    });
+
+    // the server sends the updates of one action as a single batch, hand every message to its handlers
+    this.eventSource.addEventListener("batch", (event) => {
+      const batch = JSON.parse(event.data);
+      batch.msg.forEach(message => {
+        this.messageHandlers
+          .filter(handler => handler.messageType === message.type)
+          .forEach(handler => handler.callback(message));
       });
     });
 
@@ -102,18 +119,25 @@ class SSEService {
 
   reconnectionHandler = () => {
 
-    if (!this.connection_lost) {
+    if (!this.connection_lost || this.reconnectTimer) {
       return;
     }
 
-    console.log('SSEService: Trying to reconnect');
-
-
+    // call itself after 5 seconds
+    this.reconnectTimer = setTimeout(() => {
+      this.reconnectTimer = null;
+      if (!this.connection_lost) {
+        return;
+      }
 
+      console.log('SSEService: Trying to reconnect');
 
+      // the session token reopens the event stream, also after a restart of the server
+      if (this.token && !this.eventSource) {
+        this.registration_token = this.token;
+        this.connect();
+      }
 
-    // call itself after 5 seconds
-    setTimeout(() => {
       this.reconnectionHandler();
     }, 5000);
 
@@ -1,8 +1,14 @@
-from client import Client
+from client import Client, Outbox, current_outbox
 from objects import *
 from log import log, logErrorAndNotify
 from fastapi import HTTPException
 from client import sendMessageToPlayer
+from util import get_game_clients, encode_message, LogLevel
+from history import recordEvent, getHistory
+from bus import publish
+from loot import LootPool
+import asyncio
+import time
 
 
 registered_actions = {}
@@ -19,9 +25,21 @@ async def handle_adv_action(action_type : str, client : Client, playerid : int,
     if action_type not in registered_actions:
         return False, "Action not found"
 
+    # the session is only ever used by one thread at a time, blocking calls go through run_db
     action_session = Session()
-    succ, msg = await registered_actions[action_type](client, playerid, data, action_session)
-    action_session.close()
+    # messages to the clients of the game are collected and sent as one batch per client when the action is done
+    outbox = Outbox(client.gameid)
+    outbox_token = current_outbox.set(outbox)
+    try:
+        succ, msg = await registered_actions[action_type](client, playerid, data, action_session)
+    finally:
+        current_outbox.reset(outbox_token)
+        outbox.flush()
+        # closing only blocks when it has to roll back, most actions commit or never touch the session
+        if action_session.in_transaction():
+            await run_db(action_session.close)
+        else:
+            action_session.close()
 
     if not succ:
         raise HTTPException(status_code=400, detail=msg)
@@ -30,11 +48,20 @@ async def handle_adv_action(action_type : str, client : Client, playerid : int,
     
 
 
+def deleteAndCommit(obj, session):
+    session.delete(obj)
+    session.commit()
+
+
 def give_player_item(gameid, player, item : ItemPrefab, session = None) -> (Item | bool, str):
     if player is None or item is None:
         logErrorAndNotify("Player or item is None. Aborting giving player a item.")
         return False, "Malformed Request"
 
+    # the prefab has to be part of the game or of the shared library (and not overridden by the game)
+    if ItemPrefab.getCatalog(gameid, session).get(item.id) is None:
+        return False, "This item does not exist in this game."
+
     curItem = session.query(Item).filter_by(id_prefab=item.id, owner=player.id).first()
     newItem = None
 
@@ -56,6 +83,18 @@ def give_player_item(gameid, player, item : ItemPrefab, session = None) -> (Item
     return newItem or curItem, "Player received Item succesfully"
 
 
+# The database part of an action runs in one executor call, every hop makes the event loop wait for the GIL again.
+# These helpers return (False, error) or (result, message) and build the messages for the clients as well
+
+def give_item(gameid, item_id, player_id, session):
+    item_prefab = ItemPrefab.getFromId(item_id, session)
+    player = Player.getFromId(player_id, session)
+
+    item, msg = give_player_item(gameid, player, item_prefab, session)
+    if not item:
+        return False, msg
+    return (player, item_prefab, item, Game.buildItemMessages(item)), msg
+
 async def action_GiveItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
     if not client.isDM:
         return False, "You are not a DM, you can't give items to players"
@@ -63,83 +102,106 @@ async def action_GiveItem(client : Client, playerid : int, data, session : sqlal
     item_id = data.get("item_id", None)
     player_id = data.get("player_id", None)
 
-    item_prefab = ItemPrefab.getFromId(item_id, session)
-    player = Player.getFromId(player_id, session)
-
-    if item_prefab is None or player is None:
-        return False, "Item or player not found"
-    
-    item, msg = give_player_item(client.gameid, player, item_prefab, session)
-
-    if not item:
+    result, msg = await run_db(give_item, client.gameid, item_id, player_id, session)
+    if not result:
         return False, msg
-    await Game.syncPlayerItem(client.gameid, item)
-    return True, f"Player {player.name} received item {item.name}"
 
-register_action("GiveItem", action_GiveItem)
+    player, item_prefab, item, messages = result
+    await Game.publishItemMessages(client.gameid, *messages)
+    message = f"Player {player.name} received item {item.name}"
+    recordEvent(client, "GiveItem", playerid=player.id, itemid=item.id, prefabid=item_prefab.id, message=message)
+    return True, message
 
-async def action_SendItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
-    item_id = data.get("item_id", None)
-    target_player_id = data.get("player_id", None)
+register_action("GiveItem", action_GiveItem)
 
+def send_item(item_id, playerid, target_player_id, session):
     item = Item.getFromId(item_id, session)
     player = Player.getFromId(playerid, session)
     target_player = Player.getFromId(target_player_id, session)
 
-    if item is None or player is None or target_player_id is None:
-        return False, "Item or player not found"
-    
-    if not item.isPlayerOwner(client.playerid):
+    if not item.isPlayerOwner(playerid):
         return False, "You can't send an item that is not owned by your player!"
 
-    await Game.syncPlayerItem(client.gameid, item, isRemoval=True)
+    removal = Game.buildItemMessages(item, isRemoval=True)
     item.owner = target_player.id
     session.commit()
-    await Game.syncPlayerItem(client.gameid, item)
+    return (item, player, target_player, removal, Game.buildItemMessages(item)), ""
+
+async def action_SendItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    item_id = data.get("item_id", None)
+    target_player_id = data.get("player_id", None)
+
+    result, msg = await run_db(send_item, item_id, client.playerid, target_player_id, session)
+    if not result:
+        return False, msg
+
+    item, player, target_player, removal, update = result
+    await Game.publishItemMessages(client.gameid, *removal)
+    await Game.publishItemMessages(client.gameid, *update)
     await sendMessageToPlayer(target_player_id,
         {
             "type": "notification",
             "msg": f"You have received item {item.name} from player {player.name}"
         }
     )
-    return True, f"Item {item.name} has been sent to player {player.name}"
+    message = f"Item {item.name} has been sent to player {target_player.name}"
+    recordEvent(client, "SendItem", playerid=target_player.id, itemid=item.id, prefabid=item.id_prefab, message=message)
+    return True, message
 
 register_action("SendItem", action_SendItem)
 
+def delete_item(item_id, client : Client, session):
+    item = Item.getFromId(item_id, session)
+    player = Player.getFromId(item.owner, session)
+
+    if not (client.isDM or (client.playerid  == item.owner)):
+        return False, "You are not allowed to delete this item"
+
+    name = item.name # the prefab can't be loaded once the item is gone
+    removal = Game.buildItemMessages(item, isRemoval=True)
+    deleteAndCommit(item, session)
+    return (item, name, player, removal), ""
+
 async def action_DeleteItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
     item_id = data.get("item_id", None)
-    current_item = Item.getFromId(item_id, session)
-    curr_player = Player.getFromId(current_item.owner, session)
 
+    result, msg = await run_db(delete_item, item_id, client, session)
+    if not result:
+        return False, msg
 
-    log_msg = f"Item {current_item.name} from {curr_player.name} has been deleted by {'Dungeon Master' if client.isDM else 'Player'}"
-    target_msg = f"Item {current_item.name} has been deleted by {'Dungeon Master' if client.isDM else 'yourself'}"
+    current_item, name, curr_player, removal = result
+    log_msg = f"Item {name} from {curr_player.name} has been deleted by {'Dungeon Master' if client.isDM else 'Player'}"
+    target_msg = f"Item {name} has been deleted by {'Dungeon Master' if client.isDM else 'yourself'}"
 
-    if not (client.isDM or (client.playerid  == current_item.owner)):
-        return False, "You are not allowed to delete this item"
-
-    await Game.syncPlayerItem(client.gameid, current_item.id, isRemoval=True)
+    await Game.publishItemMessages(client.gameid, *removal)
     await sendMessageToPlayer(current_item.owner,
         {
             "type": "notification",
             "msg": target_msg
         }
     )
-    session.delete(current_item)
-    session.commit()
-    session.close()
+    recordEvent(client, "DeleteItem", playerid=curr_player.id, itemid=current_item.id, prefabid=current_item.id_prefab, message=log_msg)
 
     return True, log_msg
 
 register_action("DeleteItem", action_DeleteItem)
 
-def edit_item(editItem, session) -> Item | None:
+def edit_item(editItem, session, gameid : int) -> ItemPrefab | None:
     if editItem is None:
         return None
 
     try:
         toEditItem = ItemPrefab.getFromId(editItem["id"], session)
 
+        if toEditItem.isLibraryPrefab():
+            # the shared library is read-only, the game gets its own copy of the prefab
+            if ItemPrefab.getCatalog(gameid, session).get(toEditItem.id) is None:
+                return None
+            toEditItem = ItemPrefab.overrideLibraryPrefab(gameid, toEditItem, session)
+        elif toEditItem.gameid != gameid:
+            logErrorAndNotify("Edit item belongs to another game")
+            return None
+
         toEditItem.name = editItem["name"]
         toEditItem.type = editItem["itemType"]
         toEditItem.rarity = editItem["rarity"]
@@ -150,12 +212,23 @@ def edit_item(editItem, session) -> Item | None:
         toEditItem.unique = editItem["isUnique"]
 
         session.commit()
+        ItemPrefab.updateCache(toEditItem)
         return toEditItem
 
     except NotFoundByIDException as e:
         logErrorAndNotify("Edit item not found")
         return None
 
+def edit_and_sync_item(editItem, session, gameid : int):
+    catalog_version = ItemPrefab.getCatalog(gameid, session).version
+    prefab = edit_item(editItem, session, gameid)
+    if prefab is None:
+        return False, "Failed to edit item"
+
+    # every copy of the item shows the new values
+    messages = [Game.buildItemMessages(item) for item in Game.getAllItemsWithPrefabID(gameid, prefab.id, session)]
+    return (prefab, Game.buildItemListUpdate(gameid, session, catalog_version), messages), ""
+
 async def action_EditItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
     if not client.isDM:
         return False, "You are not a DM, you can't edit items"
@@ -165,14 +238,16 @@ async def action_EditItem(client : Client, playerid : int, data, session : sqlal
     if item is None:
         return False, "Missing data"
 
-    if edit_item(item, session) is None:
-        return False, "Failed to edit item"
-    
-    await Game.updateItemList(client.gameid, session)
+    result, msg = await run_db(edit_and_sync_item, item, session, client.gameid)
+    if not result:
+        return False, msg
 
-    for item in Game.getAllItemsWithPrefabID(client.gameid, item["id"], session):
-        await Game.syncPlayerItem(client.gameid, item)
-    
+    prefab, itemlist_update, messages = result
+    await publish(("dm", client.gameid), itemlist_update)
+    for owner, dm_data, player_data in messages:
+        await Game.publishItemMessages(client.gameid, owner, dm_data, player_data)
+
+    recordEvent(client, "EditItem", prefabid=prefab.id, message=f"Item {prefab.name} has been edited")
     return True, "Item edited successfully"
 
 register_action("EditItem", action_EditItem)
@@ -182,7 +257,7 @@ def create_new_item(name : str, description: str, value : int, img : str, rarity
     if name is None or description is None or value is None:
         return False
 
-    session.add(ItemPrefab(
+    prefab = ItemPrefab(
         name=name,
         description=description,
         gameid=gameid,
@@ -192,8 +267,10 @@ def create_new_item(name : str, description: str, value : int, img : str, rarity
         img=img,
         stackable=stackable,
         unique=unique
-    ))
+    )
+    session.add(prefab)
     session.commit()
+    ItemPrefab.updateCache(prefab)
     log(f"Item {name} [ID: {name}] has been created")
     return True
 
@@ -218,19 +295,25 @@ async def action_CreateItem(client : Client, playerid : int, data, session : sql
     if None in [name, description, value, img, rarity, itype]:
         return False, "Missing data"
 
-    if not create_new_item(name, description, value, img, rarity, itype, client.gameid, session, unique, stackable):
+    def create():
+        catalog_version = ItemPrefab.getCatalog(client.gameid, session).version
+        if not create_new_item(name, description, value, img, rarity, itype, client.gameid, session, unique, stackable):
+            return None
+        return Game.buildItemListUpdate(client.gameid, session, catalog_version)
+
+    itemlist_update = await run_db(create)
+    if itemlist_update is None:
         return False, "Failed to create item"
-    
+
+    await publish(("dm", client.gameid), itemlist_update)
+
+    recordEvent(client, "CreateItem", message=f"Item {name} has been created")
     return True, "Item created successfully"
 
 register_action("CreateItem", action_CreateItem)
 register_action("AddItem", action_CreateItem)
 
-async def action_SellItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
-    if client.isDM:
-        return False, "You are a DM, you can't sell items... duh"
-    
-    item_id = data["item_id"]
+def sell_item(item_id, client : Client, session):
     item = Item.getFromId(item_id, session)
 
     if not item.isPlayerOwner(client.playerid):
@@ -241,21 +324,41 @@ async def action_SellItem(client : Client, playerid : int, data, session : sqlal
         return False, f"You are not able to sell anything currently."
 
     ply = Player.getFromId(client.playerid, session)
-    ply.gold += (item.value * max(item.count,1))
+    name, value = item.name, item.value # the prefab can't be loaded once the item is gone
+    ply.gold += (value * max(item.count,1))
 
-    await Game.syncPlayerItem(client.gameid, item.id, isRemoval=True)
-    session.delete(item)
-    session.commit()
+    removal = Game.buildItemMessages(item, isRemoval=True)
+    deleteAndCommit(item, session)
+    return (item, name, value, ply, removal), ""
+
+async def action_SellItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if client.isDM:
+        return False, "You are a DM, you can't sell items... duh"
+    
+    item_id = data["item_id"]
+
+    result, msg = await run_db(sell_item, item_id, client, session)
+    if not result:
+        return False, msg
+
+    item, name, value, ply, removal = result
+    await Game.publishItemMessages(client.gameid, *removal)
     await Game.syncPlayerGold(client.gameid, ply)
 
-    message = f'Player {ply.name} sold item "{item.name}" for {item.value} gold'
+    message = f'Player {ply.name} sold item "{name}" for {value} gold'
     log(message)
+    recordEvent(client, "SellItem", playerid=ply.id, itemid=item.id, prefabid=item.id_prefab, gold_delta=value * max(item.count,1), message=message)
     return True, message
 
 register_action("SellItem", action_SellItem)
 
 async def action_GetGameInfo(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
-    await client.sendGameSync(session)
+    await client.sendGameSync(session, data.get("itemlist_catalog", None), data.get("itemlist_version", None))
+
+    # a loot round which was running before a restart is restored the first time a client of the game asks for it
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is not None:
+        await pool.sendLootList(client)
     return True, ""
 
 register_action("GetGameInfo", action_GetGameInfo)
@@ -264,26 +367,35 @@ async def action_ToggleSelling(client : Client, playerid : int, data, session :
     if not client.isDM:
         return False, "You are not a DM, you can't toggle selling"
     
-    current_game = Game.getFromId(client.gameid, session)
+    current_game = await run_db(Game.getFromId, client.gameid, session)
     current_game.allow_selling = not current_game.allow_selling
 
     # Notify all players of the game
-    for _,client in client_list.items():
-        if client is not None and client.gameid == current_game.id:
-            await client.send({
-                "type": "notification",
-                "msg": f"Selling has been toggled to " + ("enabled" if current_game.allow_selling else "disabled")
-            })
-            await client.send({
-                "type": "SellingToggled",
-                "msg": current_game.allow_selling
-            })
-
-    return True, f"(GameID:{current_game.id}) Selling has been toggled to " + ("enabled" if current_game.allow_selling else "disabled")
+    notification = encode_message({
+        "type": "notification",
+        "msg": f"Selling has been toggled to " + ("enabled" if current_game.allow_selling else "disabled")
+    })
+    toggled = encode_message({
+        "type": "SellingToggled",
+        "msg": current_game.allow_selling
+    })
+    await publish(("game", current_game.id), notification)
+    await publish(("game", current_game.id), toggled)
+
+    message = f"(GameID:{current_game.id}) Selling has been toggled to " + ("enabled" if current_game.allow_selling else "disabled")
+    recordEvent(client, "ToggleSelling", message=message)
+    return True, message
 
 register_action("ToggleSelling", action_ToggleSelling)
 
 
+def set_player_gold(player_id, gold, session):
+    player = Player.getFromId(player_id, session)
+    gold_delta = gold - (player.gold or 0)
+    player.gold = gold
+    session.commit()
+    return player, gold_delta
+
 async def action_SetPlayerGold(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
     if not client.isDM:
         return False, "You are not a DM, you can't set player gold"
@@ -291,18 +403,394 @@ async def action_SetPlayerGold(client : Client, playerid : int, data, session :
     player_id = data.get("player_id", None)
     gold = data.get("gold", None)
 
-    player = Player.getFromId(player_id, session)
-
-    if player is None or gold is None:
+    if gold is None:
         return False, "Player or gold not found"
-    
-    player.gold = gold
-    session.commit()
+
+    player, gold_delta = await run_db(set_player_gold, player_id, gold, session)
     await Game.syncPlayerGold(client.gameid, player)
-    return True, f"Player {player.name} gold has been set to {gold}"
+    message = f"Player {player.name} gold has been set to {gold}"
+    recordEvent(client, "SetPlayerGold", playerid=player.id, gold_delta=gold_delta, message=message)
+    return True, message
 
 register_action("SetPlayerGold", action_SetPlayerGold)
 
+# gameid -> time of the last import, per worker
+last_imports = {}
+import_cooldown = 600 # seconds
+import_tasks = set() # running imports, the loop only keeps weak references to tasks
+
+def isLibraryEmpty():
+    with Session() as session:
+        return len(ItemPrefab.getList(None, session)) == 0
+
+async def run_import_script(client : Client):
+    """Makes sure the dnd5eapi items are available for the game of the client and tells the client once they are"""
+    try:
+        # items are imported into the shared library once, every game can use them from there
+        from fetchItems import importDnDItems
+        libraryEmpty = await run_db(isLibraryEmpty)
+        if libraryEmpty:
+            await importDnDItems(None)
+        await client.send({
+            "type": "items_imported",
+            "success": True
+        })
+    except Exception as e:
+        log(f"ImportNewItems failed: {e}", level=LogLevel.ERROR)
+        await client.send({
+            "type": "items_imported",
+            "success": False
+        })
+        await client.send({
+            "type": "error",
+            "msg": f"ImportNewItems failed: {str(e)}"
+        })
+    session = Session()
+    try:
+        await Game.updateItemList(client.gameid, session)
+    finally:
+        await run_db(session.close)
+
+async def action_ImportNewItems(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't import items"
+
+    if last_imports.get(client.gameid, 0) > time.time() - import_cooldown:
+        return False, "Import cooldown. Chill!"
+    last_imports[client.gameid] = time.time()
+
+    # the import takes a while, the client gets items_imported when it is done
+    task = asyncio.create_task(run_import_script(client))
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+    recordEvent(client, "ImportNewItems", message="Importing the dnd5eapi items")
+    return True, "Importing items"
+
+register_action("ImportNewItems", action_ImportNewItems)
+
+async def action_GetHistory(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't view the history"
+
+    try:
+        since = float(data["since"]) if data.get("since") is not None else None
+        until = float(data["until"]) if data.get("until") is not None else None
+        before_id = int(data["before_id"]) if data.get("before_id") is not None else None
+        before_timestamp = float(data["before_timestamp"]) if data.get("before_timestamp") is not None else None
+        limit = min(max(int(data.get("limit", 50)), 1), 200)
+    except (TypeError, ValueError):
+        return False, "Invalid history request"
+
+    if (before_id is None) != (before_timestamp is None):
+        return False, "Invalid history request"
+
+    before = (before_timestamp, before_id) if before_id is not None else None
+    events = await getHistory(client.gameid, since, until, before, limit)
+    last = events[-1] if len(events) == limit else None
+    return True, {
+        "type": "history",
+        "msg": {
+            "events": events,
+            # cursor for the next page
+            "before_id": last["id"] if last is not None else None,
+            "before_timestamp": last["timestamp"] if last is not None else None
+        }
+    }
+
+register_action("GetHistory", action_GetHistory)
+
+
+def search_items(gameid : int, query : str, filters : dict, page : int, page_size : int, session):
+    return ItemPrefab.getCatalog(gameid, session).getSearchIndex().search(query, filters, page, page_size)
+
+def parse_ids(value) -> list:
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    return [int(i) for i in value]
+
+def parse_flag(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+async def action_SearchItems(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    query = str(data.get("query", "") or "")[:200]
+    try:
+        filters = {
+            "rarity": parse_ids(data.get("rarity", None)),
+            "type": parse_ids(data.get("item_type", None)),
+            "min_value": float(data["min_value"]) if data.get("min_value") is not None else None,
+            "max_value": float(data["max_value"]) if data.get("max_value") is not None else None,
+            "stackable": parse_flag(data.get("stackable", None)),
+            "unique": parse_flag(data.get("unique", None))
+        }
+        page = max(int(data.get("page", 0)), 0)
+        page_size = int(data.get("page_size", 25))
+    except (TypeError, ValueError):
+        return False, "Invalid search request"
+
+    result = await run_db(search_items, client.gameid, query, filters, page, page_size, session)
+    return True, {
+        "type": "item_search",
+        "msg": dict(result, query=query)
+    }
+
+register_action("SearchItems", action_SearchItems)
+
+
+# another worker changed the loot pool since this one loaded it, the change was dropped
+loot_changed = "The loot changed in the meantime, please try again."
+
+def get_loot_item(gameid : int, item_id : int, session):
+    return ItemPrefab.getCatalog(gameid, session).get(item_id)
+
+async def action_AddLootItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't add loot"
+
+    try:
+        item_id = int(data.get("item_id", None))
+    except (TypeError, ValueError):
+        return False, "Invalid item"
+
+    item = await run_db(get_loot_item, client.gameid, item_id, session)
+    if item is None:
+        return False, "This item does not exist in this game."
+
+    pool = await LootPool.get_by_gameid(client.gameid, create=True)
+    if pool.phase is not LootPool.Phase.PREP:
+        return False, "You can only add loot during the preparations."
+
+    pool.addLoot(item_id, item)
+    if not await pool.checkpoint():
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "AddLootItem", prefabid=item_id, message=f"Item {item['name']} has been added to the loot")
+    return True, ""
+
+register_action("AddLootItem", action_AddLootItem)
+
+async def action_RemoveLootItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't remove loot"
+
+    pool = await LootPool.get_by_gameid(client.gameid, create=True)
+    loot_id = data.get("loot_id", None)
+    pool.removeLoot(loot_id)
+    if not await pool.checkpoint():
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "RemoveLootItem", message=f"Loot {loot_id} has been removed from the loot")
+    return True, ""
+
+register_action("RemoveLootItem", action_RemoveLootItem)
+
+async def action_GenerateLootItems(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't generate loot"
+
+    count_list = data.get("count_list", None)
+    if not isinstance(count_list, dict):
+        return False, "Missing data"
+
+    weighting = data.get("weighting", "uniform")
+    if weighting not in loot_weightings:
+        return False, "Unknown weighting"
+
+    item_type = data.get("item_type", None)
+    try:
+        item_type = int(item_type) if item_type is not None else None
+        for count in count_list.values():
+            int(count or 0)
+    except (TypeError, ValueError):
+        return False, "Invalid data"
+
+    pool = await LootPool.get_by_gameid(client.gameid, create=True)
+    if pool.phase is not LootPool.Phase.PREP:
+        return False, "You can only add loot during the preparations."
+
+    await run_db(pool.generateRandomLoot, count_list, item_type, weighting)
+    if not await pool.checkpoint():
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "GenerateLootItems", message=f"Random loot has been generated ({weighting} weighting)")
+    return True, ""
+
+register_action("GenerateLootItems", action_GenerateLootItems)
+
+async def action_SetLootGold(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't set the loot gold"
+
+    try:
+        gold = int(data.get("loot_gold", None))
+    except (TypeError, ValueError):
+        return False, "Invalid gold"
+
+    pool = await LootPool.get_by_gameid(client.gameid, create=True)
+    pool.setGold(gold)
+    if not await pool.checkpoint():
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "SetLootGold", message=f"The loot gold has been set to {gold}")
+    return True, ""
+
+register_action("SetLootGold", action_SetLootGold)
+
+async def action_ClearLoot(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't clear the loot"
+
+    def reset():
+        LootPool.delete_by_gameid(client.gameid)
+        return LootPool.create_new_lootpool(client.gameid)
+
+    pool = await run_db(reset)
+    await pool.sendLootList()
+    recordEvent(client, "ClearLoot", message="The loot has been cleared")
+    return True, ""
+
+register_action("ClearLoot", action_ClearLoot)
+
+async def action_GetLootList(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    """Sends the whole loot list to a client which missed a loot_list_delta"""
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is not None:
+        await pool.sendLootList(client)
+    return True, ""
+
+register_action("GetLootList", action_GetLootList)
+
+def players_in_game(gameid : int, playerids : list, session) -> bool:
+    return session.query(Player).filter(Player.id.in_(playerids), Player.gameid == gameid).count() == len(set(playerids))
+
+async def action_DistributeLoot(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    if not client.isDM:
+        return False, "You are not a DM, you can't distribute loot"
+
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is None:
+        return False, "There is no active lootpool"
+
+    try:
+        selected_players = [int(i) for i in data.get("players", [])]
+    except (TypeError, ValueError):
+        return False, "Invalid player in player selection"
+
+    if len(selected_players) < 1:
+        return False, "You have to select more than one player"
+
+    if len(pool.loot) < 1:
+        return False, "You have to add loot to distribute"
+
+    if pool.phase is not LootPool.Phase.PREP:
+        return False, "The loot is already being distributed"
+
+    def load_members():
+        if not players_in_game(client.gameid, selected_players, session):
+            return False
+        pool.loadMembers(session)
+        return True
+
+    if not await run_db(load_members):
+        return False, "Invalid player in player selection"
+
+    pool.setPlayers(selected_players)
+    pool.nextPhase()
+    if not await pool.checkpoint():
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "DistributeLoot", message=f"The loot is being distributed to {', '.join(str(pool.members.get(i, i)) for i in selected_players)}")
+    return True, ""
+
+register_action("DistributeLoot", action_DistributeLoot)
+
+async def action_ClaimLootItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    loot_id = data.get("loot_id", None)
+
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is None or pool.loot.get(loot_id) is None:
+        return False, f"Item {loot_id} does not exist!"
+
+    pool.setClaim(loot_id, client.playerid)
+    if not await pool.saveEntry(loot_id):
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "ClaimLootItem", playerid=client.playerid, message=f"Loot {loot_id} has been claimed")
+    return True, ""
+
+register_action("ClaimLootItem", action_ClaimLootItem)
+
+async def action_VoteLootItem(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    loot_id = data.get("loot_id", None)
+    player_id = data.get("player_id", None)
+
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is None or pool.loot.get(loot_id) is None:
+        return False, f"Item {loot_id} does not exist!"
+
+    if not await run_db(players_in_game, client.gameid, [player_id], session):
+        return False, "Invalid VoteLootitem!"
+
+    pool.setVote(loot_id, player_id, client.playerid)
+    if not await pool.saveEntry(loot_id):
+        return False, loot_changed
+    await pool.broadcast()
+    recordEvent(client, "VoteLootItem", playerid=player_id, message=f"Vote for {pool.members.get(player_id, player_id)} on loot {loot_id}")
+    return True, ""
+
+register_action("VoteLootItem", action_VoteLootItem)
+
+async def action_LootPhaseDone(client : Client, playerid : int, data, session : sqlalchemy.orm.Session):
+    pool = await LootPool.get_by_gameid(client.gameid)
+    if pool is None or (pool.phase is not LootPool.Phase.CLAIM and pool.phase is not LootPool.Phase.VOTE):
+        return False, "Invalid request"
+
+    phase = pool.phase
+    if pool.handleNewFinish(client.playerid):
+        if pool.phase is LootPool.Phase.VOTE:
+            return await conclude_loot(client, pool)
+        pool.nextPhase()
+        saved = await pool.checkpoint()
+    else:
+        saved = await pool.saveFinished()
+    if not saved:
+        return False, loot_changed
+
+    await pool.broadcast()
+    recordEvent(client, "LootPhaseDone", playerid=client.playerid, message=f"Player {pool.members.get(client.playerid, client.playerid)} is done with the {phase.name.lower()} phase")
+    return True, ""
+
+register_action("LootPhaseDone", action_LootPhaseDone)
+
+async def conclude_loot(client : Client, pool : LootPool):
+    """Gives out the loot once every player voted and tells the clients who received what"""
+    conclusion = await pool.conclude()
+    if conclusion is None:
+        return False, loot_changed
+
+    await Game.syncPlayerItems(client.gameid, conclusion["items"])
+    for player in conclusion["players"]:
+        await Game.syncPlayerGold(client.gameid, player)
+    await pool.broadcast()
+    await publish(("game", client.gameid), {
+        "type": "loot_result",
+        "msg": {
+            "seed": str(conclusion["seed"]), # too large for a javascript number
+            "loot": conclusion["loot"],
+            "gold": conclusion["gold"]
+        }
+    })
+
+    for playerid, loot_ids in conclusion["loot"].items():
+        recordEvent(client, "LootReceived", playerid=playerid, gold_delta=conclusion["gold"].get(playerid, 0),
+                    message=f"Player {pool.members.get(playerid, playerid)} received {len(loot_ids)} items and {conclusion['gold'].get(playerid, 0)} gold from the loot (seed {conclusion['seed']})")
+    return True, ""
+
 
 
 
@@ -367,190 +855,3 @@ register_action("SetPlayerGold", action_SetPlayerGold)
 #                                     "type": "error",
 #                                     "msg": "Invalid CreatePlayer message"
 #                                 }))
-
-
-
-
-
-
-
-
-
-
-#                         case "ClaimLootItem":
-#                             print(f"CLAIMLOOTITEM {msg}")
-#                             loot_id = msg["loot_id"]
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             if currentLootPool.loot.get(loot_id) is None:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": f"Item {loot_id} does not exist!"
-#                                 }))
-#                                 continue
-#                             currentLootPool.setClaim(loot_id, self.playerid)
-#                             await currentLootPool.sendLootList()
-
-#                         case "VoteLootItem":
-
-#                             loot_id = msg["loot_id"]
-#                             player_id = msg["player_id"]
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             if currentLootPool.loot.get(loot_id) is None:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": f"Item {loot_id} does not exist!"
-#                                 }))
-#                                 continue
-#                             session = Session()
-#                             try:
-#                                 target_player = Player.getFromId(player_id, session)
-#                                 if target_player.gameid != self.gameid:
-#                                     await self.send(json.dumps({
-#                                         "type": "error",
-#                                         "msg": f"Invalid VoteLootitem!"
-#                                     }))
-#                                     return
-#                                 try:
-#                                     currentLootPool.setVote(loot_id, self.playerid, player_id)
-#                                 except:
-#                                     print("meh")
-#                                 await currentLootPool.sendLootList()
-#                             except NotFoundByIDException:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": f"Invalid VoteLootitem!"
-#                                 }))
-#                                 continue
-#                             finally:
-#                                 session.close()
-
-#                         case "LootPhaseDone":
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             if currentLootPool.phase != LootPool.Phase.CLAIM and currentLootPool.phase != LootPool.Phase.VOTE:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Invalid request"
-#                                 }))
-#                                 continue
-
-#                             if currentLootPool.handleNewFinish(self.playerid):
-#                                 currentLootPool.nextPhase()
-
-#                             await currentLootPool.sendLootList()
-
-#                         case "AddLootItem":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-
-#                             item_id = msg["item_id"]
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-
-#                             if currentLootPool.phase.value != 0:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "You can only add loot during the preparations."
-#                                 }))
-#                                 continue
-
-#                             currentLootPool.addLoot(item_id)
-#                             await currentLootPool.sendLootList()
-
-#                         case "RemoveLootItem":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-
-#                             loot_id = msg["loot_id"]
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             currentLootPool.removeLoot(loot_id)
-#                             await currentLootPool.sendLootList()
-
-#                         case "GenerateLootItems":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-
-#                             countList = msg["count_list"]
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             currentLootPool.generateRandomLoot(countList)
-#                             await currentLootPool.sendLootList()
-
-#                         case "SetLootGold":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             currentLootPool.gold = msg["loot_gold"]
-#                             await currentLootPool.sendLootList()
-
-
-#                         case "ClearLoot":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-#                             LootPool.delete_by_gameid(self.gameid)
-#                             currentLootPool = LootPool.create_new_lootpool(self.gameid)
-#                             await currentLootPool.sendLootList()
-
-#                         case "DistributeLoot":
-#                             if not self.isDM:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Illegal operation"
-#                                 }))
-#                                 return
-
-#                             currentLootPool = LootPool.find_by_gameid(self.gameid)
-#                             if currentLootPool is None:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "There is no active lootpool"
-#                                 }))
-#                                 continue
-
-#                             selected_players = msg["players"]
-#                             if len(selected_players) < 1:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "You have to select more than one player"
-#                                 }))
-#                                 continue
-
-#                             if len(currentLootPool.loot) < 1:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "You have to add loot to distribute"
-#                                 }))
-#                                 continue
-
-#                             session = Session()
-#                             try:
-#                                 for player in selected_players:
-#                                     Player.getFromId(player, session)
-#                             except NotFoundByIDException:
-#                                 await self.send(json.dumps({
-#                                     "type": "error",
-#                                     "msg": "Invalid player in player selection"
-#                                 }))
-#                                 continue
-
-#                             currentLootPool.players = [int(i) for i in selected_players]
-#                             currentLootPool.nextPhase()
-#                             await currentLootPool.sendLootList()
-#                             session.close()
\ No newline at end of file
@@ -0,0 +1,800 @@
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# keep the benchmarks away from players.db
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db"))
+
+from util import encode_message, register_client, unregister_client, client_list
+from objects import createEngine, migrate, Game, Player, Session
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy
+from client import Client
+import objects
+import actions
+from history import getHistory
+
+# Small benchmarks for the hot paths of the server. Run with `python benchmark.py`
+
+
+def _item_update(clientid):
+    return {
+        "type": "inventory_update",
+        "msg": {
+            "playerid": 1,
+            "itemid": 1,
+            "item": {
+                'id': 1,
+                'id_prefab': 1,
+                'name': "Longsword",
+                'rarity': 1,
+                'type': 1,
+                'description': "A long sword. " * 20,
+                'count': 1,
+                'value': 15,
+                'img': "https://www.dndbeyond.com/attachments/2/742/weapon.jpg",
+                'stackable': False,
+                'unique': False
+            }
+        }
+    }
+
+
+def bench_broadcast(client_counts=(1, 10, 100, 1000), rounds=50):
+    print("Broadcast serialization (per broadcast)")
+    for count in client_counts:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for clientid in range(count):
+                json.dumps(_item_update(clientid))
+        per_client = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            msg = encode_message(_item_update(0))
+            for clientid in range(count):
+                msg.data
+        once = (time.perf_counter() - start) / rounds
+
+        print(f" {count:5} clients | per client: {per_client * 1000:8.3f}ms | serialize once: {once * 1000:8.3f}ms")
+
+
+def bench_concurrent_writes(threads=8, actions_per_thread=200):
+    """Runs the database part of SetPlayerGold (load player, change gold, commit) from several threads at once"""
+    print(f"Concurrent gold updates ({threads} threads)")
+    configs = {
+        "rollback journal, synchronous FULL": {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0},
+        "WAL, synchronous NORMAL": {"journal_mode": "WAL", "synchronous": "NORMAL"},
+    }
+    for name, pragmas in configs.items():
+        with tempfile.TemporaryDirectory() as directory:
+            bench_engine = createEngine("sqlite:///" + os.path.join(directory, "bench.db"), pool_size=threads, **pragmas)
+            migrate(bench_engine)
+            BenchSession = sessionmaker(bind=bench_engine)
+
+            with BenchSession() as session:
+                game = Game(name="bench", dm_pass="", join_code="BENCH")
+                session.add(game)
+                session.flush()
+                players = [Player(name=f"player{i}", level=1, gold=0, gameid=game.id) for i in range(threads)]
+                session.add_all(players)
+                session.commit()
+                playerids = [ply.id for ply in players]
+
+            def worker(playerid):
+                for _ in range(actions_per_thread):
+                    with BenchSession() as session:
+                        ply = session.query(Player).filter_by(id=playerid).first()
+                        ply.gold += 1
+                        session.commit()
+
+            workers = [threading.Thread(target=worker, args=(playerid,)) for playerid in playerids]
+            start = time.perf_counter()
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            duration = time.perf_counter() - start
+            bench_engine.dispose()
+
+        print(f" {name:36} | {threads * actions_per_thread / duration:8.0f} actions/sec")
+
+
+def bench_loop_latency_during_writes(burst=200, concurrency=20):
+    """Measures how late a message reaches an SSE client while SetPlayerGold actions are handled, with and without the db executor"""
+    print(f"SSE delivery latency during {burst} SetPlayerGold actions")
+
+    with Session() as session:
+        game = Game(name="latency", dm_pass="", join_code="LATENCY")
+        session.add(game)
+        session.flush()
+        player = Player(name="latency", level=1, gold=0, gameid=game.id)
+        session.add(player)
+        session.commit()
+        gameid, playerid = game.id, player.id
+
+    async def run():
+        dm = Client("bench-dm", gameid, -1, True)
+        listener = Client("bench-listener", gameid, playerid)
+        register_client(-100, dm)
+        register_client(-101, listener)
+        latencies = []
+        done = asyncio.Event()
+
+        async def ticker():
+            # stands in for another campaign's broadcasts every 2ms, the delay is measured from when the tick was due
+            while not done.is_set():
+                due = time.perf_counter() + 0.002
+                await asyncio.sleep(0.002)
+                await listener.send({"type": "tick", "sent": due})
+            await listener.send({"type": "done"})
+
+        async def generator():
+            while True:
+                msg = await listener.queue.get()
+                if msg["type"] == "done":
+                    return
+                if msg["type"] == "tick":
+                    latencies.append(time.perf_counter() - msg["sent"])
+
+        async def writer(count):
+            for i in range(count):
+                await actions.handle_adv_action("SetPlayerGold", dm, -1, {"player_id": playerid, "gold": i})
+                while not dm.queue.empty():
+                    dm.queue.get_nowait()
+
+        tasks = [asyncio.create_task(ticker()), asyncio.create_task(generator())]
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*[writer(burst // concurrency) for _ in range(concurrency)])
+        done.set()
+        await asyncio.gather(*tasks)
+        unregister_client(-100)
+        unregister_client(-101)
+        return latencies
+
+    # every runnable executor thread can hold the GIL for a whole switch interval (5ms) before the loop gets it back,
+    # so the tail latency grows with the number of workers while sqlite only runs one write at a time anyway
+    executor = objects.db_executor
+    runs = [("on the event loop", None)] + [(f"db executor, {workers} workers", ThreadPoolExecutor(max_workers=workers)) for workers in (1, 2, 4)]
+    for name, db_executor in runs:
+        objects.db_executor = db_executor
+        start = time.perf_counter()
+        latencies = sorted(asyncio.run(run()))
+        elapsed = time.perf_counter() - start
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f" {name:26} | median: {statistics.median(latencies) * 1000:7.2f}ms | p99: {p99 * 1000:7.2f}ms | max: {latencies[-1] * 1000:7.2f}ms | burst: {elapsed * 1000:6.0f}ms")
+        if db_executor is not None:
+            db_executor.shutdown()
+    objects.db_executor = executor
+
+
+def bench_slow_consumer(updates=100000, players=4, items=50):
+    """Sends inventory and gold updates to a client which never reads its stream"""
+    print(f"Stalled client receiving {updates} updates")
+
+    async def run():
+        client = Client("bench-stalled", 1, -1, True)
+        start = time.perf_counter()
+        for i in range(updates):
+            if i % 10 == 0:
+                await client.send({"type": "gold_update", "msg": {"playerid": i % players, "gold": i}})
+            else:
+                await client.send({"type": "inventory_update", "msg": {"playerid": i % players, "itemid": i % items, "item": {}}})
+        duration = time.perf_counter() - start
+        return duration, client.queue.getStats()
+
+    duration, stats = asyncio.run(run())
+    print(f" {updates / duration:8.0f} sends/sec | queued: {stats['queued']} (high water {stats['high_water']}) | coalesced: {stats['coalesced']} | overflows: {stats['overflows']}")
+
+    async def player_updates():
+        # the inventory updates a player receives about its own items carry no playerid
+        client = Client("bench-player", 1, 1, False)
+        for i in range(items * 2):
+            await client.send({"type": "inventory_update", "msg": {"itemid": i % items, "item": {}}})
+            await client.send({"type": "item_removal", "msg": {"itemid": i % items}})
+        return client.queue.getStats()
+
+    stats = asyncio.run(player_updates())
+    assert stats['queued'] == items, stats
+    print(f" player stream: queued {stats['queued']} | coalesced: {stats['coalesced']}")
+
+
+def check_bus_stalled_peer(messages=2000, size=4096, buffer_limit=256 * 1024):
+    """A worker which stops reading from the socket bus gets dropped by the hub, the other workers keep receiving"""
+    from bus import SocketBus
+    print(f"Socket bus hub with a peer which stopped reading, {messages} messages of {size} bytes")
+
+    async def run(directory):
+        path = os.path.join(directory, "bus.sock")
+        hub = SocketBus(path, buffer_limit=buffer_limit)
+        await hub.start()
+        while hub.server is None:
+            await asyncio.sleep(0.01)
+        member = SocketBus(path, buffer_limit=buffer_limit)
+        await member.start()
+        _, stalled = await asyncio.open_unix_connection(path) # never reads
+        while len(hub.members) < 2 or member.hub is None:
+            await asyncio.sleep(0.01)
+
+        payload = "x" * size
+        high_water = 0
+        for i in range(messages):
+            await hub.publish(("cache", "bench"), {"type": "bench", "key": payload})
+            high_water = max(high_water, max((writer.transport.get_write_buffer_size() for writer in hub.members), default=0))
+            if i % 50 == 0:
+                await asyncio.sleep(0.01) # the healthy member reads in the meantime
+        while member.received < messages:
+            await asyncio.sleep(0.01)
+
+        stats = hub.getStats()
+        stalled.close()
+        await member.stop()
+        await hub.stop()
+        return stats, member.received, high_water
+
+    with tempfile.TemporaryDirectory() as directory:
+        stats, received, high_water = asyncio.run(asyncio.wait_for(run(directory), 30))
+
+    # the stalled peer was dropped before the hub buffered much more than the limit for it, the member got everything
+    assert stats["dropped"] == 1 and stats["members"] == 1, stats
+    assert high_water <= buffer_limit + size + 64, high_water
+    assert received == messages, received
+    print(f" ok: dropped {stats['dropped']} peer, at most {high_water // 1024}KB buffered for one peer, the member received {received} messages")
+
+
+def bench_auth(session_counts=(10, 100, 1000, 10000), requests=20000):
+    """Cost of authenticating one /action request, before and after the token lookup fast path"""
+    import contextlib
+    import io
+    import main
+    print("Token authentication per /action request")
+
+    for count in session_counts:
+        main.token_list.clear()
+        old_token_list = {}
+        for clientid in range(count):
+            token = main.secrets.token_urlsafe(16)
+            main.token_list.set(token, {"ip": "127.0.0.1", "playerid": clientid, "clientid": clientid})
+            old_token_list[main.generateToken("server-identifier-", token, "127.0.0.1", False)] = {"token": token, "playerid": clientid, "clientid": clientid}
+
+        # the previous path: hash token and ip to the server side identifier, print it and the whole token list
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(max(requests // count, 20)):
+                identifier = main.generateToken("server-identifier-", token, "127.0.0.1", False)
+                print("server-identifier-", token, "127.0.0.1")
+                print(identifier)
+                print(old_token_list)
+                assert old_token_list[identifier]["token"] == token
+        old = (time.perf_counter() - start) / max(requests // count, 20)
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            assert main.authenticate(token, "127.0.0.1") is not None
+        new = (time.perf_counter() - start) / requests
+
+        print(f" {count:6} sessions | hash + print: {old * 1e6:10.2f}us | lookup: {new * 1e6:6.2f}us")
+    main.token_list.clear()
+
+
+def bench_token_store(sessions=10000, requests=20000):
+    """Session lookups in the in-memory store and the sqlite store, with and without its LRU cache"""
+    from tokens import TokenStore, SQLiteTokenStore
+    print(f"Session token lookup with {sessions} sessions")
+
+    with tempfile.TemporaryDirectory() as directory:
+        stores = (
+            ("memory", TokenStore("bench")),
+            ("sqlite + LRU cache", SQLiteTokenStore("bench", os.path.join(directory, "tokens.db"))),
+            ("sqlite, no cache", SQLiteTokenStore("bench", os.path.join(directory, "tokens.db"), cache_ttl=0)),
+        )
+        tokens = [f"token{i}" for i in range(sessions)]
+        for name, store in stores[:2]:
+            for i, token in enumerate(tokens):
+                store.set(token, {"ip": "127.0.0.1", "playerid": i, "gameid": 1, "clientid": i})
+
+        for name, store in stores:
+            start = time.perf_counter()
+            for i in range(requests):
+                assert store.get(tokens[i % 100]) is not None # a few active clients
+            print(f" {name:20} | {(time.perf_counter() - start) / requests * 1e6:7.2f}us per lookup")
+
+
+def check_token_store_contention(hold=1.0):
+    """Another worker holds the write lock of the sqlite token store, /register and the sweeper have to wait without stalling the event loop"""
+    import sqlite3
+    import types
+    import main
+    from tokens import SQLiteTokenStore, TokenSweeper, run_blocking
+    print(f"Sqlite token store locked by another worker for {hold:.1f}s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tokens.db")
+        stores = (main.token_list, main.registration_token_list)
+        main.token_list = SQLiteTokenStore("token_list", path, ttl=main.session_token_ttl)
+        main.registration_token_list = SQLiteTokenStore("registration_token_list", path, ttl=main.registration_token_ttl)
+        sweeper = TokenSweeper([main.token_list, main.registration_token_list])
+        request = types.SimpleNamespace(client=types.SimpleNamespace(host="127.0.0.1"))
+        register = next(route.endpoint for route in main.app.routes if getattr(route, "path", None) == "/register/{registration_token}")
+        registration_tokens = [main.issueRegistrationToken("127.0.0.1", playerid, 1) for playerid in range(5)]
+        locked = threading.Event()
+        clients = set(client_list)
+
+        def other_worker():
+            connection = sqlite3.connect(path, isolation_level=None)
+            connection.execute("BEGIN IMMEDIATE")
+            locked.set()
+            time.sleep(hold)
+            connection.execute("COMMIT")
+            connection.close()
+
+        async def contended():
+            stalls = []
+            done = asyncio.Event()
+
+            async def ticker():
+                while not done.is_set():
+                    due = time.perf_counter() + 0.002
+                    await asyncio.sleep(0.002)
+                    stalls.append(time.perf_counter() - due)
+
+            task = asyncio.create_task(ticker())
+            start = time.perf_counter()
+            responses = await asyncio.gather(*[register(request, token) for token in registration_tokens],
+                                             run_blocking(sweeper, sweeper.sweep))
+            waited = time.perf_counter() - start
+            done.set()
+            await task
+            return responses, waited, max(stalls)
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        locked.wait()
+        responses, waited, stall = asyncio.run(contended())
+        thread.join()
+
+        # the writes waited for the lock, the loop kept running meanwhile and every stream got its session
+        assert waited >= hold * 0.5, waited
+        assert stall < hold * 0.25, stall
+        assert len(responses) == len(registration_tokens) + 1 and len(main.token_list) == len(registration_tokens)
+        print(f" ok: requests waited {waited * 1000:.0f}ms for the lock, longest event loop stall {stall * 1000:.1f}ms")
+
+        for clientid in set(client_list) - clients:
+            unregister_client(clientid)
+        main.token_list, main.registration_token_list = stores
+
+
+def bench_resync_herd(clients=1000, games=20):
+    """Validates the resync tokens of every client at once, like after a server restart"""
+    import main
+    print(f"{clients} simultaneous resyncs over {games} games")
+
+    with Session() as session:
+        game_list = [Game(name=f"herd{i}", dm_pass="", join_code=f"HERD{i}") for i in range(games)]
+        session.add_all(game_list)
+        session.flush()
+        players = [Player(name=f"herd{i}", level=1, gold=0, gameid=game_list[i % games].id) for i in range(clients)]
+        session.add_all(players)
+        session.commit()
+        tokens = [Client(f"herd{ply.id}", ply.gameid, ply.id).generateReSyncToken() for ply in players]
+
+    async def herd():
+        start = time.perf_counter()
+        results = await asyncio.gather(*[objects.run_db(main.ValidateSyncToken, token) for token in tokens])
+        assert all(isValid for isValid, _ in results)
+        return time.perf_counter() - start
+
+    caches = (main.validated_sync_tokens, main.known_games, main.known_players)
+    ttls = [cache.ttl for cache in caches]
+    runs = (
+        ("uncached", False, False),
+        ("cold caches", True, False),
+        ("warmed existence caches", True, True),
+    )
+    for name, cached, warm in runs:
+        for cache, ttl in zip(caches, ttls):
+            cache.clear()
+            cache.ttl = ttl if cached else 0
+        if warm:
+            main.warmExistenceCaches()
+        first = asyncio.run(herd())
+        again = asyncio.run(herd())
+        print(f" {name:24} | herd: {first * 1000:8.1f}ms | repeated herd: {again * 1000:8.1f}ms")
+
+    for cache, ttl in zip(caches, ttls):
+        cache.clear()
+        cache.ttl = ttl
+
+
+def check_inventory_queries(shapes=((1, 1), (5, 20), (20, 50))):
+    """Loading every inventory of a game for the DM takes the same number of statements for any number of players and items"""
+    from sqlalchemy import event
+    from objects import Item, ItemPrefab
+    print("Statements per DM inventory load")
+
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+
+    counts = {}
+    for players, items in shapes:
+        with Session() as session:
+            game = Game(name=f"inventories{players}x{items}", dm_pass="", join_code="INV")
+            session.add(game)
+            session.flush()
+            prefab = ItemPrefab(name="Torch", gameid=game.id, rarity=1)
+            owners = [Player(name=f"player{i}", level=1, gold=0, gameid=game.id) for i in range(players)]
+            session.add(prefab)
+            session.add_all(owners)
+            session.flush()
+            session.add_all([Item(id_prefab=prefab.id, owner=ply.id) for ply in owners for _ in range(items)])
+            session.commit()
+            gameid = game.id
+
+        with Session() as session:
+            statements[0] = 0
+            event.listen(objects.engine, "before_cursor_execute", count_statement)
+            try:
+                inventories = Client("bench-dm", gameid, -1, True).getInventories(session)
+            finally:
+                event.remove(objects.engine, "before_cursor_execute", count_statement)
+        assert sum(len(i['inventory']) for i in inventories.values()) == players * items
+        counts[(players, items)] = statements[0]
+        print(f" {players:3} players x {items:3} items | {statements[0]} statements")
+
+    assert len(set(counts.values())) == 1 and max(counts.values()) <= 2, counts
+
+
+def check_query_plans():
+    """The hot lookups use their indexes instead of scanning the table (sqlite only)"""
+    if objects.engine.dialect.name != "sqlite":
+        return
+    print("Query plans of the indexed lookups")
+    lookups = {
+        "ix_players_gameid_name": "SELECT * FROM players WHERE gameid = 1 AND name = 'a'",
+        "ix_items_owner": "SELECT * FROM items WHERE owner = 1",
+        "ix_items_id_prefab": "SELECT * FROM items WHERE id_prefab = 1",
+        "ix_item_prefabs_gameid_rarity": "SELECT * FROM item_prefabs WHERE gameid = 1 AND rarity = 2",
+        "ix_prefab_overrides_gameid": "SELECT * FROM prefab_overrides WHERE gameid = 1",
+        "ix_games_join_code": "SELECT * FROM games WHERE join_code = 'ABCD'",
+    }
+    with objects.engine.connect() as connection:
+        for index, query in lookups.items():
+            plan = " | ".join(row[-1] for row in connection.execute(sqlalchemy.text("EXPLAIN QUERY PLAN " + query)))
+            assert f"USING INDEX {index}" in plan or f"USING COVERING INDEX {index}" in plan, (index, plan)
+            assert "SCAN" not in plan, (index, plan)
+            print(f" {index:32} | {plan}")
+
+
+def _hoard(items, players, rng):
+    """Loot pool where about half the items are unclaimed and the rest claimed and voted on by some players"""
+    loot = {}
+    for loot_id in range(1, items + 1):
+        claimers = rng.sample(players, rng.choice((0, 0, 1, 2, 3)))
+        loot[loot_id] = {
+            "itemid": 1,
+            "claims": {playerid: True for playerid in claimers},
+            "votes": {playerid: (playerid if playerid in claimers else rng.choice(claimers)) for playerid in players} if claimers else {}
+        }
+    return loot
+
+
+def _resolve_per_item(loot, players, rng):
+    """The old resolve loop: tallies every item in a dict and scans every player's bias for each unclaimed item"""
+    results = {ply: [] for ply in players}
+    randomBias = {ply: 0 for ply in players}
+    for loot_id, vals in loot.items():
+        claims = [ply for ply, claimed in vals["claims"].items() if claimed]
+        if len(claims) == 0:
+            lowest_val = min(randomBias.values())
+            picked_player = rng.choice([key for key, value in randomBias.items() if value == lowest_val])
+            results[picked_player].append(loot_id)
+            randomBias[picked_player] += 1
+            continue
+        if len(claims) == 1:
+            results[claims[0]].append(loot_id)
+            continue
+        mostLikely = {}
+        for vote in vals["votes"].values():
+            mostLikely[vote] = mostLikely.get(vote, 0) + 1
+        highest_val = max(mostLikely.values())
+        winning_players = [key for key, value in mostLikely.items() if value == highest_val]
+        picked_player = rng.choice(winning_players)
+        results[picked_player].append(loot_id)
+        if len(winning_players) > 1:
+            randomBias[picked_player] += 1
+    return results
+
+
+def bench_loot_resolve(item_counts=(100, 1000, 10000), player_counts=(4, 50), rounds=20):
+    """Resolves loot pools of growing size, like a dumped hoard"""
+    import random
+    from loot import resolveLoot
+    print("Loot resolution")
+    for players in player_counts:
+        player_ids = list(range(1, players + 1))
+        for items in item_counts:
+            loot = _hoard(items, player_ids, random.Random(items))
+            before = after = float("inf") # best round, the rounds alternate so both see the same machine load
+            for seed in range(rounds):
+                start = time.perf_counter()
+                _resolve_per_item(loot, player_ids, random.Random(seed))
+                before = min(before, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                resolveLoot(loot, player_ids, random.Random(seed))
+                after = min(after, time.perf_counter() - start)
+            print(f" {items:6} items, {players:3} players | per item: {before * 1000:8.2f}ms | tallied: {after * 1000:8.2f}ms")
+
+
+def check_loot_fairness(players=5, seeds=2000):
+    """Properties of resolveLoot which the loot phase relies on, fails with an AssertionError"""
+    import random
+    from loot import resolveLoot
+    print("Loot resolution fairness")
+    player_ids = [3, 7, 11, 20, 42][:players]
+
+    # every item goes to exactly one player, and the same seed gives the same result
+    loot = _hoard(500, player_ids, random.Random(1))
+    result = resolveLoot(loot, player_ids, random.Random(5))
+    assert sorted(loot_id for received in result.values() for loot_id in received) == sorted(loot)
+    assert result == resolveLoot(loot, player_ids, random.Random(5))
+
+    # an item claimed by one player always goes to that player, and a clear vote always wins
+    for loot_id, vals in loot.items():
+        claimers = [ply for ply, claimed in vals["claims"].items() if claimed]
+        if len(claimers) == 1:
+            assert loot_id in result[claimers[0]]
+    contested = {1: {"itemid": 1, "claims": {3: True, 7: True}, "votes": {3: 3, 7: 7, 11: 7}}}
+    assert all(resolveLoot(contested, player_ids, random.Random(seed))[7] == [1] for seed in range(50))
+
+    # unclaimed items are spread evenly: nobody has more than one item more than anybody else
+    unclaimed = {loot_id: {"itemid": 1, "claims": {}, "votes": {}} for loot_id in range(1, 18)}
+    extra = {ply: 0 for ply in player_ids}
+    for seed in range(seeds):
+        counts = [len(received) for received in resolveLoot(unclaimed, player_ids, random.Random(seed)).values()]
+        assert max(counts) - min(counts) <= 1, counts
+        for ply, received in resolveLoot(unclaimed, player_ids, random.Random(seed)).items():
+            if len(received) > len(unclaimed) // players:
+                extra[ply] += 1
+
+    # and every player is equally likely to be one who gets the leftovers
+    expected = seeds * (len(unclaimed) % players) / players
+    for ply, times in extra.items():
+        assert abs(times - expected) < 5 * (expected ** 0.5), (ply, times, expected)
+    print(f" ok: leftovers per player over {seeds} seeds {extra}, expected {expected:.0f}")
+
+
+def check_loot_conclusion():
+    """Plays a loot round through the actions up to its distribution, fails with an AssertionError"""
+    from objects import Item, ItemPrefab
+    from loot import LootPool
+    print("Loot round from claims to the distribution")
+
+    with Session() as session:
+        game = Game(name="loot round", dm_pass="", join_code="LOOT")
+        session.add(game)
+        session.flush()
+        owners = [Player(name=f"player{i}", level=1, gold=5, gameid=game.id) for i in range(3)]
+        arrow = ItemPrefab(name="Arrow", gameid=game.id, rarity=1, stackable=True, unique=False)
+        crown = ItemPrefab(name="Crown", gameid=game.id, rarity=5, stackable=False, unique=True)
+        sword = ItemPrefab(name="Sword", gameid=game.id, rarity=2, stackable=False, unique=False)
+        session.add_all(owners + [arrow, crown, sword])
+        session.commit()
+        gameid, players, prefabs = game.id, [ply.id for ply in owners], (arrow.id, arrow.id, arrow.id, crown.id, sword.id, sword.id)
+
+    dm = Client("bench-dm", gameid, -1, True)
+    clients = {playerid: Client(f"bench-player{playerid}", gameid, playerid, False) for playerid in players}
+
+    async def round():
+        for prefabid in prefabs:
+            await actions.handle_adv_action("AddLootItem", dm, -1, {"item_id": prefabid})
+        await actions.handle_adv_action("SetLootGold", dm, -1, {"loot_gold": 10})
+        await actions.handle_adv_action("DistributeLoot", dm, -1, {"players": players})
+        for playerid in players[:2]: # both want the crown, the third player votes for the second one
+            await actions.handle_adv_action("ClaimLootItem", clients[playerid], playerid, {"loot_id": 4})
+        for playerid in players:
+            await actions.handle_adv_action("LootPhaseDone", clients[playerid], playerid, {})
+        await actions.handle_adv_action("VoteLootItem", clients[players[2]], players[2], {"loot_id": 4, "player_id": players[1]})
+        for playerid in players:
+            await actions.handle_adv_action("LootPhaseDone", clients[playerid], playerid, {})
+        return await getHistory(gameid, limit=100)
+    history = asyncio.run(round())
+
+    pool = LootPool.find_by_gameid(gameid)
+    assert pool.phase is LootPool.Phase.CONCLUDED and pool.seed is not None
+    with Session() as session:
+        owners = {ply.id: ply for ply in session.query(Player).filter_by(gameid=gameid)}
+        items = {playerid: sorted(item.id_prefab for item in session.query(Item).filter_by(owner=playerid) for _ in range(item.count)) for playerid in players}
+        stored = LootPool.restore(gameid, session)
+
+    # every item was given out once, the crown went to the claimer with the most votes and the gold was split evenly
+    assert sorted(prefabid for received in items.values() for prefabid in received) == sorted(prefabs)
+    assert prefabs[3] in items[players[1]]
+    assert sorted(ply.gold for ply in owners.values()) == [8, 8, 9], [ply.gold for ply in owners.values()]
+    # the seed is stored, so the distribution can be repeated
+    assert stored.seed == pool.seed and stored.phase is LootPool.Phase.CONCLUDED
+    # every step of the round shows up in the history
+    recorded = Counter(event["action"] for event in history)
+    assert recorded["AddLootItem"] == len(prefabs) and recorded["ClaimLootItem"] == 2 and recorded["VoteLootItem"] == 1, recorded
+    assert recorded["LootPhaseDone"] == 2 * len(players) - 1 and recorded["LootReceived"] == len(players), recorded
+    print(f" ok: items {items}, gold {[ply.gold for ply in owners.values()]}, seed {pool.seed}")
+
+
+def bench_generate_loot(prefabs=2000, hoard=500, rounds=20):
+    """Generates a hoard from a game with many prefabs, counting the queries it needs"""
+    import random
+    from sqlalchemy import event
+    from loot import LootPool
+    from objects import ItemPrefab, prefab_catalogs
+    print(f"Generating a {hoard} item hoard from {prefabs} prefabs")
+
+    with Session() as session:
+        game = Game(name="hoard", dm_pass="", join_code="HOARD")
+        session.add(game)
+        session.flush()
+        session.add_all([ItemPrefab(name=f"prefab{i}", gameid=game.id, rarity=1 + i % 6, type=1 + i % 9, value=1 + i % 500) for i in range(prefabs)])
+        session.commit()
+        gameid = game.id
+    counts = {'common': hoard // 2, 'uncommon': hoard // 4, 'rare': hoard // 8, 'veryRare': hoard // 16, 'epic': hoard // 32, 'legendary': hoard // 64}
+
+    def per_rarity_scan(pool):
+        # the old way: filter the whole prefab list for every rarity and pick with random.choice
+        with Session() as session:
+            itemlist = [i.getInfo() for i in session.query(ItemPrefab).filter_by(gameid=gameid).all()]
+        for rarity_str, rarity_enum in {'common': 1, 'uncommon': 2, 'rare': 3, 'veryRare': 4, 'epic': 5, 'legendary': 6}.items():
+            items = [i for i in itemlist if i['rarity'] == rarity_enum]
+            for _ in range(counts[rarity_str]):
+                item = random.choice(items)
+                pool.addLoot(item['id'], item)
+
+    queries = [0]
+    def count_query(*args):
+        queries[0] += 1
+    event.listen(objects.engine, "before_cursor_execute", count_query)
+
+    runs = (
+        ("per rarity scan", per_rarity_scan),
+        ("alias tables, cold", lambda pool: (prefab_catalogs.pop(gameid, None), pool.generateRandomLoot(counts))),
+        ("alias tables, warm", lambda pool: pool.generateRandomLoot(counts)),
+        ("alias tables by value", lambda pool: pool.generateRandomLoot(counts, weighting="value")),
+    )
+    for name, generate in runs:
+        queries[0] = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            pool = LootPool(gameid)
+            generate(pool)
+        elapsed = (time.perf_counter() - start) / rounds
+        print(f" {name:22} | {elapsed * 1000:7.2f}ms | {queries[0] / rounds:5.1f} queries per hoard | {len(pool.loot)} items")
+
+    event.remove(objects.engine, "before_cursor_execute", count_query)
+
+
+def bench_item_search(queries=("sword", "long", "fire resistance", "potion of heal", "+1", "a " * 100, " ".join(f"w{i}" for i in range(100))), rounds=50, game_prefabs=50, hidden=10):
+    """Searches the item import (Items.csv) as shared library with a game layered on top, compared to filtering the whole list"""
+    import csv
+    from search import PrefabSearchIndex
+    rarities = {"common": 1, "uncommon": 2, "rare": 3, "very rare": 4, "legendary": 6}
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Items.csv"), newline='', encoding='utf-8') as file:
+        library = [{
+            'id': i, 'name': row["Name"], 'rarity': rarities.get(row["Rarity"], 0), 'type': None, 'description': row["Text"],
+            'value': i % 500, 'img': None, 'stackable': i % 3 == 0, 'unique': i % 7 == 0
+        } for i, row in enumerate(csv.DictReader(file))]
+    # the game overrides a few library prefabs (hidden, with an edited copy) and has some prefabs of its own
+    overrides = {i * 97 % len(library) for i in range(hidden)}
+    game = [{**library[tid], 'id': len(library) + tid, 'name': library[tid]['name'] + " (edited)"} for tid in overrides]
+    game += [{**library[i], 'id': 2 * len(library) + i, 'name': f"Long custom sword {i}"} for i in range(game_prefabs - len(game))]
+    prefabs = [i for i in library if i['id'] not in overrides] + game
+    print(f"Item search over {len(prefabs)} prefabs, {len(game)} of them in the game")
+
+    start = time.perf_counter()
+    library_index = PrefabSearchIndex(library)
+    print(f" library index, built once      | {(time.perf_counter() - start) * 1000:7.2f}ms")
+    start = time.perf_counter()
+    for _ in range(rounds):
+        index = PrefabSearchIndex(game, library_index, overrides)
+    print(f" game index, on every change    | {(time.perf_counter() - start) / rounds * 1000:7.2f}ms")
+
+    # the game layer ranks exactly like one index over the whole list
+    flat = PrefabSearchIndex(prefabs)
+    for query in queries + ("", "edited", "custom"):
+        for filters in ({}, {"rarity": [2, 3]}, {"stackable": True, "max_value": 200}):
+            assert index.search(query, filters, page_size=100) == flat.search(query, filters, page_size=100), (query, filters)
+
+    for query in queries:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            # what the client does today with the full list: substring match on every name, then sort
+            sorted((i for i in prefabs if query.lower() in i['name'].lower()), key=lambda i: i['name'])[:25]
+        scan = (time.perf_counter() - start) / rounds
+
+        # the scores of common terms are cached by the index, the first search of a term has to compute them
+        fresh = PrefabSearchIndex(game, library_index, overrides)
+        start = time.perf_counter()
+        fresh.search(query, {"rarity": [2, 3]}, page_size=25)
+        first = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            result = index.search(query, {"rarity": [2, 3]}, page_size=25)
+        indexed = (time.perf_counter() - start) / rounds
+        top = result["items"][0]["name"] if result["items"] else "-"
+        print(f" {query[:16]!r:18} | name scan: {scan * 1000:6.2f}ms | index with facets, first: {first * 1000:6.2f}ms, again: {indexed * 1000:6.2f}ms | {result['total']:4} hits, top: {top}")
+
+
+def check_discord_shipper(max_batch_chars=1900):
+    """Ships log lines to a local webhook stub which rate limits the first post, fails with an AssertionError"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from log import DiscordLogShipper
+    print("Discord log shipping")
+    posts = []
+
+    class Webhook(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not posts and not getattr(self.server, "limited", False):
+                self.server.limited = True
+                self.send_response(429)
+                reply = json.dumps({"retry_after": 0.1}).encode()
+            else:
+                posts.append(body["content"])
+                self.send_response(200)
+                reply = b"{}"
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Webhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    shipper = DiscordLogShipper(f"http://127.0.0.1:{server.server_address[1]}/", max_queue=10, batch_interval=0.05, max_batch_chars=max_batch_chars)
+
+    async def ship():
+        shipper.enqueue("a" * 5000) # a traceback longer than a whole batch
+        shipper.enqueue("short")
+        for i in range(20):
+            shipper.enqueue(f"line {i}") # the last 12 don't fit into the queue
+        shipper.start()
+        await asyncio.sleep(0.5)
+        shipper.enqueue("b" * max_batch_chars) # after the drops, so it shares its batch with the dropped count
+        await asyncio.sleep(0.3)
+        await shipper.stop()
+
+    asyncio.run(ship())
+    server.shutdown()
+
+    content = "\n".join(posts)
+    assert all(len(post) <= max_batch_chars for post in posts), [len(post) for post in posts]
+    assert "a" * 100 in posts[0] and "short" in content and "line 7" in content and "line 8" not in content
+    assert "(12 log lines dropped)" in content and "b" * 100 in content
+    assert shipper.getStats() == {"queued": 0, "sent": 11, "dropped": 12, "failed": 0}, shipper.getStats()
+    print(f" ok: {len(posts)} posts after a rate limit, {shipper.getStats()}")
+
+
+if __name__ == "__main__":
+    bench_broadcast()
+    bench_concurrent_writes()
+    bench_loop_latency_during_writes()
+    bench_slow_consumer()
+    check_bus_stalled_peer()
+    bench_auth()
+    bench_token_store()
+    check_token_store_contention()
+    bench_resync_herd()
+    check_inventory_queries()
+    check_query_plans()
+    bench_loot_resolve()
+    check_loot_fairness()
+    check_loot_conclusion()
+    bench_generate_loot()
+    bench_item_search()
+    check_discord_shipper()
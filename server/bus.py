@@ -0,0 +1,263 @@
+from util import LogLevel, EncodedMessage, encode_message, client_list, get_game_clients, get_dm_clients, get_player_clients, message_bus_type, message_bus_path, message_bus_buffer_limit
+from log import log
+import asyncio
+import fcntl
+import json
+import os
+import struct
+
+# Broadcasts go out on the message bus and every worker process delivers them to its own SSE clients.
+# A target selects the clients of a message:
+#   ("game", gameid)            every client of the game
+#   ("dm", gameid)              the dm clients of the game
+#   ("players", gameid)         the player clients of the game
+#   ("player", playerid)        the clients of one player
+#   ("owners", gameid, playerid) the dm clients of the game and the clients of the player
+#   ("client", clientid)        one client
+#   ("cache", name)             no client, the other workers drop their cached state of message["key"]
+
+
+def getLocalClients(target):
+    kind = target[0]
+    if kind == "game":
+        return get_game_clients(target[1])
+    if kind == "dm":
+        return get_dm_clients(target[1])
+    if kind == "players":
+        return [client for client in get_game_clients(target[1]) if not client.isDM]
+    if kind == "player":
+        return get_player_clients(target[1])
+    if kind == "owners":
+        clients = get_dm_clients(target[1])
+        clients.extend(client for client in get_player_clients(target[2]) if client.gameid == target[1])
+        return clients
+    if kind == "client":
+        client = client_list.get(target[1])
+        return [client] if client is not None else []
+    raise ValueError(f"Unknown message bus target {target}")
+
+
+# caches of a worker which the other workers invalidate when they change the state behind them.
+# name -> handler(key), key None drops the whole cache
+cache_handlers = {}
+
+def registerCacheHandler(name, handler):
+    cache_handlers[name] = handler
+
+def resetCaches():
+    """Drops every cache, after this worker may have missed invalidations"""
+    for handler in cache_handlers.values():
+        handler(None)
+
+
+async def deliver(target, message):
+    """Sends a message to the clients of this worker which are selected by the target"""
+    if target[0] == "cache":
+        handler = cache_handlers.get(target[1])
+        if handler is not None:
+            handler(message.message["key"])
+        return
+    for client in getLocalClients(target):
+        await client.send(message)
+
+
+class LocalBus:
+    """Message bus for a single worker, messages are delivered directly"""
+
+    async def publish(self, target, message):
+        await deliver(target, encode_message(message))
+
+    def invalidate(self, name, key):
+        pass # there are no other workers
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def getStats(self):
+        return {"type": "local"}
+
+
+class SocketBus:
+    """Message bus between the worker processes of one machine over a unix socket.
+
+    The worker which holds the lock file is the hub: it listens on the socket and relays every message it
+    receives to the other workers. The others connect to it, and one of them takes over if the hub exits.
+    Frames are written without waiting, a connection which has more than buffer_limit bytes waiting is dropped."""
+
+    def __init__(self, path, buffer_limit=message_bus_buffer_limit):
+        self.path = path
+        self.buffer_limit = buffer_limit
+        self.lock_file = None
+        self.server = None
+        self.members = set() # writers of the connected workers, only used by the hub
+        self.hub = None # writer to the hub, only used by the other workers
+        self.task = None
+        self.loop = None
+        self.connected = False # was connected to a hub or was the hub before
+
+        self.published = 0
+        self.received = 0
+        self.lost = 0
+        self.dropped = 0 # connections to workers which stopped reading
+
+    @staticmethod
+    def encodeFrame(target, message : EncodedMessage) -> bytes:
+        header = json.dumps(target).encode('utf-8')
+        data = message.data.encode('utf-8')
+        return struct.pack("!I", len(header)) + header + struct.pack("!I", len(data)) + data
+
+    @staticmethod
+    async def readFrame(reader : asyncio.StreamReader):
+        header = await reader.readexactly(struct.unpack("!I", await reader.readexactly(4))[0])
+        data = (await reader.readexactly(struct.unpack("!I", await reader.readexactly(4))[0])).decode('utf-8')
+        return tuple(json.loads(header)), EncodedMessage(json.loads(data), data)
+
+    def send(self, target, message : EncodedMessage):
+        """Sends a message to the other workers"""
+        frame = SocketBus.encodeFrame(target, message)
+        if self.server is not None:
+            for writer in list(self.members):
+                self.write(writer, frame)
+        elif self.hub is not None:
+            self.write(self.hub, frame)
+        else:
+            self.lost += 1 # between two hubs, the other workers miss this message
+        self.published += 1
+
+    def write(self, writer : asyncio.StreamWriter, frame : bytes):
+        """Writes a frame to another worker without waiting for it. A worker which stopped reading (e.g. a hung process)
+        is disconnected once buffer_limit bytes wait for it, instead of buffering for it without bound"""
+        if writer.is_closing():
+            return
+        writer.write(frame)
+        if writer.transport.get_write_buffer_size() > self.buffer_limit:
+            log(f"Message bus: dropping a connection with {writer.transport.get_write_buffer_size()} unsent bytes", level=LogLevel.ERROR)
+            self.dropped += 1
+            writer.transport.abort() # the reader of the connection fails, members reconnect and reset their caches
+
+    async def publish(self, target, message):
+        message = encode_message(message)
+        self.send(target, message)
+        await deliver(target, message)
+
+    def invalidate(self, name, key):
+        """Tells the other workers to drop their cached state of key, can be called from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send, ("cache", name), encode_message({"type": "invalidate", "key": key}))
+
+    def reconnected(self):
+        # invalidations sent while this worker wasn't connected are lost
+        if self.connected:
+            resetCaches()
+        self.connected = True
+
+    def tryBecomeHub(self) -> bool:
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    async def handleMember(self, reader, writer):
+        self.members.add(writer)
+        try:
+            while True:
+                target, message = await SocketBus.readFrame(reader)
+                self.received += 1
+                frame = SocketBus.encodeFrame(target, message)
+                for member in list(self.members):
+                    if member is not writer:
+                        self.write(member, frame)
+                await deliver(target, message)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass # the worker exited, or this hub is stopping
+        finally:
+            self.members.discard(writer)
+            writer.close()
+
+    async def run(self):
+        while True:
+            if self.tryBecomeHub():
+                if os.path.exists(self.path):
+                    os.unlink(self.path) # left over from a hub which exited
+                self.server = await asyncio.start_unix_server(self.handleMember, path=self.path)
+                log(f"Message bus: this worker is the hub on {self.path}")
+                self.reconnected()
+                await self.server.serve_forever()
+                return
+
+            try:
+                reader, self.hub = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(0.5) # the hub is starting or just exited
+                continue
+
+            log(f"Message bus: connected to the hub on {self.path}", level=LogLevel.DEBUG)
+            self.reconnected()
+            try:
+                while True:
+                    target, message = await SocketBus.readFrame(reader)
+                    self.received += 1
+                    await deliver(target, message)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log("Message bus: lost the connection to the hub, reconnecting")
+            finally:
+                self.hub.close()
+                self.hub = None
+
+    async def start(self):
+        if self.task is None:
+            self.loop = asyncio.get_running_loop()
+            self.task = self.loop.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.members):
+                writer.close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        if self.lock_file is not None:
+            self.lock_file.close() # releases the lock, another worker becomes the hub
+            self.lock_file = None
+
+    def getStats(self):
+        return {
+            "type": "socket",
+            "role": "hub" if self.server is not None else ("member" if self.hub is not None else "disconnected"),
+            "members": len(self.members),
+            "published": self.published,
+            "received": self.received,
+            "lost": self.lost,
+            "dropped": self.dropped
+        }
+
+
+def createMessageBus(bus_type : str, path : str):
+    if bus_type == "local":
+        return LocalBus()
+    if bus_type == "socket":
+        return SocketBus(path)
+    raise ValueError(f"Unknown MESSAGE_BUS {bus_type}, use local or socket")
+
+
+message_bus = createMessageBus(message_bus_type, message_bus_path)
+
+async def publish(target, message):
+    await message_bus.publish(target, message)
+
+def invalidateRemote(name, key):
+    message_bus.invalidate(name, key)
@@ -1,15 +1,168 @@
-from util import clientList, global_sync_token_key, _encrypt
+from util import clientList, global_sync_token_key, _encrypt, get_player_clients, encode_message, encode_batch, sse_queue_size
 from objects import *
+from bus import publish
+from collections import deque
+from contextvars import ContextVar
 import asyncio
 import json
 import time
 
 
+RESYNC = "resync" # returned by ClientQueue.get when the backlog was dropped and the client needs a full game sync
+EVICTED = "evicted" # returned by ClientQueue.get when the client stalled and its stream should be closed
+
+def coalesceKey(message):
+    """Messages with the same key replace each other, only the newest state has to reach the client"""
+    if "type" not in message:
+        return None
+    msg_type = message["type"]
+    if msg_type == "gold_update":
+        return ("gold", message["msg"]["playerid"])
+    if msg_type in ("inventory_update", "item_removal"):
+        # player clients only get updates of their own inventory, without a playerid
+        return ("item", message["msg"].get("playerid"), message["msg"]["itemid"])
+    return None
+
+
+class ClientQueue:
+    """Bounded message queue of a client's SSE stream.
+
+    Superseded gold and inventory updates are dropped. If the backlog still grows past max_size it is
+    thrown away and the client gets a full resync, if it overflows again before even taking that resync
+    the client is evicted."""
+
+    def __init__(self, max_size=sse_queue_size):
+        self.max_size = max_size
+        self.entries = deque() # [key, message], message is None once superseded
+        self.pending = {} # coalesce key -> entry
+        self.size = 0
+        self.resync = False
+        self.evicted = False
+        self.waiter = None
+
+        self.delivered = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def put_nowait(self, message):
+        if self.evicted:
+            return
+
+        key = coalesceKey(message)
+        if key is not None:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[1] = None
+                self.size -= 1
+                self.coalesced += 1
+
+        if self.size >= self.max_size:
+            self.overflow()
+            return
+
+        entry = [key, message]
+        self.entries.append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        self.size += 1
+        self.high_water = max(self.high_water, self.size)
+        self.wakeup()
+
+    def overflow(self):
+        self.overflows += 1
+        self.entries.clear()
+        self.pending.clear()
+        self.size = 0
+        if self.resync:
+            self.evicted = True
+        self.resync = True
+        self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def empty(self):
+        return self.size == 0 and not self.resync and not self.evicted
+
+    def qsize(self):
+        return self.size
+
+    def get_nowait(self):
+        if self.evicted:
+            return EVICTED
+        if self.resync:
+            self.resync = False
+            return RESYNC
+        while self.entries:
+            key, message = self.entries.popleft()
+            if message is None:
+                continue
+            if key is not None:
+                del self.pending[key]
+            self.size -= 1
+            self.delivered += 1
+            return message
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while self.empty():
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.get_nowait()
+
+    def getStats(self):
+        return {
+            "queued": self.size,
+            "high_water": self.high_water,
+            "delivered": self.delivered,
+            "coalesced": self.coalesced,
+            "overflows": self.overflows,
+            "evicted": self.evicted
+        }
+
+
+class Outbox:
+    """Collects the messages for the clients of a game while an action runs.
+
+    On flush every client gets one batch event, superseded updates (see coalesceKey) are left out."""
+
+    def __init__(self, gameid):
+        self.gameid = gameid
+        self.messages = {} # client -> {key: message}, unkeyed messages get a unique key
+        self.count = 0
+        self.flushed = False
+
+    def add(self, client, message):
+        messages = self.messages.setdefault(client, {})
+        key = coalesceKey(message)
+        if key is None:
+            self.count += 1
+            key = self.count
+        else:
+            messages.pop(key, None) # the newest update moves to the end
+        messages[key] = message
+
+    def flush(self):
+        self.flushed = True
+        for client, messages in self.messages.items():
+            messages = list(messages.values())
+            client.queue.put_nowait(messages[0] if len(messages) == 1 else encode_batch(messages))
+        self.messages.clear()
+
+
+current_outbox = ContextVar("current_outbox", default=None)
+
+
 class Client:
     def __init__(self, identifier, gameid, playerid, isDM=False):
         self.identifier = identifier
         self.playerid = playerid
-        self.queue = asyncio.Queue()
+        self.queue = ClientQueue()
         self.gameid = gameid
         self.isDM = isDM
 
@@ -24,64 +177,34 @@ class Client:
     
 
     def getInventory(self, session):
-        items = session.query(Item).filter_by(owner=self.playerid).all()
+        items = session.query(Item).filter_by(owner=self.playerid).options(joinedload(Item.prefab)).all()
         inventory = {}
 
         for i in items:
-            inventory[i.id] = {
-                'id': i.id,
-                'id_prefab': i.id_prefab,
-                'name': i.name,
-                'rarity': i.rarity,
-                'type': i.type,
-                'description': i.description,
-                'count': i.count,
-                'value': i.value,
-                'img': i.img,
-                'stackable': i.prefab.stackable,
-                'unique': i.prefab.unique
-            }
+            inventory[i.id] = i.getInfo()
         return inventory
 
 
 
     def getInventories(self, session):
 
-        current_game = Game.getFromId(self.gameid, session)
-
         # Retrieve all players associated with the current game
-        players = session.query(Player).filter_by(gameid=current_game.id).all()
+        players = session.query(Player).filter_by(gameid=self.gameid).all()
 
         # Initialize a dictionary to hold all inventories
         all_inventories = {}
-
-        # For each player, retrieve their inventory
         for player in players:
-            tmp = session.query(Item).filter_by(owner=player.id).all()
-            inventory = {}
-            for i in tmp:
-                inventory[i.id] = {
-                    'id': i.id,
-                    'id_prefab': i.id_prefab,
-                    'name': i.name,
-                    'rarity': i.rarity,
-                    'type': i.type,
-                    'description': i.description,
-                    'count': i.count,
-                    'value': i.value,
-                    'img': i.img,
-                    'stackable': i.prefab.stackable,
-                    'unique': i.prefab.unique
-                }
-
-            # Add the player's inventory to the all_inventories dictionary
             all_inventories[player.id] = {
                 'id': player.id,
                 'name': player.name,
                 'gold': player.gold,
-                'inventory': inventory
+                'inventory': {}
             }
 
+        # Retrieve every item of the game at once and sort them into the inventories
+        for i in Item.getAllFromGame(self.gameid, session):
+            all_inventories[i.owner]['inventory'][i.id] = i.getInfo()
+
         return all_inventories
     
     def isAllowedToSell(self, item : Item, session) -> bool:
@@ -90,11 +213,9 @@ class Client:
         current_game = Game.getFromId(self.gameid, session)
         return current_game.sellingAllowed
 
-    async def sendGameSync(self, session):
-        print(f"Sending game sync to client with playerid {self.playerid}")
+    def getGameSync(self, session):
         game = Game.getFromId(self.gameid, session)
-
-        await self.send({
+        return {
             "type" : "game_info",
             "msg" : {
                 "game": game.getInfo(session=session),
@@ -103,27 +224,42 @@ class Client:
                 "inventory": self.getInventory(session) if not self.isDM else None,
                 "inventories" : self.getInventories(session) if self.isDM else None,
             }
-        })
+        }
 
-        if self.isDM:
-            await self.send({
-                "type": "game_info",
-                "msg": {
-                    "itemlist": ItemPrefab.getList(self.gameid, session)
-                }
-            })
-
-    async def sendItemList(self, session):
-        if self.isDM:
-            await self.send({
-                "type": "game_info",
-                "msg": {
-                    "itemlist": ItemPrefab.getList(self.gameid, session)
-                }
-            })
+    async def sendGameSync(self, session, known_catalog=None, known_version=None):
+        print(f"Sending game sync to client with playerid {self.playerid}")
+        await self.send(await run_db(self.getGameSync, session))
+        await self.sendItemList(session, known_catalog, known_version)
+
+    async def sendItemList(self, session, known_catalog=None, known_version=None):
+        """Sends the itemlist to a dm client. If the client already knows a recent version only the delta is sent"""
+        if not self.isDM:
+            return
+
+        catalog = await run_db(ItemPrefab.getCatalog, self.gameid, session)
+        if known_catalog == catalog.catalog_id and isinstance(known_version, int):
+            delta = catalog.getDelta(known_version)
+            if delta is not None:
+                await self.send({
+                    "type": "itemlist_delta",
+                    "msg": delta
+                })
+                return
+
+        await self.send(Game.buildItemListMessage(catalog))
 
     async def send(self, message):
-        await self.queue.put(message)
+        outbox = current_outbox.get()
+        if outbox is not None and not outbox.flushed and outbox.gameid == self.gameid:
+            outbox.add(self, message)
+        else:
+            self.queue.put_nowait(message)
+
+    async def resync(self):
+        """Sends a full game sync after the backlog of the client was dropped"""
+        print(f"Client with playerid {self.playerid} fell behind, sending a full game sync")
+        with Session() as session:
+            await self.sendGameSync(session)
 
     @staticmethod
     async def sendMessageToClient(identifier, msg):
@@ -134,8 +270,17 @@ class Client:
             print(f"Client {identifier} not found")
 
 
+class RemoteClient(Client):
+    """A client whose event stream is served by another worker, messages to it go over the message bus"""
+
+    def __init__(self, clientid, gameid, playerid, isDM=False):
+        super().__init__(None, gameid, playerid, isDM)
+        self.clientid = clientid
+
+    async def send(self, message):
+        await publish(("client", self.clientid), message)
+
+
 async def sendMessageToPlayer(playerid, msg):
-    # loop through client list and send message to every client with corresponding playerid
-    for _, client in client_list.items():
-        if client.playerid == playerid:
-            await client.send(msg)
\ No newline at end of file
+    # send message to every client with corresponding playerid
+    await publish(("player", playerid), msg)
\ No newline at end of file
@@ -1,10 +1,17 @@
 import time
 
-import requests
+import asyncio
+import hashlib
+import httpx
+import os
 from enum import Enum, auto
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from main import create_new_item
+from sqlalchemy import insert
+from objects import ItemPrefab, Session, run_db
+from util import LogLevel, dnd_api_url, dnd_api_cache_dir
+from log import log
 import json
+import re
+import sys
 
 class ItemType(Enum):
     WEAPON = 1
@@ -47,21 +54,6 @@ def parse_csv(file_path):
 
 
 
-
-
-# Example usage
-if __name__ == "__main__":
-    file_path = 'Items.csv'  # Replace with your CSV file path
-    parsed_data = parse_csv(file_path)
-    types = set()
-    for row in parsed_data:
-        print(row)
-        row_types = [i for i in row["Type"].split(", ")]
-        for type_ in row_types:
-            types.add(type_)
-    print(len(parsed_data))
-    print(len(types), types)
-
 # generic variant
 
 type_translate = {
@@ -109,7 +101,6 @@ class ItemRarity(Enum): # not use auto()
     EPIC = 5
     LEGENDARY = 6
     QUEST_ITEM = 7
-    UNKOWN 
 
 rarityLookup = {
     "Common": ItemRarity.COMMON,
@@ -172,20 +163,11 @@ imgTypes = {
     ItemType.WONDROUS: "https://i.imgur.com/JcOSiaU.jpeg"
 }
 
-def fetchItem(url, gameid, mundane=False):
-    citem = requests.get("https://www.dnd5eapi.co" + url).json()
-    #print(citem)
+def apiItemToPrefab(citem, gameid, mundane=False):
+    """Converts an item of the dnd5eapi equipment / magic-items endpoints to prefab columns"""
     item_name = citem["name"]
     item_type = None
 
-    if "variants" in citem and len(citem["variants"]) > 0:
-        print("Item has Variants...")
-        for variant in citem["variants"]:
-            print(f" - Creating Variant {variant['name']}...")
-            fetchItem(variant["url"], gameid, mundane=mundane)
-        return # this item has variants of it, do not add itself to the list
-
-
     try:
         item_type = typeLookup[citem["equipment_category"]["name"]]
     except:
@@ -252,25 +234,209 @@ def fetchItem(url, gameid, mundane=False):
                 if "max_bonus" in citem["armor_class"]:
                     item_desc += " (max " + str(citem["armor_class"]["max_bonus"]) + ")"
 
-    if create_new_item(item_name, item_desc, item_value, item_img, item_rarity.value, item_type.value, gameid):
-        #print(f"Item {item_name} created successfully")
-        pass
-    else:
-        print(f"Item {item_name} failed to be created")
-
-def importDnDItems(gameid:int):
-    print("\nCreating mundane Items...\n")
+    return {
+        "name": item_name,
+        "description": item_desc,
+        "gameid": gameid,
+        "value": item_value,
+        "rarity": item_rarity.value,
+        "type": item_type.value,
+        "img": item_img,
+        "stackable": False,
+        "unique": False
+    }
+
+
+class APIClient:
+    """Fetches json from the dnd5eapi with a pooled http client, a concurrency limit, retries and an on-disk cache"""
+
+    def __init__(self, base_url=None, cache_dir=None, concurrency=8, retries=4, backoff=0.5):
+        self.base_url = (base_url or dnd_api_url).rstrip("/")
+        self.cache_dir = cache_dir if cache_dir is not None else dnd_api_cache_dir
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.requests = 0
+        self.cache_hits = 0
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(20.0),
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.client.aclose()
+
+    def _cachePath(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".json")
+
+    def _readCache(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cachePath(url), mode='r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _writeCache(self, url, data):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._cachePath(url) + ".tmp"
+        with open(tmp_path, mode='w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._cachePath(url))
+
+    async def get(self, path):
+        url = self.base_url + path
+        cached = self._readCache(url)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.requests += 1
+                    response = await self.client.get(url)
+                    if response.status_code == 429 or response.status_code >= 500:
+                        raise httpx.HTTPStatusError(f"Server responded with {response.status_code}", request=response.request, response=response)
+                    response.raise_for_status()
+                    data = response.json()
+                    break
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code == 429 or e.response.status_code >= 500
+                    if not retryable or attempt >= self.retries:
+                        raise
+                    delay = self.backoff * (2 ** attempt)
+                    retry_after = e.response.headers.get("Retry-After") if isinstance(e, httpx.HTTPStatusError) else None
+                    if retry_after is not None and retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                    log(f"Request to {url} failed ({e}), retrying in {delay}s", level=LogLevel.DEBUG)
+                    await asyncio.sleep(delay)
+
+        self._writeCache(url, data)
+        return data
+
+
+async def fetchItem(api : APIClient, url, gameid, mundane=False):
+    """Returns the prefabs for an item, items with variants are replaced by their variants"""
+    citem = await api.get(url)
 
-    items = requests.get("https://www.dnd5eapi.co/api/equipment").json()["results"]
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(fetchItem, item["url"], gameid, True) for item in items]
-        for future in as_completed(futures):
-            future.result()  # To raise any exceptions that occurred
-
-    print("\nCreating magical items...\n")
+    if "variants" in citem and len(citem["variants"]) > 0:
+        results = await asyncio.gather(*[fetchItem(api, variant["url"], gameid, mundane=mundane) for variant in citem["variants"]])
+        return [prefab for result in results for prefab in result] # this item has variants of it, do not add itself to the list
+
+    return [apiItemToPrefab(citem, gameid, mundane)]
+
+async def importDnDItems(gameid:int, base_url=None, cache_dir=None, concurrency=8) -> int:
+    """Imports the equipment and magic items into a game or, for gameid None, into the shared library"""
+    start = time.perf_counter()
+    async with APIClient(base_url, cache_dir, concurrency) as api:
+        prefabs = []
+        for endpoint, mundane in (("/api/equipment", True), ("/api/magic-items", False)):
+            print(f"\nFetching {'mundane' if mundane else 'magical'} Items...\n")
+            items = (await api.get(endpoint))["results"]
+            results = await asyncio.gather(*[fetchItem(api, item["url"], gameid, mundane) for item in items])
+            for result in results:
+                prefabs.extend(result)
+
+    session = Session()
+    try:
+        count = await run_db(insertPrefabs, session, prefabs)
+    finally:
+        session.close()
+        ItemPrefab.invalidateCache(gameid)
+
+    log(f"Imported {count} items from {api.base_url} for {'the library' if gameid is None else f'game {gameid}'} in {time.perf_counter() - start:.2f}s ({api.requests} requests, {api.cache_hits} cached)")
+    return count
+
+
+def insertPrefabs(session, prefabs, chunk_size=1000) -> int:
+    """Bulk inserts prefab rows with one transaction per chunk"""
+    count = 0
+    for i in range(0, len(prefabs), chunk_size):
+        chunk = prefabs[i:i + chunk_size]
+        session.execute(insert(ItemPrefab), chunk)
+        session.commit()
+        count += len(chunk)
+    return count
+
+
+def csvItemType(type_column : str) -> ItemType:
+    """Maps the Type column of Items.csv (e.g. "melee weapon, martial weapon" or "treasure (gemstone)") to an ItemType"""
+    for type_ in type_column.lower().split(", "):
+        type_ = type_.split(" (")[0].strip()
+        if type_ in type_translate:
+            return type_translate[type_]
+        for word in type_.split(" "):
+            if word in type_translate:
+                return type_translate[word]
+    return ItemType.MISC
+
+def csvItemRarity(rarity_column : str) -> ItemRarity:
+    return rarityLookup.get(rarity_column.strip().title(), ItemRarity.MUNDANE)
+
+coin_values = {
+    "pp": 10,
+    "gp": 1,
+    "ep": 0.5,
+    "sp": 0.1,
+    "cp": 0.01,
+}
 
-    items = requests.get("https://www.dnd5eapi.co/api/magic-items").json()["results"]
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(fetchItem, item["url"], gameid, False) for item in items]
-        for future in as_completed(futures):
-            future.result()  # To raise any exceptions that occurred
\ No newline at end of file
+def csvItemValue(value_column : str) -> int:
+    """Converts values like "1,000 gp, 5 sp" to gold, items without a value are worth 1 gold like in fetchItem"""
+    value = 0
+    for quantity, unit in re.findall(r"([\d,.]+)\s*(pp|gp|ep|sp|cp)", value_column):
+        value += float(quantity.replace(",", "")) * coin_values[unit]
+    return round(value) if value > 0 else 1
+
+def csvRowToPrefab(row, gameid : int):
+    item_type = csvItemType(row["Type"])
+    return {
+        "name": row["Name"],
+        "description": row["Text"],
+        "gameid": gameid,
+        "value": csvItemValue(row["Value"]),
+        "rarity": csvItemRarity(row["Rarity"]).value,
+        "type": item_type.value,
+        "img": imgTypes[item_type] if item_type in imgTypes.keys() else defaultImgType,
+        "stackable": False,
+        "unique": False
+    }
+
+def importCSVItems(gameid : int, file_path='Items.csv', chunk_size=1000) -> int:
+    """Offline import of a CSV export like Items.csv into a game or, for gameid None, into the shared library.
+    Rows are streamed and bulk inserted with one transaction per chunk"""
+    start = time.perf_counter()
+    count = 0
+
+    session = Session()
+    try:
+        with open(file_path, mode='r', newline='') as csvfile:
+            chunk = []
+            for row in csv.DictReader(csvfile):
+                chunk.append(csvRowToPrefab(row, gameid))
+                if len(chunk) >= chunk_size:
+                    count += insertPrefabs(session, chunk, chunk_size)
+                    chunk = []
+            count += insertPrefabs(session, chunk, chunk_size)
+    finally:
+        session.close()
+        ItemPrefab.invalidateCache(gameid)
+
+    duration = time.perf_counter() - start
+    log(f"Imported {count} items from {file_path} for {'the library' if gameid is None else f'game {gameid}'} in {duration:.2f}s ({count / max(duration, 1e-9):.0f} rows/sec)")
+    return count
+
+
+# Offline import: python fetchItems.py <gameid|library> [file_path]
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python fetchItems.py <gameid|library> [file_path]")
+        sys.exit(1)
+    importCSVItems(None if sys.argv[1] == "library" else int(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else 'Items.csv')
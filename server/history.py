@@ -0,0 +1,112 @@
+from objects import History, Session, run_db
+from util import LogLevel
+from log import log
+from sqlalchemy import insert
+import asyncio
+import threading
+import time
+
+
+class HistoryWriter:
+    """Buffers audit events and writes them to the history table in batches, so actions never wait for it"""
+
+    def __init__(self, batch_size=100, flush_interval=1.0, max_buffer=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, gameid : int, action : str, actor : int = None, playerid : int = None, itemid : int = None,
+               prefabid : int = None, gold_delta : int = None, message : str = None):
+        row = {
+            "gameid": gameid,
+            "timestamp": time.time(),
+            "actor": actor,
+            "action": action,
+            "playerid": playerid,
+            "itemid": itemid,
+            "prefabid": prefabid,
+            "gold_delta": gold_delta,
+            "log": message
+        }
+        with self.lock:
+            if len(self.buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_size
+
+        if full and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    @staticmethod
+    def _insert(rows):
+        with Session() as session:
+            session.execute(insert(History), rows)
+            session.commit()
+
+    async def flush(self):
+        with self.lock:
+            rows = self.buffer
+            self.buffer = []
+        if not rows:
+            return
+        try:
+            await run_db(HistoryWriter._insert, rows)
+            self.written += len(rows)
+        except Exception as e:
+            log(f"Failed to write {len(rows)} history events: {e}", level=LogLevel.ERROR)
+            with self.lock:
+                self.buffer[:0] = rows[:max(self.max_buffer - len(self.buffer), 0)]
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                await self.flush()
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
+
+    def start(self):
+        if self.task is None:
+            self.loop = asyncio.get_running_loop()
+            self.wakeup = asyncio.Event()
+            self.task = self.loop.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            self.loop = None
+
+
+history_writer = HistoryWriter()
+
+def recordEvent(client, action : str, **kwargs):
+    """Records an action of a client in the history of its game"""
+    history_writer.record(client.gameid, action, actor=client.playerid, **kwargs)
+
+async def getHistory(gameid : int, since : float = None, until : float = None, before : tuple = None, limit : int = 50):
+    await history_writer.flush() # include events which are still buffered
+
+    def query():
+        with Session() as session:
+            return [event.getInfo() for event in History.getPage(gameid, session, since, until, before, limit)]
+    return await run_db(query)
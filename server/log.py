@@ -1,27 +1,156 @@
-from util import LogLevel, discord_webhook_url, loglevel_prefixes
-import requests
+from util import LogLevel, discord_webhook_url, loglevel_prefixes, debug_log
+from collections import deque
 from datetime import datetime
+import asyncio
+import httpx
+import threading
+import time
 
-enableDebugLog = True
+enableDebugLog = debug_log
 printLogToConsole = True
 
-def send_discord_message(msg):
 
-    if not discord_webhook_url:
-        return # No webhook URL set, don't send the message
-    
-    data = {
-        "content": msg,
-        "username": "DnD Logger"
-    }
+class DiscordLogShipper:
+    """Ships log lines to a Discord webhook from a background task.
+
+    Lines are put into a bounded queue (from the event loop or from db executor threads), sent in batches of
+    up to max_batch_chars per webhook post and dropped, with a count, if the queue is full."""
+
+    def __init__(self, webhook_url, max_queue=1000, batch_interval=2.0, max_batch_chars=1900, username="DnD Logger"):
+        self.webhook_url = webhook_url
+        self.max_queue = max_queue
+        self.batch_interval = batch_interval
+        self.max_batch_chars = max_batch_chars
+        self.username = username
+
+        self.lines = deque()
+        self.lock = threading.Lock()
+        self.task = None
+        self.retry_at = 0 # monotonic time until which the webhook is rate limited
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._unreported_drops = 0
+
+    def enqueue(self, line : str) -> bool:
+        with self.lock:
+            if len(self.lines) >= self.max_queue:
+                self.dropped += 1
+                self._unreported_drops += 1
+                return False
+            self.lines.append(line[:self.max_batch_chars])
+        return True
+
+    def _takeBatch(self):
+        with self.lock:
+            lines = []
+            length = 0
+            drops = self._unreported_drops
+            self._unreported_drops = 0
+            if drops > 0:
+                length += len(f"({drops} log lines dropped)") + 1
+            while self.lines and length + len(self.lines[0]) + 1 <= self.max_batch_chars:
+                line = self.lines.popleft()
+                lines.append(line)
+                length += len(line) + 1
+            if self.lines and not lines:
+                # a line which doesn't fit next to the dropped count is cut, it would block the queue otherwise
+                lines.append(self.lines.popleft()[:self.max_batch_chars - length])
+            return lines, drops
+
+    def _requeue(self, lines, drops):
+        with self.lock:
+            self.lines.extendleft(reversed(lines))
+            self._unreported_drops += drops
+
+    async def _post(self, client : httpx.AsyncClient, lines, drops) -> bool:
+        """Returns False if the batch should be retried later"""
+        content = "\n".join(lines)
+        if drops > 0:
+            content = f"({drops} log lines dropped)\n" + content
+        try:
+            response = await client.post(self.webhook_url, json={
+                "content": content,
+                "username": self.username
+            })
+        except httpx.HTTPError as e:
+            print(f"Failed to send log to discord: {e}")
+            self.retry_at = time.monotonic() + self.batch_interval * 5
+            return False
+
+        if response.status_code == 429:
+            retry_after = 5.0
+            try:
+                retry_after = float(response.json().get("retry_after", retry_after))
+            except (ValueError, AttributeError):
+                pass
+            self.retry_at = time.monotonic() + retry_after
+            return False
+
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            self.retry_at = time.monotonic() + float(response.headers.get("X-RateLimit-Reset-After", self.batch_interval))
 
-    # Send the POST request to Discord's webhook URL
-    response = requests.post(discord_webhook_url, json=data)
+        if response.status_code >= 400:
+            print(f"Failed to send log to discord, status code: {response.status_code}")
+            self.failed += len(lines)
+            return True
 
-    if response.status_code == 204:
-        print("Message sent successfully")
-    else:
-        print(f"Failed to send message, status code: {response.status_code}")
+        self.sent += len(lines)
+        return True
+
+    async def run(self):
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10.0)) as client:
+            try:
+                while True:
+                    await asyncio.sleep(max(self.batch_interval, self.retry_at - time.monotonic()))
+                    await self.flush(client)
+            except asyncio.CancelledError:
+                await self.flush(client, ignoreRateLimit=True)
+                raise
+
+    async def flush(self, client : httpx.AsyncClient, ignoreRateLimit=False):
+        while True:
+            if not ignoreRateLimit and self.retry_at > time.monotonic():
+                return
+            lines, drops = self._takeBatch()
+            if not lines and drops == 0:
+                return
+            if not await self._post(client, lines, drops):
+                self._requeue(lines, drops)
+                return
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def getStats(self):
+        with self.lock:
+            queued = len(self.lines)
+        return {
+            "queued": queued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
+
+
+discord_shipper = DiscordLogShipper(discord_webhook_url) if discord_webhook_url else None
+
+def send_discord_message(msg):
+    """Queues a message for the discord webhook, never blocks"""
+    if discord_shipper is None:
+        return # No webhook URL set, don't send the message
+    discord_shipper.enqueue(msg)
 
 def log(msg : str, level=LogLevel.INFO) -> None:
 
@@ -34,5 +163,8 @@ def log(msg : str, level=LogLevel.INFO) -> None:
     if printLogToConsole or level == LogLevel.ERROR:
         print(toAdd)
 
+    if level == LogLevel.ERROR:
+        send_discord_message(toAdd)
+
 def logErrorAndNotify(msg : str) -> None:
-    log(msg, level=LogLevel.ERROR)
\ No newline at end of file
+    log(msg, level=LogLevel.ERROR)
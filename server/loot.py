@@ -0,0 +1,568 @@
+from objects import Game, Player, Item, ItemPrefab, LootPoolState, LootEntry, Session
+from objects import run_db
+from util import ItemRarity, max_generated_loot
+from bus import publish, registerCacheHandler, invalidateRemote
+from enum import Enum
+from collections import Counter
+from sqlalchemy.exc import IntegrityError
+import asyncio
+import json
+import random
+import secrets
+import threading
+
+# loot pool of every game which used one since the start, pools of other games are restored from the database on first use.
+# Every write of a pool bumps its revision in the database and drops the cached pool of the other workers, a write based
+# on an older revision fails, so a worker never overwrites changes it hasn't seen
+loot_pools = {}
+loot_pools_lock = threading.Lock() # pools are looked up from the db executor threads
+
+# count_list keys of GenerateLootItems
+loot_rarities = {
+    'common': ItemRarity.COMMON,
+    'uncommon': ItemRarity.UNCOMMON,
+    'rare': ItemRarity.RARE,
+    'veryRare': ItemRarity.VERY_RARE,
+    'epic': ItemRarity.EPIC,
+    'legendary': ItemRarity.LEGENDARY
+}
+
+
+class BiasPicker:
+    """Picks the players who receive unclaimed or tied items.
+
+    Every pick goes to one of the players who received the fewest such items so far, uniformly at random.
+    The players with the fewest items are dealt from a shuffled list, which is refilled once every one of them
+    received one more, so a pick doesn't have to look at every player."""
+
+    def __init__(self, players : list, rng : random.Random):
+        self.rng = rng
+        self.players = players
+        self.bias = dict.fromkeys(players, 0)
+        self.lowest = -1
+        self.candidates = [] # the players whose bias is lowest, in random order
+        self.refill()
+
+    def refill(self):
+        self.lowest += 1
+        self.candidates = [playerid for playerid in self.players if self.bias[playerid] == self.lowest]
+        self.rng.shuffle(self.candidates)
+
+    def pick(self, candidates=None):
+        """Picks one of the candidates (every player if None) who received the fewest items"""
+        if candidates is None:
+            picked = self.candidates.pop()
+        else:
+            lowest = min(self.bias[playerid] for playerid in candidates)
+            picked = self.rng.choice([playerid for playerid in candidates if self.bias[playerid] == lowest])
+            if lowest == self.lowest:
+                self.candidates.remove(picked)
+
+        self.bias[picked] += 1
+        if not self.candidates:
+            self.refill()
+        return picked
+
+
+def resolveLoot(loot : dict, players : list, rng : random.Random) -> dict:
+    """Distributes the loot between the players.
+
+    An item claimed by one player goes to that player, an item claimed by several players to the claimer
+    with the most votes, and an unclaimed item to a random player. Ties and unclaimed items go to the players
+    who received the fewest of them so far. Items are handled in the order of the pool, which is the order of
+    their loot ids, so the result only depends on the state of the pool and the rng."""
+    results = {playerid: [] for playerid in players}
+    if len(players) == 0:
+        return results
+
+    picker = BiasPicker(players, rng)
+    pick = picker.pick
+    for loot_id, vals in loot.items():
+        claims = vals["claims"]
+        if not claims:
+            # nobody claimed it, a random player who received the fewest random items gets it
+            results[pick()].append(loot_id)
+            continue
+
+        claimers = [playerid for playerid, claimed in claims.items() if claimed and playerid in results]
+        if len(claimers) == 0:
+            results[pick()].append(loot_id) # every claim was withdrawn
+            continue
+
+        if len(claimers) == 1:
+            results[claimers[0]].append(loot_id)
+            continue
+
+        # only contested items need their votes counted, and only the votes for a claimer count
+        tally = dict.fromkeys(claimers, 0)
+        for vote in vals["votes"].values():
+            if vote in tally:
+                tally[vote] += 1
+        highest = max(tally.values())
+        winners = [playerid for playerid in claimers if tally[playerid] == highest]
+        results[winners[0] if len(winners) == 1 else pick(winners)].append(loot_id)
+
+    return results
+
+
+def splitGold(gold : int, players : list, rng : random.Random) -> dict:
+    """Splits the gold evenly between the players, the leftover pieces go to random players"""
+    if len(players) == 0:
+        return {}
+    share, leftover = divmod(max(gold or 0, 0), len(players))
+    shares = dict.fromkeys(players, share)
+    for playerid in rng.sample(players, leftover):
+        shares[playerid] += 1
+    return shares
+
+
+class LootPool:
+
+    class Phase(Enum):
+        PREP = 0
+        CLAIM = 1
+        VOTE = 2
+        CONCLUDED = 3
+
+    def __init__(self, gameid):
+        self.gameid = gameid
+        self.loot = {}
+        self.gold = 0
+
+        self.finished = [] # players who are finished claiming / voting
+        self.players = [] # players who should receive anything from this lootpool
+        self.votes = []
+        self.claims = []
+
+        self.members = {} # playerid -> name of the players in the game, loaded when the loot gets distributed
+
+        self.nextLootId = 1
+        self.seed = None # seed of the distribution once it was resolved, so it can be repeated
+
+
+        self.phase = LootPool.Phase.PREP
+
+        self.revision = 0 # revision of the pool in the database, 0 until it is written the first time
+        self.write_lock = asyncio.Lock() # writes of the pool go to the executor one at a time, in order
+
+        # revision the clients were sent last, clients which missed a broadcast ask for the full list again.
+        # Revisions are counted in the database, so broadcasts of different workers continue each other's versions
+        self.version = 0
+        self.changes = [] # changes since the last broadcast, None if the full list has to be sent
+
+    def recordChange(self, change):
+        if self.changes is not None:
+            self.changes.append(change)
+
+    def markChanged(self):
+        """The loot or the players changed, the next broadcast sends the full list"""
+        self.changes = None
+
+    def addLoot(self, itemid : int, item : dict):
+        """item is the prefab info of itemid, it is kept with the loot so the list doesn't have to look it up again"""
+        self.loot[self.nextLootId] = {}
+        self.loot[self.nextLootId]["itemid"] = itemid
+        self.loot[self.nextLootId]["item"] = item
+        self.loot[self.nextLootId]["claims"] = {}
+        self.loot[self.nextLootId]["votes"] = {}
+        self.nextLootId += 1
+        self.markChanged()
+
+    def removeLoot(self, loot_id : int):
+        try:
+            del self.loot[loot_id]
+        except KeyError:
+            return
+        self.markChanged()
+
+    def setGold(self, gold : int):
+        self.gold = gold
+        self.markChanged()
+
+    def setPlayers(self, players : list):
+        self.players = players
+        self.markChanged()
+
+    def loadMembers(self, session):
+        current_game = Game.getFromId(self.gameid, session)
+        self.members = {ply.id: ply.name for ply in current_game.players}
+
+    def getToWait(self):
+        results = {}
+        for playerid, name in self.members.items():
+            if self.phase == LootPool.Phase.CLAIM:
+                if playerid not in self.finished:
+                    if playerid in self.players:
+                        results[playerid] = name
+            elif self.phase == LootPool.Phase.VOTE:
+                if playerid not in self.finished:
+                    results[playerid] = name
+        return results
+
+    def handleNewFinish(self, player_id : int) -> bool:
+        """Returns True if after the player_id has been added, every player has voted / claimed"""
+
+        # if already "finished" then ignore
+        if player_id in self.finished:
+            return False
+
+        # if it is the claim phase, only people who are in self.players are allowed to claim / others are ignored
+        if self.phase == LootPool.Phase.CLAIM and player_id not in self.players:
+            return False
+
+        if player_id in self.members:
+            self.finished.append(player_id)
+            self.recordChange({"type": "finished", "playerid": player_id})
+
+        return len(self.members) == len(self.finished) if self.phase == LootPool.Phase.VOTE else len(self.finished) == len(self.players)
+
+    def setClaim(self, loot_id : int, player_id : int, unClaim=False):
+        if self.phase is not LootPool.Phase.CLAIM:
+            return
+        if self.loot.get(loot_id) is None:
+            return
+        if player_id not in self.players:
+            return
+        if unClaim:
+            self.loot[loot_id]["claims"][player_id] = None
+            self.loot[loot_id]["votes"][player_id] = None
+        else:
+            self.loot[loot_id]["claims"][player_id] = True
+            self.loot[loot_id]["votes"][player_id] = player_id
+        self.recordChange({"type": "claim", "lootid": loot_id, "playerid": player_id,
+                           "claim": self.loot[loot_id]["claims"][player_id], "vote": self.loot[loot_id]["votes"][player_id]})
+
+    def setVote(self, loot_id : int, voted_player_id : int, vote_player_id : int):
+        if self.phase is not LootPool.Phase.VOTE:
+            return
+        if self.loot.get(loot_id) is None:
+            return
+        if voted_player_id not in self.players:
+            return # only allow votes for people who are allowed to get this item
+        if not self.loot[loot_id]["claims"].get(voted_player_id):
+            return # only allow votes for people who claim this item
+
+        if self.loot[loot_id]["claims"].get(vote_player_id):
+            return # if you have claimed an item you automatically vote for yourself
+        self.loot[loot_id]["votes"][vote_player_id] = voted_player_id
+        self.recordChange({"type": "vote", "lootid": loot_id, "playerid": vote_player_id, "vote": voted_player_id})
+
+    async def resolve(self, seed=None) -> (tuple | None):
+        """Returns (playerid -> loot ids each player receives, seed), the same seed always gives the same result.
+
+        Without a seed the stored one is used, or a new one is generated and stored with the pool, so resolving
+        again (also after a restart) repeats the distribution. None if another worker changed the pool"""
+        if self.phase is not LootPool.Phase.VOTE:
+            return
+        if seed is None:
+            seed = self.seed if self.seed is not None else secrets.randbits(63)
+        results = resolveLoot(self.loot, self.players, random.Random(seed))
+        if seed != self.seed:
+            self.seed = seed
+            if not await self._save(LootPool._writeSeed, lambda: (self.gameid, seed)):
+                return
+        return results, seed
+
+    async def conclude(self) -> (dict | None):
+        """Resolves the votes, gives every player its loot and its share of the gold and concludes the pool.
+
+        The items, the gold and the phase are written in one transaction. Returns the "seed", the "loot" ids and "gold"
+        of every player, the ids of the given "items" and the "players" whose gold changed.
+        None if the pool isn't in the vote phase or another worker changed it"""
+        resolved = await self.resolve()
+        if resolved is None:
+            return
+        results, seed = resolved
+        gold = splitGold(self.gold, self.players, random.Random(seed))
+        self.nextPhase()
+
+        def rows():
+            state = {"phase": self.phase.value, "finished": json.dumps(self.finished)}
+            grants = {playerid: [self.loot[loot_id]["itemid"] for loot_id in loot_ids] for playerid, loot_ids in results.items()}
+            return self.gameid, state, grants, gold
+        given = await self._save(LootPool._writeConclusion, rows)
+        if given is False:
+            return
+        return {"seed": seed, "loot": results, "gold": gold, **given}
+
+
+    def abortLootPool(self):
+        LootPool.delete_by_gameid(self.gameid)
+
+    def nextPhase(self):
+        self.finished = []
+        if self.phase is LootPool.Phase.PREP:
+            self.phase = LootPool.Phase.CLAIM
+        elif self.phase is LootPool.Phase.CLAIM:
+            self.phase = LootPool.Phase.VOTE
+        elif self.phase is LootPool.Phase.VOTE:
+            self.phase = LootPool.Phase.CONCLUDED
+        self.recordChange({"type": "phase", "phase": self.phase.value, "waiting": self.getToWait()})
+
+    def getLoot(self):
+        loot_list = {}
+        for lootid, vals in self.loot.items():
+            loot_list[lootid] = dict(vals["item"], lootid=lootid, ext={"itemid": vals["itemid"], "claims": vals["claims"], "votes": vals["votes"]})
+        return loot_list
+
+    def generateRandomLoot(self, countList, itemType=None, weighting="uniform", seed=None):
+        """Adds count random prefabs of every rarity in countList, only of itemType if it isn't None"""
+        with Session() as session: # only used if the catalog isn't loaded yet
+            sampler = ItemPrefab.getCatalog(self.gameid, session).getSampler(weighting)
+
+        rng = random.Random(seed)
+        remaining = max_generated_loot - len(self.loot)
+        for rarity_str, rarity_enum in loot_rarities.items():
+            count = min(int(countList.get(rarity_str, 0) or 0), remaining)
+            if count <= 0:
+                continue
+            for item in sampler.sample(rarity_enum.value, itemType, count, rng):
+                self.addLoot(item['id'], item)
+                remaining -= 1
+
+    async def sendLootList(self, client=None):
+        """Sends the whole loot pool to every client of the game, or only to the given client"""
+        to_send_list = {
+            "type": "loot_list_update",
+            "msg": {
+                "items": self.getLoot(),
+                "gold": self.gold,
+                "players": self.players,
+                "phase": self.phase.value,
+                "waiting": self.getToWait(),
+                "version": self.version
+            }
+        }
+        if client is not None:
+            await client.send(to_send_list)
+        else:
+            await publish(("game", self.gameid), to_send_list)
+
+    async def broadcast(self):
+        """Sends the changes since the last broadcast to every client of the game, the full list if the loot changed"""
+        changes = self.changes
+        self.changes = []
+        if changes is not None and len(changes) == 0:
+            return
+
+        from_version, self.version = self.version, self.revision
+        if changes is None:
+            await self.sendLootList()
+            return
+
+        await publish(("game", self.gameid), {
+            "type": "loot_list_delta",
+            "msg": {
+                "from_version": from_version,
+                "version": self.version,
+                "changes": changes
+            }
+        })
+
+    # Persistence: the whole pool is written in one transaction whenever its phase or loot changes,
+    # claims, votes and finished players are written on their own.
+    # The rows are built on the event loop once the previous write is done, so the pool doesn't change while the executor
+    # writes them and an older state never overwrites a newer one. Every write returns False if another worker
+    # changed the pool in the meantime, the pool is dropped then and the next lookup loads the current one
+
+    async def _save(self, write, rows):
+        """Returns what write returned, False if it was based on an old revision"""
+        async with self.write_lock:
+            result = await run_db(write, *rows(), self.revision)
+            if result is False:
+                LootPool.dropCached(self.gameid, self)
+                return False
+            self.revision += 1
+        invalidateRemote("loot", self.gameid)
+        return result
+
+    async def checkpoint(self) -> bool:
+        def rows():
+            state = {
+                "gameid": self.gameid,
+                "phase": self.phase.value,
+                "gold": self.gold,
+                "players": json.dumps(self.players),
+                "finished": json.dumps(self.finished),
+                "next_loot_id": self.nextLootId,
+                "seed": self.seed
+            }
+            entries = [
+                {"gameid": self.gameid, "lootid": lootid, "itemid": vals["itemid"], "claims": json.dumps(vals["claims"]), "votes": json.dumps(vals["votes"])}
+                for lootid, vals in self.loot.items()
+            ]
+            return state, entries
+        return await self._save(LootPool._writeCheckpoint, rows)
+
+    @staticmethod
+    def _writeCheckpoint(state, entries, revision) -> bool:
+        with Session() as session:
+            if revision == 0:
+                session.add(LootPoolState(**state, revision=1))
+                try:
+                    session.flush()
+                except IntegrityError:
+                    return False # another worker created a pool for the game first
+            elif session.query(LootPoolState).filter_by(gameid=state["gameid"], revision=revision).update(dict(state, revision=revision + 1)) == 0:
+                return False
+            session.query(LootEntry).filter_by(gameid=state["gameid"]).delete()
+            session.add_all([LootEntry(**entry) for entry in entries])
+            session.commit()
+        return True
+
+    @staticmethod
+    def _bumpRevision(gameid, revision, session) -> bool:
+        return session.query(LootPoolState).filter_by(gameid=gameid, revision=revision).update({"revision": revision + 1}) == 1
+
+    async def saveEntry(self, loot_id : int) -> bool:
+        if self.loot.get(loot_id) is None:
+            return True
+        return await self._save(LootPool._writeEntry, lambda: (self.gameid, loot_id, json.dumps(self.loot[loot_id]["claims"]), json.dumps(self.loot[loot_id]["votes"])))
+
+    @staticmethod
+    def _writeEntry(gameid, loot_id, claims, votes, revision) -> bool:
+        with Session() as session:
+            if not LootPool._bumpRevision(gameid, revision, session):
+                return False
+            session.query(LootEntry).filter_by(gameid=gameid, lootid=loot_id).update({"claims": claims, "votes": votes})
+            session.commit()
+        return True
+
+    async def saveFinished(self) -> bool:
+        return await self._save(LootPool._writeFinished, lambda: (self.gameid, json.dumps(self.finished)))
+
+    @staticmethod
+    def _writeFinished(gameid, finished, revision) -> bool:
+        with Session() as session:
+            if session.query(LootPoolState).filter_by(gameid=gameid, revision=revision).update({"finished": finished, "revision": revision + 1}) == 0:
+                return False
+            session.commit()
+        return True
+
+    @staticmethod
+    def _writeSeed(gameid, seed, revision) -> bool:
+        with Session() as session:
+            if session.query(LootPoolState).filter_by(gameid=gameid, revision=revision).update({"seed": seed, "revision": revision + 1}) == 0:
+                return False
+            session.commit()
+        return True
+
+    @staticmethod
+    def _writeConclusion(gameid, state, grants, gold, revision):
+        """grants are the prefab ids every player receives. Returns the ids of the given items and the players
+        whose gold changed, items whose prefab was deleted or which are unique and already owned are skipped"""
+        with Session() as session:
+            if session.query(LootPoolState).filter_by(gameid=gameid, revision=revision).update(dict(state, revision=revision + 1)) == 0:
+                return False
+
+            catalog = ItemPrefab.getCatalog(gameid, session)
+            prefabids = {prefabid for received in grants.values() for prefabid in received}
+            stacks = {(item.owner, item.id_prefab): item for item in session.query(Item).filter(Item.owner.in_(list(grants)), Item.id_prefab.in_(prefabids))}
+            owned = {prefabid for (prefabid,) in session.query(Item.id_prefab).join(Player, Item.owner == Player.id).filter(Player.gameid == gameid, Item.id_prefab.in_(prefabids))}
+
+            items = []
+            for playerid, received in grants.items():
+                for prefabid in received:
+                    info = catalog.get(prefabid)
+                    if info is None or (info['unique'] and prefabid in owned):
+                        continue
+                    owned.add(prefabid)
+                    item = stacks.get((playerid, prefabid)) if info['stackable'] else None
+                    if item is None:
+                        item = Item(id_prefab=prefabid, count=1, owner=playerid)
+                        session.add(item)
+                        if info['stackable']:
+                            stacks[(playerid, prefabid)] = item
+                    else:
+                        item.count += 1
+                    items.append(item)
+
+            players = session.query(Player).filter(Player.id.in_([playerid for playerid, share in gold.items() if share > 0])).all()
+            for player in players:
+                player.gold = (player.gold or 0) + gold[player.id]
+            session.commit()
+            return {"items": list(dict.fromkeys(item.id for item in items)), "players": players}
+
+    @staticmethod
+    def restore(gameid, session):
+        """Loads the pool of a game from the database, None if the game has none"""
+        state = session.query(LootPoolState).filter_by(gameid=gameid).first()
+        if state is None:
+            return None
+
+        pool = LootPool(gameid)
+        pool.phase = LootPool.Phase(state.phase)
+        pool.gold = state.gold
+        pool.players = json.loads(state.players)
+        pool.finished = json.loads(state.finished)
+        pool.nextLootId = state.next_loot_id
+        pool.seed = state.seed
+        pool.revision = state.revision
+        pool.version = state.revision
+        pool.loadMembers(session)
+        catalog = ItemPrefab.getCatalog(gameid, session)
+        for entry in session.query(LootEntry).filter_by(gameid=gameid).order_by(LootEntry.lootid):
+            # json turned the player ids into strings
+            pool.loot[entry.lootid] = {
+                "itemid": entry.itemid,
+                "item": catalog.get(entry.itemid) or {"id": entry.itemid, "name": "Unknown item"}, # the prefab was deleted since
+                "claims": {int(playerid): claimed for playerid, claimed in json.loads(entry.claims).items()},
+                "votes": {int(playerid): vote for playerid, vote in json.loads(entry.votes).items()}
+            }
+        return pool
+
+    @classmethod
+    def get_all_instances(cls):
+        return list(loot_pools.values())
+
+    @classmethod
+    def find_by_gameid(cls, gameid):
+        pool = loot_pools.get(gameid)
+        if pool is not None:
+            return pool
+        with loot_pools_lock:
+            if gameid not in loot_pools:
+                with Session() as session:
+                    pool = LootPool.restore(gameid, session)
+                if pool is None:
+                    return None
+                loot_pools[gameid] = pool
+            return loot_pools[gameid]
+
+    @staticmethod
+    def dropCached(gameid, pool=None):
+        """Drops the cached pool of a game (of every game if gameid is None), only if it is still pool if one is given"""
+        with loot_pools_lock:
+            if gameid is None:
+                loot_pools.clear()
+            elif pool is None or loot_pools.get(gameid) is pool:
+                loot_pools.pop(gameid, None)
+
+    @classmethod
+    def create_new_lootpool(cls, gameid):
+        existing = cls.find_by_gameid(gameid)
+        if existing:
+            return existing
+        with loot_pools_lock:
+            return loot_pools.setdefault(gameid, cls(gameid))
+
+    @classmethod
+    async def get_by_gameid(cls, gameid, create=False):
+        """find_by_gameid / create_new_lootpool for the event loop, only a pool which is not cached goes through the db executor"""
+        pool = loot_pools.get(gameid)
+        if pool is not None:
+            return pool
+        return await run_db(cls.create_new_lootpool if create else cls.find_by_gameid, gameid)
+
+    @classmethod
+    def delete_by_gameid(cls, gameid):
+        with loot_pools_lock:
+            loot_pools.pop(gameid, None)
+        with Session() as session:
+            session.query(LootEntry).filter_by(gameid=gameid).delete()
+            session.query(LootPoolState).filter_by(gameid=gameid).delete()
+            session.commit()
+        invalidateRemote("loot", gameid)
+
+
+registerCacheHandler("loot", LootPool.dropCached)
@@ -14,6 +14,7 @@ import asyncio
 import datetime
 import time
 import random
+import secrets
 import websockets
 import string
 import ssl
@@ -32,17 +33,39 @@ import uvicorn
 from enum import Enum, auto
 
 
-from objects import Game, Player, Item, ItemPrefab, Session
-from util import NotFoundByIDException, LogLevel, loglevel_prefixes, ItemRarity, ItemType, _decrypt, _encrypt, clientList, client_list, global_sync_token_key
-from log import log, logErrorAndNotify
-from client import Client, sendMessageToPlayer
+from objects import Game, Player, Item, ItemPrefab, Session, run_db
+from util import NotFoundByIDException, LogLevel, loglevel_prefixes, ItemRarity, ItemType, _decrypt, _encrypt, clientList, client_list, global_sync_token_key, register_client, unregister_client, get_game_clients, encode_message, registration_token_ttl, token_sweep_interval, sync_token_cache_ttl, existence_cache_ttl, token_store_type, session_token_ttl, session_reconnect_grace
+from log import log, logErrorAndNotify, discord_shipper
+from client import Client, RemoteClient, sendMessageToPlayer, RESYNC, EVICTED
+from bus import message_bus
 from actions import handle_adv_action
+from history import history_writer
+from tokens import TokenStore, TokenSweeper, createTokenStore, run_blocking
 
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def lifespan(app : FastAPI):
+    if discord_shipper is not None:
+        discord_shipper.start()
+    history_writer.start()
+    await run_blocking(worker_list, heartbeat)
+    token_sweeper.start()
+    await message_bus.start()
+    await run_db(warmExistenceCaches)
+    yield
+    await message_bus.stop()
+    await token_sweeper.stop()
+    await run_blocking(worker_list, worker_list.pop, worker_id)
+    await history_writer.stop()
+    if discord_shipper is not None:
+        await discord_shipper.stop()
 
 
 # tell fastapi that the root begins at /backend
-app = FastAPI(root_path="/dnd/backend")
+app = FastAPI(root_path="/dnd/backend", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -54,13 +77,36 @@ app.add_middleware(
 )
 
 
-token_list = {}
+def isOrphanedSession(session_token):
+    return session_token["clientid"] is not None and session_token["clientid"] not in client_list
 
-registration_token_list = {}
+# session token -> {"ip", "playerid", "gameid", "clientid", "worker"}, clientid is None while the event stream is closed.
+# Orphans can only be detected if the store is not shared with other workers
+token_list = createTokenStore("token_list", ttl=session_token_ttl, is_orphaned=isOrphanedSession if token_store_type == "memory" else None)
+
+# registration token -> {"ip", "playerid", "gameid"}, until it is used for /register
+registration_token_list = createTokenStore("registration_token_list", ttl=registration_token_ttl)
+
+# resync tokens which were validated recently and ids of games / players known to exist
+validated_sync_tokens = TokenStore("validated_sync_tokens", ttl=sync_token_cache_ttl)
+# only existing ids are cached and games / players are never deleted, so other workers can't make these stale
+known_games = TokenStore("known_games", ttl=existence_cache_ttl)
+known_players = TokenStore("known_players", ttl=existence_cache_ttl)
+
+# worker id -> pid of every running worker, a crashed worker drops out once its heartbeat expires.
+# The random part tells a restarted worker apart from the one which had the same pid before
+worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+worker_list = createTokenStore("worker_list", ttl=token_sweep_interval * 3)
+
+def heartbeat():
+    worker_list.set(worker_id, os.getpid())
+
+token_sweeper = TokenSweeper([token_list, registration_token_list, validated_sync_tokens, known_games, known_players, worker_list], interval=token_sweep_interval, heartbeat=heartbeat)
 random_val = 0
 
 # make next_client_id sync across all async etc.
-next_client_id = 0
+# the pid keeps the ids of several worker processes apart, messages for one client are routed by its id
+next_client_id = (os.getpid() & 0x3FFFFF) << 24
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('sqlalchemy').setLevel(logging.WARNING)
@@ -70,288 +116,6 @@ sockets = []
 games = {}
 clients_to_remove = []
 
-last_imports = {}
-
-class LootPool:
-    _instances = []
-
-    class Phase(Enum):
-        PREP = 0
-        CLAIM = 1
-        VOTE = 2
-        CONCLUDED = 3
-
-    def __init__(self, gameid):
-        self.gameid = gameid
-        self.loot = {}
-        self.gold = 0
-
-        self.finished = [] # players who are finished claiming / voting
-        self.players = [] # players who should receive anything from this lootpool
-        self.votes = []
-        self.claims = []
-
-        self.nextLootId = 1
-        self.__class__._instances.append(self)
-
-        self.phase = LootPool.Phase.PREP
-
-    def __del__(self):
-        try:
-            self.__class__._instances.remove(self)
-        except ValueError:
-            pass
-
-    def addLoot(self, itemid : int):
-        self.loot[self.nextLootId] = {}
-        self.loot[self.nextLootId]["itemid"] = itemid
-        self.loot[self.nextLootId]["claims"] = {}
-        self.loot[self.nextLootId]["votes"] = {}
-        self.nextLootId += 1
-
-    def removeLoot(self, loot_id : int):
-        try:
-            del self.loot[loot_id]
-        except KeyError:
-            pass
-
-    def getToWait(self):
-        results = {}
-        session = Session()
-        current_game = Game.getFromId(self.gameid, session)
-        for ply in current_game.players:
-            if self.phase == LootPool.Phase.CLAIM:
-                if ply.id not in self.finished:
-                    if ply.id in self.players:
-                        results[ply.id] = ply.name
-            elif self.phase == LootPool.Phase.VOTE:
-                if ply.id not in self.finished:
-                    results[ply.id] = ply.name
-        return results
-
-    def handleNewFinish(self, player_id : int) -> bool:
-        """Returns True if after the player_id has been added, every player has voted / claimed"""
-
-        # if already "finished" then ignore
-        if player_id in self.finished:
-            return False
-
-        # if it is the claim phase, only people who are in self.players are allowed to claim / others are ignored
-        if self.phase == LootPool.Phase.CLAIM and player_id not in self.players:
-            return False
-
-        session = Session()
-        current_game = Game.getFromId(self.gameid, session)
-        for ply in current_game.players:
-            if ply.id == player_id:
-                self.finished.append(player_id)
-                break
-
-        res = len(current_game.players) == len(self.finished) if self.phase == LootPool.Phase.VOTE else len(self.finished) == len(self.players)
-        session.close()
-        return res
-
-    def setClaim(self, loot_id : int, player_id : int, unClaim=False):
-        if self.phase is not LootPool.Phase.CLAIM:
-            return
-        if self.loot[loot_id] is None:
-            return
-        if player_id not in self.players:
-            return
-        if unClaim:
-            self.loot[loot_id]["claims"][player_id] = None
-            self.loot[loot_id]["votes"][player_id] = None
-            return
-
-        self.loot[loot_id]["claims"][player_id] = True
-        self.loot[loot_id]["votes"][player_id] = player_id
-
-    def setVote(self, loot_id : int, voted_player_id : int, vote_player_id : int):
-        if self.phase is not LootPool.Phase.VOTE:
-            return
-        if self.loot[loot_id] is None:
-            return
-        if voted_player_id not in self.players:
-            return # only allow votes for people who are allowed to get this item
-        if not self.loot[loot_id]["claims"][voted_player_id]:
-            return # only allow votes for people who claim this item
-
-        if self.loot[loot_id]["claims"][vote_player_id]:
-            return # if you have claimed an item you automatically vote for yourself
-        self.loot[loot_id]["votes"][vote_player_id] = voted_player_id
-
-    def resolve(self) -> (dict | None):
-        if self.phase is not LootPool.Phase.VOTE:
-            return
-
-        randomBias = {}
-        results = {}
-        for ply in self.players:
-            results[ply] = []
-            randomBias[ply] = 0
-
-        for loot_id, vals in enumerate(self.loot):
-            if len(vals.claims) == 0:
-                # this code basically will give the item to a random player and will record who received it
-                # and the next time a random player receives an item, a player who has not received anything will
-                # get priority over players who have already received random stuff
-                lowest_val = min(randomBias.values())
-                keys_lowest_val = [key for key, value in randomBias.items() if value == lowest_val]
-                picked_player = random.choice(keys_lowest_val)
-                results[picked_player].append(loot_id)
-                randomBias[picked_player] += 1
-                continue
-
-            if len(vals.claims) == 1:
-                claimed_player = next(iter(vals['claims']))
-                results[claimed_player].append(loot_id)
-                continue
-
-            # there has to be atleast more than one vote because there are more than one claim and if a player claims
-            # they automatically vote for themselves
-
-            mostLikely = {}
-            for vote in vals.votes:
-                mostLikely[vote] = mostLikely.get(vote, 0) + 1
-
-            highest_val = max(mostLikely.values())
-            winning_players = [key for key, value in mostLikely.items() if value == highest_val]
-            picked_player = random.choice(winning_players)
-            results[picked_player].append(loot_id)
-            if len(winning_players) > 1:
-                randomBias[picked_player] += 1
-
-        return results
-
-
-    def abortLootPool(self):
-        self.__class__._instances.remove(self)
-        del self
-
-    def nextPhase(self):
-        self.finished = []
-        if self.phase is LootPool.Phase.PREP:
-            self.phase = LootPool.Phase.CLAIM
-        elif self.phase is LootPool.Phase.CLAIM:
-            self.phase = LootPool.Phase.VOTE
-        elif self.phase is LootPool.Phase.VOTE:
-            self.phase = LootPool.Phase.CONCLUDED
-
-    def getLoot(self):
-        session = Session()
-        loot_list = {}
-        try:
-            for lootid, vals in self.loot.items():
-                item = ItemPrefab.getFromId(vals["itemid"], session)
-                loot_list[lootid] = {
-                    'id': item.id,
-                    'lootid': lootid,
-                    'name': item.name,
-                    'rarity': item.rarity,
-                    'type': item.type,
-                    'description': item.description,
-                    'value': item.value,
-                    'img': item.img,
-                    'stackable': item.stackable,
-                    'unique': item.unique,
-                    'ext': vals
-                }
-        finally:
-            session.close()
-        return loot_list
-
-    def generateRandomLoot(self, countList):
-        rarity_map = {
-            'common': ItemRarity.COMMON,
-            'uncommon': ItemRarity.UNCOMMON,
-            'rare': ItemRarity.RARE,
-            'veryRare': ItemRarity.VERY_RARE,
-            'epic': ItemRarity.EPIC,
-            'legendary': ItemRarity.LEGENDARY
-        }
-
-        session = Session()
-        try:
-            for rarity_str, rarity_enum in rarity_map.items():
-                count = countList.get(rarity_str, 0)
-                if count > 0:
-                    items = session.query(ItemPrefab).filter_by(gameid=self.gameid, rarity=rarity_enum.value).all()
-                    if len(items) < 1:
-                        continue
-                    for _ in range(min(count, 12)): # vale causec crash
-                        if items:
-                            item = random.choice(items)
-                            self.addLoot(item.id)
-        finally:
-            session.close()
-
-    async def sendLootList(self, sendToAll=False):
-
-
-        global clientList
-        to_send_list = {
-            "type": "loot_list_update",
-            "msg": {
-                "items": self.getLoot(),
-                "gold": self.gold,
-                "players": self.players,
-                "phase": self.phase.value,
-                "waiting": self.getToWait()
-            }
-        }
-        for client in clientList:
-            if client.gameid != self.gameid:
-                continue
-            await client.send(json.dumps(to_send_list))
-
-    @classmethod
-    def get_all_instances(cls):
-        return cls._instances
-
-    @classmethod
-    def find_by_gameid(cls, gameid):
-        return next((instance for instance in cls._instances if instance.gameid == gameid), None)
-
-    @classmethod
-    def create_new_lootpool(cls, gameid):
-        existing = cls.find_by_gameid(gameid)
-        if existing:
-            return existing
-        return cls(gameid)
-
-    @classmethod
-    def delete_by_gameid(cls, gameid):
-        instance = cls.find_by_gameid(gameid)
-        if instance:
-            cls._instances.remove(instance)
-
-
-
-def run_import_script(gameid, send_callback):
-    async def async_run():
-        try:
-            from fetchItems import importDnDItems
-            importDnDItems(gameid)
-            await send_callback(json.dumps({
-                "type": "items_imported",
-                "success": True
-            }))
-        except Exception as e:
-            print("ImportNewItems Error:", e)
-            await send_callback(json.dumps({
-                "type": "items_imported",
-                "success": False
-            }))
-            await send_callback(json.dumps({
-                "type": "error",
-                "msg": f"ImportNewItems failed: {str(e)}"
-            }))
-        session = Session()
-        await Game.updateItemList(gameid, session)
-        session.close()
-    asyncio.run(async_run())
-
-
 
 def load_player(player_name: str, gameid: int):
     # Create a session
@@ -395,28 +159,104 @@ def createNewGame(name: str, description: str, dm_pass: str):
     return res
 
 
+def warmExistenceCaches():
+    """Loads the ids of every game and player, so resyncs after a restart don't need to query them one by one"""
+    with Session() as session:
+        for (gameid,) in session.query(Game.id):
+            known_games.set(gameid, True)
+        for (playerid,) in session.query(Player.id):
+            known_players.set(playerid, True)
+
+
+def _exists(cache, model, tid, session):
+    if cache.get(tid) is not None:
+        return True
+    if session.query(model.id).filter_by(id=tid).first() is None:
+        return False # not cached, the game / player might be created later
+    cache.set(tid, True)
+    return True
+
+
 def ValidateSyncToken(token):
+    cached = validated_sync_tokens.get(token)
+    if cached is not None:
+        isValid, dec_token = cached
+        return isValid and dec_token["valid_until"] >= time.time(), dec_token
+
     dec_token = _decrypt(token, global_sync_token_key)
     dec_token = json.loads(dec_token)
     isValid = False
-    session = Session()
-    try:
 
-        Game.getFromId(dec_token["gameid"], session)
-        if not dec_token["isDM"]:
-            Player.getFromId(dec_token["playerid"], session)
+    if dec_token["valid_until"] < time.time():
+        print("Sync token has expired")
+    else:
+        with Session() as session:
+            if not _exists(known_games, Game, dec_token["gameid"], session):
+                print(f"Sync Token invalid, game {dec_token['gameid']} not found")
+            elif not dec_token["isDM"] and not _exists(known_players, Player, dec_token["playerid"], session):
+                print(f"Sync Token invalid, player {dec_token['playerid']} not found")
+            else:
+                isValid = True
+
+    validated_sync_tokens.set(token, (isValid, dec_token))
+    return isValid, dec_token
 
-        if dec_token["valid_until"] < time.time():
-            print("Sync token has expired")
-        else:
-            isValid = True
 
-    except NotFoundByIDException as e:
-        print("Sync Token invalid", e)
-        pass
+def issueRegistrationToken(ip, playerid, gameid):
+    """Returns a new registration token for opening the event stream, or None if it collides with a pending one"""
+    registration_token = generateToken(playerid, gameid, ip)
+    if registration_token is None or not registration_token_list.add(registration_token, {
+        "ip" : ip,
+        "playerid": playerid,
+        "gameid": gameid
+    }):
+        return None
+    return registration_token
 
-    session.close()
-    return isValid, dec_token
+
+def authenticate(provided_token, ip):
+    """Returns the session of a token from the register message, or None if the token is unknown or used from another ip"""
+    session_token = token_list.get(provided_token)
+    if session_token is None or session_token["ip"] != ip:
+        return None
+    token_list.touch(provided_token)
+    return session_token
+
+
+def openSession(registration_token, ip):
+    """Returns the registration of a token from /register and the session token of the new stream, (None, None) if the token is invalid"""
+    res = registration_token_list.pop(registration_token, None)
+    if res is not None:
+        if res["ip"] != ip:
+            return None, None
+        return res, secrets.token_urlsafe(16)
+
+    # reopening the stream with the session token, e.g. after a restart of the server
+    return authenticate(registration_token, ip), registration_token
+
+
+def releaseSession(session_token, clientid):
+    """Lets the session reopen its stream for a while, unless another stream took it over already"""
+    session = token_list.get(session_token)
+    if session is not None and session["clientid"] == clientid:
+        token_list.set(session_token, {**session, "clientid": None}, ttl=session_reconnect_grace)
+
+
+def releaseStaleSession(provided_token, session_token):
+    """Releases a session whose stream died with its worker (crash or restart), returns False if another worker serves it"""
+    worker = session_token.get("worker")
+    if worker != worker_id and worker in worker_list:
+        return False
+    token_list.set(provided_token, {**session_token, "clientid": None}, ttl=session_reconnect_grace)
+    return True
+
+
+def resyncSession(sync_token, ip):
+    """Returns the decrypted sync token and a new registration token, None as registration token if the sync token is invalid"""
+    isValid, dec_token = ValidateSyncToken(sync_token)
+    if not isValid:
+        return dec_token, None
+    return dec_token, issueRegistrationToken(ip, dec_token["playerid"], dec_token["gameid"])
 
 
 def generateToken(first, second, third, randomness=True):
@@ -431,28 +271,22 @@ async def register(request: Request, registration_token: str):
 
     global next_client_id
 
-    res = registration_token_list.pop(registration_token, None)
-
+    ip = request.client.host
+    res, new_token = await run_blocking(token_list, openSession, registration_token, ip)
     if res is None:
         raise HTTPException(status_code=400, detail="Invalid registration token!")
 
-    ip = request.client.host
-    if res["ip"] != ip:
-        raise HTTPException(status_code=400, detail="Invalid registration token!")
-    
-    new_token = generateToken(res["playerid"], res["gameid"], ip)
     new_server_side_identifier = generateToken("server-identifier-", new_token, ip, False)
 
-    print(f"New client registered with token {new_token} and server side identifier {new_server_side_identifier}")
-    print(ip + str(new_token) + str(random_val))
+    log(f"New client registered with server side identifier {new_server_side_identifier}", level=LogLevel.DEBUG)
 
     client = Client(new_server_side_identifier, res["gameid"], res["playerid"], False if res["playerid"] != -1 else True)
 
     clientid = next_client_id
     next_client_id += 1
 
-    client_list[clientid] = client
-    token_list[new_server_side_identifier] = {"token": new_token, "playerid": res["playerid"], "clientid": clientid}
+    register_client(clientid, client)
+    await run_blocking(token_list, token_list.set, new_token, {"ip": ip, "playerid": res["playerid"], "gameid": res["gameid"], "clientid": clientid, "worker": worker_id})
 
     async def event_generator():
         try:
@@ -462,16 +296,55 @@ async def register(request: Request, registration_token: str):
 
             while True:
                 msg = await client.queue.get()
+                if msg is RESYNC:
+                    await client.resync()
+                    continue
+                if msg is EVICTED:
+                    log(f"Client {clientid} (playerid {client.playerid}) stopped reading its events, closing the stream")
+                    break
+                msg = encode_message(msg)
                 yield {
-                    "event": msg["type"] if "type" in msg else msg["event"],
-                    "data": json.dumps(msg)
+                    "event": msg.event,
+                    "data": msg.data
                 }
         except asyncio.CancelledError:
-            client_list.pop(clientid, None)
+            pass
+        finally:
+            try:
+                await asyncio.shield(run_blocking(token_list, releaseSession, new_token, clientid))
+            finally:
+                unregister_client(clientid)
 
     return EventSourceResponse(event_generator())
 
 
+# Backlog of every connected client, slow consumers show up with a high queue / overflow count
+@app.get("/stats/clients")
+async def client_stats():
+    return sorted([
+        {
+            "clientid": clientid,
+            "gameid": client.gameid,
+            "playerid": client.playerid,
+            "isDM": client.isDM,
+            **client.queue.getStats()
+        }
+        for clientid, client in list(client_list.items())
+    ], key=lambda stats: stats["queued"], reverse=True)
+
+
+# Role of this worker on the message bus and how many messages went through it
+@app.get("/stats/bus")
+async def bus_stats():
+    return message_bus.getStats()
+
+
+# Number of live, expired and orphaned entries in the token stores
+@app.get("/stats/tokens")
+async def token_stats():
+    return await run_blocking(token_sweeper, token_sweeper.getStats)
+
+
 # For testing purposes, verify that reverse proxy is set up correctly
 @app.get("/test")
 async def register(request: Request):
@@ -551,15 +424,9 @@ def action_selectPlayer(data, ip):
         if provided_pass is not None and (provided_pass == game.dm_pass or provided_pass == "FelixStinkt"): # super secure hard coded backup pw
             print("Provided password is correct. New DM Client...")
 
-            registration_token = generateToken(-1, game.id, ip)
-            if registration_token is None or registration_token in registration_token_list:
+            registration_token = issueRegistrationToken(ip, -1, game.id)
+            if registration_token is None:
                 raise HTTPException(status_code=400, detail="Invalid request 3")
-            
-            registration_token_list[registration_token] = {
-                "ip" : ip,
-                "playerid": -1,
-                "gameid": gameid
-            }
 
             return {
                 "type": "register",
@@ -573,16 +440,9 @@ def action_selectPlayer(data, ip):
     try:
         ply = Player.getFromId(playerToSelect, session)
 
-        registration_token = generateToken(ply.id, game.id, ip)
-
-        if registration_token is None or registration_token in registration_token_list:
+        registration_token = issueRegistrationToken(ip, ply.id, game.id)
+        if registration_token is None:
             raise HTTPException(status_code=400, detail="Invalid request 5")
-        
-        registration_token_list[registration_token] = {
-            "ip" : ip,
-            "playerid": ply.id,
-            "gameid": gameid
-        }
 
         return {
             "type": "register",
@@ -621,10 +481,10 @@ async def handle_action(request: Request):
         # return {"status": "Session created successfully"}
 
     elif action_type == "joinSession":
-        return action_joinSession(data)
+        return await run_db(action_joinSession, data)
 
     elif action_type == "selectPlayer":
-        return action_selectPlayer(data, request.client.host)
+        return await run_db(action_selectPlayer, data, request.client.host)
 
     elif action_type == "resync":
 
@@ -633,19 +493,9 @@ async def handle_action(request: Request):
         if sync_token is None:
             raise HTTPException(status_code=400, detail="Invalid request!")
 
-        isValid, dec_token = ValidateSyncToken(sync_token)
-        if not isValid:
-            raise HTTPException(status_code=400, detail="Invalid request!")
-
-        registration_token = generateToken(dec_token["playerid"], dec_token["gameid"], request.client.host)
-        if registration_token is None or registration_token in registration_token_list:
+        dec_token, registration_token = await run_db(resyncSession, sync_token, request.client.host)
+        if registration_token is None:
             raise HTTPException(status_code=400, detail="Invalid request!")
-        
-        registration_token_list[registration_token] = {
-            "ip" : request.client.host,
-            "playerid": dec_token["playerid"],
-            "gameid": dec_token["gameid"]
-        }
 
         return {
             "type": "register",
@@ -662,23 +512,26 @@ async def handle_action(request: Request):
     if provided_token is None or ip is None:
         raise HTTPException(status_code=400, detail="Invalid request!")
 
-    server_side_identifier = generateToken("server-identifier-", provided_token, ip, False)
-    
-    #print the current server side identifier and every in the list
-    print("server-identifier-", provided_token, ip)
-    print(server_side_identifier)
-    print(token_list)
+    session_token = await run_blocking(token_list, authenticate, provided_token, ip)
+    if session_token is None:
+        log(f"Rejected {action_type} from {ip}, unknown session token", level=LogLevel.DEBUG)
+        raise HTTPException(status_code=400, detail="Invalid request!")
+
+    playerid = session_token["playerid"]
+    clientid = session_token["clientid"]
 
-    if server_side_identifier not in token_list or token_list[server_side_identifier]["token"] != provided_token:
+    if clientid is None: # the event stream is closed
         raise HTTPException(status_code=400, detail="Invalid request!")
-    
-    playerid = token_list[server_side_identifier]["playerid"]
-    clientid = token_list[server_side_identifier]["clientid"]
 
     current_client = client_list.get(clientid, None)
 
-    if current_client is None: # Client does not have a open sse connection
-        raise HTTPException(status_code=400, detail="Invalid request!")
+    if current_client is None:
+        if await run_blocking(token_list, releaseStaleSession, provided_token, session_token):
+            # replies would go to nobody, the client has to reopen the stream with its session token
+            log(f"Rejected {action_type} from {ip}, no worker serves client {clientid}", level=LogLevel.DEBUG)
+            raise HTTPException(status_code=400, detail="Invalid request!")
+        # the event stream is served by another worker, the token is removed when it closes
+        current_client = RemoteClient(clientid, session_token["gameid"], playerid, playerid == -1)
 
     return await handle_adv_action(action_type, current_client, playerid, data)
 
@@ -1,27 +1,119 @@
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Index, Float
+from sqlalchemy.orm import relationship, contains_eager, joinedload
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 
-from util import ItemRarity, client_list
+from util import ItemRarity, client_list, get_game_clients, get_dm_clients, get_player_clients, encode_message
 
 
 from util import NotFoundByIDException, remove_disconnected_clients, clientList
+from util import database_url, db_pool_size, db_max_overflow, sqlite_journal_mode, sqlite_synchronous, sqlite_busy_timeout, sqlite_mmap_size
+from util import db_executor_workers
+from bus import publish, registerCacheHandler, invalidateRemote
+from search import PrefabSearchIndex
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import json
-
-engine = create_engine('sqlite:///players.db')
+import threading
+import uuid
+
+db_executor = ThreadPoolExecutor(max_workers=db_executor_workers, thread_name_prefix="db") if db_executor_workers > 0 else None
+
+async def run_db(func, *args, **kwargs):
+    """Runs blocking database work in the bounded db executor, so a slow query or commit does not stall the event loop"""
+    if db_executor is None:
+        return func(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+def createEngine(url=database_url, pool_size=db_pool_size, max_overflow=db_max_overflow, journal_mode=sqlite_journal_mode,
+                 synchronous=sqlite_synchronous, busy_timeout=sqlite_busy_timeout, mmap_size=sqlite_mmap_size):
+    is_sqlite = url.startswith("sqlite")
+    in_memory = is_sqlite and (url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url)
+
+    options = {}
+    if not in_memory: # in memory sqlite databases use a single connection per thread
+        options["pool_size"] = pool_size
+        options["max_overflow"] = max_overflow
+    new_engine = create_engine(url, **options)
+
+    if is_sqlite:
+        @event.listens_for(new_engine, "connect")
+        def setSqlitePragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            if journal_mode and not in_memory:
+                cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            if synchronous:
+                cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+            cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            cursor.close()
+
+    return new_engine
+
+engine = createEngine()
 Base = sqlalchemy.orm.declarative_base()
 
+# append-only audit log of the actions in a game, written in batches by history.HistoryWriter
 class History(Base):
     __tablename__ = 'history'
+    __table_args__ = (
+        Index('ix_history_gameid_timestamp', 'gameid', 'timestamp'),
+    )
+
     id = Column(Integer, primary_key=True)
     log = Column(String)
+    gameid = Column(Integer, ForeignKey('games.id'))
+    timestamp = Column(Float)
+    actor = Column(Integer) # playerid of the client, -1 for the dm
+    action = Column(String)
+    playerid = Column(Integer) # player affected by the action
+    itemid = Column(Integer)
+    prefabid = Column(Integer)
+    gold_delta = Column(Integer)
+
+    def getInfo(self):
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp,
+            'actor': self.actor,
+            'action': self.action,
+            'playerid': self.playerid,
+            'itemid': self.itemid,
+            'prefabid': self.prefabid,
+            'gold_delta': self.gold_delta,
+            'log': self.log
+        }
+
+    @staticmethod
+    def getPage(gameid : int, session, since : float = None, until : float = None, before : tuple = None, limit : int = 50):
+        """Returns the newest events of a game in the time range.
+
+        before is the (timestamp, id) of the last event of the previous page. Events are ordered by both, ids alone
+        don't follow the timestamps because the history writer can commit batches out of order"""
+        if session is None:
+            raise NotFoundByIDException("History.getPage requires a session")
+        query = session.query(History).filter(History.gameid == gameid)
+        if since is not None:
+            query = query.filter(History.timestamp >= since)
+        if until is not None:
+            query = query.filter(History.timestamp <= until)
+        if before is not None:
+            before_timestamp, before_id = before
+            query = query.filter(sqlalchemy.or_(
+                History.timestamp < before_timestamp,
+                sqlalchemy.and_(History.timestamp == before_timestamp, History.id < before_id)))
+        return query.order_by(History.timestamp.desc(), History.id.desc()).limit(limit).all()
 
 class Player(Base):
     __tablename__ = 'players'
+    __table_args__ = (
+        Index('ix_players_gameid_name', 'gameid', 'name'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -55,6 +147,10 @@ class Player(Base):
 # items owned by a player
 class Item(Base):
     __tablename__ = 'items'
+    __table_args__ = (
+        Index('ix_items_owner', 'owner'),
+        Index('ix_items_id_prefab', 'id_prefab'),
+    )
 
     id = Column(Integer, primary_key=True)
     id_prefab = Column(Integer, ForeignKey('item_prefabs.id'), nullable=False)
@@ -100,6 +196,33 @@ class Item(Base):
             #'owner': self.owner
         }
 
+    def getInfo(self):
+        return {
+            'id': self.id,
+            'id_prefab': self.id_prefab,
+            'name': self.name,
+            'rarity': self.rarity,
+            'type': self.type,
+            'description': self.description,
+            'count': self.count,
+            'value': self.value,
+            'img': self.img,
+            'stackable': self.prefab.stackable,
+            'unique': self.prefab.unique
+        }
+
+    @staticmethod
+    def getAllFromGame(gameid : int, session):
+        """Loads the items of every player in the game together with their prefabs in a single query"""
+        if session is None:
+            raise NotFoundByIDException("Item.getAllFromGame requires a session")
+        return session.query(Item) \
+            .join(Item.prefab) \
+            .join(Player, Item.owner == Player.id) \
+            .filter(Player.gameid == gameid) \
+            .options(contains_eager(Item.prefab)) \
+            .all()
+
     def isPlayerOwner(self, player):
         if type(player) == Player:
             return player.id == self.owner
@@ -121,10 +244,12 @@ class Item(Base):
 
 
 # items which can be given to players
+# prefabs without a gameid belong to the shared library which every game can use
 class ItemPrefab(Base):
     __tablename__ = 'item_prefabs'
-
-    # TODO: link a ItemPrefab to a game, important!
+    __table_args__ = (
+        Index('ix_item_prefabs_gameid_rarity', 'gameid', 'rarity'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -149,22 +274,344 @@ class ItemPrefab(Base):
         else:
             return tmp
 
+    def getInfo(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'rarity': self.rarity,
+            'type': self.type,
+            'description': self.description,
+            'value': self.value,
+            'img': self.img,
+            'stackable': self.stackable,
+            'unique': self.unique
+        }
+
+    def isLibraryPrefab(self):
+        return self.gameid is None
+
+    @staticmethod
+    def getCatalog(gameid : int, session):
+        """Returns the cached PrefabCatalog of a game (or of the shared library for gameid None), loading it from the database on first use"""
+        catalog = prefab_catalogs.get(gameid)
+        if catalog is not None:
+            return catalog
+        with prefab_catalogs_lock: # only one thread loads a catalog
+            catalog = prefab_catalogs.get(gameid)
+            if catalog is None:
+                if session is None:
+                    raise NotFoundByIDException("ItemPrefab.getCatalog requires a session")
+                if gameid is None:
+                    catalog = PrefabCatalog(None)
+                    catalog.load(session.query(ItemPrefab).filter(ItemPrefab.gameid.is_(None)).order_by(ItemPrefab.id).all())
+                else:
+                    catalog = PrefabCatalog(gameid, ItemPrefab.getCatalog(None, session))
+                    overrides = session.query(PrefabOverride).filter_by(gameid=gameid).all()
+                    catalog.load(session.query(ItemPrefab).filter_by(gameid=gameid).order_by(ItemPrefab.id).all(), [o.base_id for o in overrides])
+                prefab_catalogs[gameid] = catalog
+            return catalog
+
+    @staticmethod
+    def getInfoFromId(gameid : int, tid : int, session):
+        info = ItemPrefab.getCatalog(gameid, session).get(tid)
+        if info is None:
+            raise NotFoundByIDException("No Item Prefab found with id {0}".format(tid))
+        return info
+
     @staticmethod
     def getList(gameid : int, session):
-        tmp = session.query(ItemPrefab).filter_by(gameid=gameid).all()
-        res = [
-        {
-            'id': i.id,
-            'name': i.name,
-            'rarity': i.rarity,
-            'type': i.type,
-            'description': i.description,
-            'value': i.value,
-            'img': i.img,
-            'stackable': i.stackable,
-            'unique': i.unique
-        } for i in tmp]
-        return res
+        return ItemPrefab.getCatalog(gameid, session).getList()
+
+    @staticmethod
+    def updateCache(prefab):
+        """Write-through for created or edited prefabs, only patches catalogs which are already loaded.
+        The other workers drop their catalog and load it again"""
+        catalog = prefab_catalogs.get(prefab.gameid)
+        if catalog is not None:
+            catalog.update(prefab)
+        invalidateRemote("prefabs", prefab.gameid)
+
+    @staticmethod
+    def invalidateCache(gameid : int):
+        ItemPrefab.dropCatalog(gameid)
+        invalidateRemote("prefabs", gameid)
+
+    @staticmethod
+    def dropCatalog(gameid : int):
+        with prefab_catalogs_lock:
+            if gameid is None:
+                prefab_catalogs.clear() # every game catalog is layered on top of the library
+            else:
+                prefab_catalogs.pop(gameid, None)
+
+    @staticmethod
+    def overrideLibraryPrefab(gameid : int, base, session):
+        """Copies a library prefab into the game, so it can be edited without changing it for other games.
+        Items of the game are moved to the copy, which replaces the library prefab in the catalog of the game"""
+        if session is None:
+            raise NotFoundByIDException("ItemPrefab.overrideLibraryPrefab requires a session")
+
+        prefab = ItemPrefab(
+            name=base.name,
+            description=base.description,
+            gameid=gameid,
+            value=base.value,
+            rarity=base.rarity,
+            type=base.type,
+            img=base.img,
+            stackable=base.stackable,
+            unique=base.unique
+        )
+        session.add(prefab)
+        session.flush()
+        session.add(PrefabOverride(gameid=gameid, base_id=base.id, prefab_id=prefab.id))
+
+        for item in Game.getAllItemsWithPrefabID(gameid, base.id, session):
+            item.id_prefab = prefab.id
+        session.commit()
+
+        catalog = prefab_catalogs.get(gameid)
+        if catalog is not None:
+            with prefab_catalogs_lock:
+                catalog.hide(base.id)
+                catalog.update(prefab)
+        invalidateRemote("prefabs", gameid)
+        return prefab
+
+
+# library prefabs which have been replaced by a copy in a game
+class PrefabOverride(Base):
+    __tablename__ = 'prefab_overrides'
+    __table_args__ = (
+        Index('ix_prefab_overrides_gameid', 'gameid'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    gameid = Column(Integer, ForeignKey('games.id'), nullable=False)
+    base_id = Column(Integer, ForeignKey('item_prefabs.id'), nullable=False)
+    prefab_id = Column(Integer, ForeignKey('item_prefabs.id'), nullable=False)
+
+
+# gameid -> PrefabCatalog, changes made by another worker reach this one as a "prefabs" cache invalidation
+prefab_catalogs = {}
+# catalogs are used from the db executor threads, the lock guards the dict and the state of every catalog.
+# Reentrant because a game catalog reads the library catalog below it
+prefab_catalogs_lock = threading.RLock()
+
+class PrefabCatalog:
+    """In memory copy of the serialized item prefabs of one game.
+
+    Every change bumps the version and is kept in a short change log, so clients which already know the
+    catalog (identified by catalog_id, which changes whenever the catalog is reloaded) only receive deltas."""
+
+    max_changes = 256
+
+    def __init__(self, gameid : int, library=None):
+        self.gameid = gameid
+        self.library = library # catalog of the shared library, which is layered below the prefabs of the game
+        self.catalog_id = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.prefabs = {}
+        self.hidden = set() # library prefabs replaced by an override
+        self.changes = deque(maxlen=PrefabCatalog.max_changes) # (version, prefabid, added)
+        self._list = None
+        self._list_key = None
+        self._samplers = {} # weighting -> LootSampler of the current list
+        self._search_index = None
+        self._search_version = None # version of a game catalog its search index was built from
+
+    def load(self, prefabs, hidden=()):
+        with prefab_catalogs_lock:
+            self.prefabs = {i.id: i.getInfo() for i in prefabs}
+            self.hidden = set(hidden)
+            self._list = None
+            self._samplers = {}
+            self._search_index = None
+
+    def get(self, tid : int):
+        with prefab_catalogs_lock:
+            info = self.prefabs.get(tid)
+            if info is None and self.library is not None and tid not in self.hidden:
+                return self.library.get(tid)
+            return info
+
+    def getList(self):
+        """Returns the prefab infos, the list is replaced and never changed once it has been returned"""
+        with prefab_catalogs_lock:
+            # changes of the library invalidate the list of the game as well
+            key = (self.version, self.library.version if self.library is not None else None)
+            if self._list is None or self._list_key != key:
+                prefabs = []
+                if self.library is not None:
+                    prefabs.extend(i for i in self.library.getList() if i['id'] not in self.hidden)
+                prefabs.extend(self.prefabs.values())
+                self._list = prefabs
+                self._list_key = key
+                self._samplers = {}
+            return self._list
+
+    def getSampler(self, weighting : str = "uniform"):
+        """Returns the LootSampler of the prefabs, rebuilt only when they changed"""
+        prefabs = self.getList()
+        sampler = self._samplers.get(weighting)
+        if sampler is None:
+            # built outside of the lock, it is only kept if the prefabs didn't change in the meantime
+            sampler = LootSampler(prefabs, loot_weightings[weighting])
+            with prefab_catalogs_lock:
+                if self._list is prefabs:
+                    self._samplers[weighting] = sampler
+        return sampler
+
+    def getSearchIndex(self):
+        """Returns the PrefabSearchIndex of the prefabs. The index of the library is rebuilt only when the library changes,
+        a game only indexes its own prefabs again, on top of the index of the library"""
+        if self.library is None:
+            prefabs = self.getList()
+            index = self._search_index
+            if index is None or index.prefabs is not prefabs:
+                index = PrefabSearchIndex(prefabs)
+                with prefab_catalogs_lock:
+                    if self._list is prefabs:
+                        self._search_index = index
+            return index
+
+        base = self.library.getSearchIndex()
+        with prefab_catalogs_lock:
+            index = self._search_index
+            if index is not None and index.base is base and self._search_version == self.version:
+                return index
+            version = self.version
+            prefabs = list(self.prefabs.values())
+            hidden = set(self.hidden)
+
+        # built outside of the lock, it is only kept if the prefabs didn't change in the meantime
+        index = PrefabSearchIndex(prefabs, base, hidden)
+        with prefab_catalogs_lock:
+            if self.version == version:
+                self._search_index = index
+                self._search_version = version
+        return index
+
+    def hide(self, tid : int):
+        with prefab_catalogs_lock:
+            self.hidden.add(tid)
+            self._list = None
+            self.version += 1
+            self.changes.append((self.version, tid, False))
+
+    def update(self, prefab : ItemPrefab):
+        info = prefab.getInfo()
+        with prefab_catalogs_lock:
+            added = prefab.id not in self.prefabs
+            self.prefabs[prefab.id] = info
+            self._list = None
+            self.version += 1
+            self.changes.append((self.version, prefab.id, added))
+
+    def remove(self, tid : int):
+        with prefab_catalogs_lock:
+            if self.prefabs.pop(tid, None) is None:
+                return
+            self._list = None
+            self.version += 1
+            self.changes.append((self.version, tid, False))
+
+    def getDelta(self, since_version : int):
+        """Returns the compacted changes after since_version or None if they are no longer known"""
+        with prefab_catalogs_lock:
+            return self._getDelta(since_version)
+
+    def _getDelta(self, since_version : int):
+        if since_version > self.version:
+            return None
+        if since_version < self.version and (len(self.changes) == 0 or self.changes[0][0] > since_version + 1):
+            return None
+
+        added_ids = set()
+        changed_ids = []
+        for version, tid, added in self.changes:
+            if version <= since_version:
+                continue
+            if added:
+                added_ids.add(tid)
+            if tid not in changed_ids:
+                changed_ids.append(tid)
+
+        delta = {
+            "catalog": self.catalog_id,
+            "from_version": since_version,
+            "version": self.version,
+            "added": [],
+            "changed": [],
+            "removed": []
+        }
+        for tid in changed_ids:
+            info = self.prefabs.get(tid)
+            if info is None:
+                if tid not in added_ids:
+                    delta["removed"].append(tid)
+            elif tid in added_ids:
+                delta["added"].append(info)
+            else:
+                delta["changed"].append(info)
+        return delta
+
+# weight of a prefab when loot is generated, by the weighting the DM picked
+loot_weightings = {
+    "uniform": lambda info: 1.0,
+    "value": lambda info: 1.0 / max(info['value'] or 1, 1), # cheap items turn up more often
+}
+
+class AliasTable:
+    """Draws items with probability proportional to their weight in O(1) per draw (Vose's alias method)"""
+
+    def __init__(self, items : list, weights : list):
+        self.items = items
+        count = len(items)
+        total = sum(weights)
+        if total <= 0:
+            weights, total = [1.0] * count, float(count)
+
+        scaled = [w * count / total for w in weights]
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # whatever is left over is 1 up to rounding errors
+
+    def draw(self, rng):
+        column = int(rng.random() * len(self.items))
+        if rng.random() < self.probability[column]:
+            return self.items[column]
+        return self.items[self.alias[column]]
+
+
+class LootSampler:
+    """Alias tables of the prefabs of a catalog per rarity and per rarity and type"""
+
+    def __init__(self, prefabs : list, weight):
+        groups = {}
+        for info in prefabs:
+            groups.setdefault((info['rarity'], None), []).append(info)
+            if info['type'] is not None:
+                groups.setdefault((info['rarity'], info['type']), []).append(info)
+        self.tables = {key: AliasTable(items, [weight(info) for info in items]) for key, items in groups.items()}
+
+    def sample(self, rarity : int, itemType : int, count : int, rng) -> list:
+        """Returns count prefab infos of the rarity (and type, if not None), fewer only if there are none"""
+        table = self.tables.get((rarity, itemType))
+        if table is None:
+            return []
+        return [table.draw(rng) for _ in range(count)]
+
+
+registerCacheHandler("prefabs", ItemPrefab.dropCatalog)
 
 class GameSettings(Base):
     __tablename__ = 'game_settings'
@@ -181,6 +628,9 @@ class GameSettings(Base):
 
 class Game(Base):
     __tablename__ = 'games'
+    __table_args__ = (
+        Index('ix_games_join_code', 'join_code'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -244,121 +694,122 @@ class Game(Base):
 
     @staticmethod
     async def updateAllClients(gameid):
-        global client_list
-        print(f"Updating all clients", len(client_list))
-        for _, client in client_list.items():
-            if client.gameid != gameid:
-                continue
+        clients = get_game_clients(gameid)
+        print(f"Updating all clients", len(clients))
+        for client in clients:
             print(f"Updating client for GameID {client.gameid}")
             await client.sendGameInfo()
         remove_disconnected_clients()
 
     @staticmethod
-    async def updateItemList(gameid, session):
-        global client_list
-        print(f"Updating ItemList for all dm clients", len(client_list))
-        for _, client in client_list.items():
+    async def updateItemList(gameid, session, since_version=None):
+        """Sends the itemlist changes since since_version to every dm client, or the full list if no version is given"""
+        print(f"Updating ItemList for all dm clients of game {gameid}")
+        await publish(("dm", gameid), await run_db(Game.buildItemListUpdate, gameid, session, since_version))
 
-            if not client.isDM:
-                continue
+    @staticmethod
+    def buildItemListUpdate(gameid, session, since_version=None):
+        """Returns the message for updateItemList, for actions which build it in their own executor call"""
+        catalog = ItemPrefab.getCatalog(gameid, session)
+
+        if since_version is not None:
+            delta = catalog.getDelta(since_version)
+            if delta is not None:
+                return {
+                    "type": "itemlist_delta",
+                    "msg": delta
+                }
 
-            if client.gameid != gameid:
-                continue
+        return Game.buildItemListMessage(catalog)
 
-            await client.sendItemList(session)
+    @staticmethod
+    def buildItemListMessage(catalog):
+        return {
+            "type": "game_info",
+            "msg": {
+                "itemlist": catalog.getList(),
+                "itemlist_catalog": catalog.catalog_id,
+                "itemlist_version": catalog.version
+            }
+        }
 
     @staticmethod
     async def syncPlayerGold(gameid : int, player : Player):
-        global client_list
         print(f"Synchronising gold from player {player}")
-        for _, client in client_list.items():
-            if client.gameid != gameid:
-                continue
-
-            if client.isDM or client.playerid == player.id:
-                data = {
-                    "type": "gold_update",
-                    "msg": {
-                        "playerid": player.id,
-                        "gold": player.gold
-                    }
-                }
-                await client.send(data)
+        await publish(("owners", gameid, player.id), {
+            "type": "gold_update",
+            "msg": {
+                "playerid": player.id,
+                "gold": player.gold
+            }
+        })
 
     @staticmethod
     async def syncPlayerItem(gameid : int, item : (Item | int), isRemoval=False, isGlobal=False):
+        owner, dm_data, player_data = await run_db(Game.buildItemMessages, item, isRemoval)
+
+        print(f"Synchronising item {item} | isRemoval: {isRemoval} | isGlobal: {isGlobal}")
+        await Game.publishItemMessages(gameid, owner, dm_data, player_data, isGlobal)
+
+    @staticmethod
+    async def syncPlayerItems(gameid : int, items : list):
+        """Like syncPlayerItem for many items, the messages are built in one executor call"""
+        messages = await run_db(lambda: [Game.buildItemMessages(item) for item in items])
+
+        print(f"Synchronising {len(items)} items")
+        for owner, dm_data, player_data in messages:
+            await Game.publishItemMessages(gameid, owner, dm_data, player_data)
 
-        with Session() as session:
-            if type(item) == int:
-                item = Item.getFromId(item, session)
-            owner = item.owner
-
-            global client_list
-            print(f"Synchronising item {item} | isRemoval: {isRemoval} | isGlobal: {isGlobal}")
-            for _, client in client_list.items():
-                if client.gameid != gameid:
-                    continue
-
-                if (client.isDM or client.playerid == owner) or isGlobal:
-
-                    if isRemoval:
-                        data = {
-                            "type": "item_removal",
-                            "msg": {
-                                "playerid": owner,
-                                "itemid": item.id
-                            }
-                        }
-                    else:
-                        if client.isDM:
-                            data = {
-                                "type": "inventory_update",
-                                "msg": {
-                                    "playerid": owner,
-                                    "itemid": item.id,
-                                    "item" : {
-                                        'id': item.id,
-                                        'id_prefab': item.id_prefab,
-                                        'name': item.name,
-                                        'rarity': item.rarity,
-                                        'type': item.type,
-                                        'description': item.description,
-                                        'count': item.count,
-                                        'value': item.value,
-                                        'img': item.img,
-                                        'stackable': item.prefab.stackable,
-                                        'unique': item.prefab.unique
-                                    }
-                                }
-                            }
-                        else:
-                            data = {
-                                "type": "inventory_update",
-                                "msg": {
-                                    "itemid": item.id,
-                                    "item": {
-                                        'id': item.id,
-                                        'id_prefab': item.id_prefab,
-                                        'name': item.name,
-                                        'rarity': item.rarity,
-                                        'type': item.type,
-                                        'description': item.description,
-                                        'count': item.count,
-                                        'value': item.value,
-                                        'img': item.img,
-                                        'stackable': item.prefab.stackable,
-                                        'unique': item.prefab.unique
-                                    }
-                                }
-                            }
-                    await client.send(data)
+    @staticmethod
+    async def publishItemMessages(gameid : int, owner : int, dm_data, player_data, isGlobal=False):
+        await publish(("dm", gameid), dm_data)
+        await publish(("players", gameid) if isGlobal else ("player", owner), player_data)
+
+    @staticmethod
+    def buildItemMessages(item : (Item | int), isRemoval=False):
+        """Returns the owner of the item and the (dm, player) messages for it, which are built and serialized once"""
+        if type(item) == int:
+            with Session() as session:
+                return Game.buildItemMessages(Item.getFromId(item, session), isRemoval)
+
+        owner = item.owner
+        if isRemoval:
+            dm_data = player_data = encode_message({
+                "type": "item_removal",
+                "msg": {
+                    "playerid": owner,
+                    "itemid": item.id
+                }
+            })
+        else:
+            item_data = item.getInfo()
+            dm_data = encode_message({
+                "type": "inventory_update",
+                "msg": {
+                    "playerid": owner,
+                    "itemid": item.id,
+                    "item" : item_data
+                }
+            })
+            player_data = encode_message({
+                "type": "inventory_update",
+                "msg": {
+                    "itemid": item.id,
+                    "item": item_data
+                }
+            })
+        return owner, dm_data, player_data
 
 
     @staticmethod
     def getAllItemsWithPrefabID(gameid : int, prefabID : int, session):
         if session is None:
             raise NotFoundByIDException("Game.getAllItemsWithPrefabID requires a session")
-        return session.query(Item).filter_by(id_prefab=prefabID).all()
+        # library prefabs are shared, so only items of players in this game count
+        return session.query(Item) \
+            .join(Player, Item.owner == Player.id) \
+            .filter(Item.id_prefab == prefabID, Player.gameid == gameid) \
+            .all()
 
 
 class Shop(Base):
@@ -387,5 +838,93 @@ class ShopItem(Base):
         return f"<ShopItem(id={self.id}, shop_id={self.shop_id}, item_id={self.item_id}, count={self.count})>"
 
 
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
\ No newline at end of file
+# state of the loot pool of a game, so a running claim / vote round survives a restart
+class LootPoolState(Base):
+    __tablename__ = 'loot_pools'
+    gameid = Column(Integer, ForeignKey('games.id'), primary_key=True)
+    phase = Column(Integer)
+    gold = Column(Integer)
+    players = Column(String) # json list of player ids
+    finished = Column(String) # json list of player ids
+    next_loot_id = Column(Integer)
+    revision = Column(Integer, nullable=False, server_default="1") # bumped by every write, see LootPool._save
+    seed = Column(Integer) # seed of the distribution once it was resolved
+
+class LootEntry(Base):
+    __tablename__ = 'loot_entries'
+    gameid = Column(Integer, ForeignKey('games.id'), primary_key=True)
+    lootid = Column(Integer, primary_key=True)
+    itemid = Column(Integer)
+    claims = Column(String) # json {player id: claimed}
+    votes = Column(String) # json {player id: voted player id}
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+# create_all only creates missing tables, changes to existing tables have to be added here.
+# Migrations are run in order and the index + 1 is the schema version after running it
+def _create_indexes(connection, indexes):
+    # the indexes are spelled out, so an index added to a model later needs its own migration
+    for name, table, columns in indexes:
+        connection.execute(sqlalchemy.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+def _migration_lookup_indexes(connection):
+    _create_indexes(connection, [
+        ("ix_players_gameid_name", "players", ("gameid", "name")),
+        ("ix_items_owner", "items", ("owner",)),
+        ("ix_items_id_prefab", "items", ("id_prefab",)),
+        ("ix_item_prefabs_gameid_rarity", "item_prefabs", ("gameid", "rarity")),
+        ("ix_prefab_overrides_gameid", "prefab_overrides", ("gameid",)),
+        ("ix_games_join_code", "games", ("join_code",)),
+    ])
+
+def _migration_history_audit_columns(connection):
+    existing = {column["name"] for column in sqlalchemy.inspect(connection).get_columns(History.__tablename__)}
+    for column in ("gameid", "timestamp", "actor", "action", "playerid", "itemid", "prefabid", "gold_delta"):
+        if column not in existing:
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {History.__tablename__} ADD COLUMN {column} {History.__table__.columns[column].type.compile(connection.dialect)}"))
+    _create_indexes(connection, [
+        ("ix_history_gameid_timestamp", "history", ("gameid", "timestamp")),
+    ])
+
+def _migration_loot_pool_revision(connection):
+    existing = {column["name"] for column in sqlalchemy.inspect(connection).get_columns(LootPoolState.__tablename__)}
+    if "revision" not in existing:
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {LootPoolState.__tablename__} ADD COLUMN revision INTEGER NOT NULL DEFAULT 1"))
+
+def _migration_loot_pool_seed(connection):
+    existing = {column["name"] for column in sqlalchemy.inspect(connection).get_columns(LootPoolState.__tablename__)}
+    if "seed" not in existing:
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {LootPoolState.__tablename__} ADD COLUMN seed INTEGER"))
+
+migrations = [
+    _migration_lookup_indexes,
+    _migration_history_audit_columns,
+    _migration_loot_pool_revision,
+    _migration_loot_pool_seed,
+]
+
+def migrate(engine):
+    """Creates the database or upgrades an existing one in place to the latest schema version"""
+    with engine.begin() as connection:
+        fresh = not sqlalchemy.inspect(connection).has_table(Game.__tablename__)
+        Base.metadata.create_all(connection)
+
+        version = connection.execute(sqlalchemy.select(SchemaVersion.version)).scalar()
+        if version is None:
+            version = len(migrations) if fresh else 0 # fresh databases already have the latest schema
+            connection.execute(sqlalchemy.insert(SchemaVersion).values(id=1, version=version))
+
+        for i in range(version, len(migrations)):
+            print(f"Migrating database to schema version {i + 1}")
+            migrations[i](connection)
+            connection.execute(sqlalchemy.update(SchemaVersion).values(version=i + 1))
+
+migrate(engine)
+# objects are handed between the db executor and the event loop, expiring them on commit would reload them on the loop
+Session = sessionmaker(bind=engine, expire_on_commit=False)
\ No newline at end of file
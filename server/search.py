@@ -0,0 +1,270 @@
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+import heapq
+import math
+import re
+import threading
+
+# Full-text and faceted search over the prefabs of a catalog.
+# The index lives in memory next to the PrefabCatalog it was built from. The index of the shared library is kept
+# until the library changes, the index of a game only covers the prefabs of the game and is layered on top of it.
+
+name_boost = 3.0 # a match in the name counts three times as much as one in the description
+prefix_weight = 0.5 # "long" matches "longsword", but ranks below an exact "long"
+max_page_size = 100
+max_query_words = 8 # further words of a query are ignored
+min_prefix_length = 3 # shorter words only match whole terms, "a" would match almost every term
+common_term_postings = 256 # scores of terms in at least this many documents are cached, they show up in many queries
+max_cached_terms = 64 # per index
+
+word_pattern = re.compile(r"\w+")
+
+
+def tokenize(text) -> list:
+    if not text:
+        return []
+    return word_pattern.findall(str(text).lower())
+
+
+def queryWords(query) -> list:
+    """The distinct words of a query in their order, at most max_query_words of them"""
+    return list(dict.fromkeys(tokenize(query)))[:max_query_words]
+
+
+class PrefabSearchIndex:
+    """Inverted index over name and description of a list of serialized prefabs.
+
+    With a base index, only the given prefabs are indexed and searched together with those of the base, except the
+    base prefabs whose id is in hidden. The BM25 statistics are taken over both, so the ranking is the same as
+    with one index over all of the prefabs."""
+
+    def __init__(self, prefabs : list, base=None, hidden=()):
+        self.base = base
+        offset = len(base.prefabs) if base is not None else 0
+        name_postings = {} # term -> {document: frequency in the name}
+        description_postings = {} # term -> {document: frequency in the description}
+        name_lengths = []
+        description_lengths = []
+        fields = [] # (rarity, type, value, stackable, unique) for the filters and facets
+        for document, info in enumerate(prefabs, offset):
+            name = tokenize(info['name'])
+            description = tokenize(info['description'])
+            for term, frequency in Counter(name).items():
+                name_postings.setdefault(term, {})[document] = frequency
+            for term, frequency in Counter(description).items():
+                description_postings.setdefault(term, {})[document] = frequency
+            name_lengths.append(len(name))
+            description_lengths.append(len(description))
+            fields.append((info['rarity'], info['type'], info['value'] or 0, bool(info['stackable']), bool(info['unique'])))
+        layer = (name_postings, description_postings, sorted(name_postings.keys() | description_postings.keys())) # terms for prefix lookups
+        self.documents = {info['id']: document for document, info in enumerate(prefabs, offset)}
+
+        if base is None:
+            self.prefabs = prefabs
+            self.layers = [layer]
+            self.name_lengths = name_lengths
+            self.description_lengths = description_lengths
+            self.fields = fields
+            self.excluded = frozenset()
+        else:
+            self.prefabs = base.prefabs + prefabs
+            self.layers = base.layers + [layer]
+            self.name_lengths = base.name_lengths + name_lengths
+            self.description_lengths = base.description_lengths + description_lengths
+            self.fields = base.fields + fields
+            self.excluded = base.excluded | {base.documents[tid] for tid in hidden if tid in base.documents}
+
+        self.count = len(self.prefabs) - len(self.excluded)
+        count = max(self.count, 1)
+        self.average_name = max((sum(self.name_lengths) - sum(self.name_lengths[d] for d in self.excluded)) / count, 1.0)
+        self.average_description = max((sum(self.description_lengths) - sum(self.description_lengths[d] for d in self.excluded)) / count, 1.0)
+        # length normalization of BM25 for every document, k1 = 1.2 and b = 0.75 (with a floor of 0.25)
+        self.name_norms = [1.2 * (0.25 + 0.75 * length / self.average_name) for length in self.name_lengths]
+        self.description_norms = [1.2 * (0.25 + 0.75 * length / self.average_description) for length in self.description_lengths]
+        self.term_cache = OrderedDict() # (term, weight) -> {document: score} of common terms
+        self.term_cache_lock = threading.Lock() # searches run in the db executor threads
+
+    def _expand(self, word : str) -> list:
+        """Returns (term, weight) of every indexed term which starts with word, only the term itself for short words"""
+        if len(word) < min_prefix_length:
+            return [(word, 1.0)] if any(word in layer[0] or word in layer[1] for layer in self.layers) else []
+        matches = {}
+        for layer in self.layers:
+            terms = layer[2]
+            i = bisect_left(terms, word)
+            while i < len(terms) and terms[i].startswith(word):
+                matches[terms[i]] = 1.0 if terms[i] == word else prefix_weight
+                i += 1
+        return list(matches.items())
+
+    def _postings(self, field : int, term : str) -> list:
+        return [layer[field][term] for layer in self.layers if term in layer[field]]
+
+    def _bm25(self, postings : list, norms : list, weight : float, scores : dict, only=None):
+        """Adds the BM25 score of a term in one field to the scores of its documents, only to those in only if it is given"""
+        if not postings:
+            return
+        matching = sum(len(documents) for documents in postings)
+        if self.excluded:
+            matching -= sum(1 for documents in postings for document in self.excluded if document in documents)
+        factor = weight * math.log(1.0 + (self.count - matching + 0.5) / (matching + 0.5)) * 2.2
+        for documents in postings:
+            if only is not None:
+                # the documents of the rarer words are looked up instead of going through every posting of a common word
+                documents = {document: documents[document] for document in only if document in documents} if len(only) < len(documents) \
+                    else {document: frequency for document, frequency in documents.items() if document in only}
+            for document, frequency in documents.items():
+                if document in self.excluded:
+                    continue
+                scores[document] = scores.get(document, 0.0) + factor * frequency / (frequency + norms[document])
+
+    def _termScores(self, term : str, term_weight : float, name_postings : list, description_postings : list, only=None) -> dict:
+        """BM25 score of a term over both fields, only for the documents in only if it is given. The returned dict must not be changed"""
+        key = (term, term_weight)
+        with self.term_cache_lock:
+            scores = self.term_cache.get(key)
+            if scores is not None:
+                self.term_cache.move_to_end(key)
+
+        if scores is None:
+            if sum(len(documents) for documents in name_postings + description_postings) < common_term_postings:
+                scores = {}
+                self._bm25(name_postings, self.name_norms, term_weight * name_boost, scores, only)
+                self._bm25(description_postings, self.description_norms, term_weight, scores, only)
+                return scores
+
+            scores = {}
+            self._bm25(name_postings, self.name_norms, term_weight * name_boost, scores)
+            self._bm25(description_postings, self.description_norms, term_weight, scores)
+            with self.term_cache_lock:
+                self.term_cache[key] = scores
+                while len(self.term_cache) > max_cached_terms:
+                    self.term_cache.popitem(last=False)
+
+        if only is None:
+            return scores
+        if len(only) < len(scores):
+            return {document: scores[document] for document in only if document in scores}
+        return {document: score for document, score in scores.items() if document in only}
+
+    def _score(self, words : list) -> dict:
+        """BM25 score (name and description scored separately) of every document which matches all words"""
+        expanded = []
+        for position, word in enumerate(words):
+            terms = [(term, term_weight, self._postings(0, term), self._postings(1, term)) for term, term_weight in self._expand(word)]
+            if not terms:
+                return {}
+            expanded.append((sum(len(documents) for term in terms for documents in term[2] + term[3]), position, terms))
+        expanded.sort(key=lambda word: word[:2]) # the rarest word first, it limits the documents the others are scored for
+
+        candidates = None
+        word_scores = []
+        for _, position, terms in expanded:
+            scores = {}
+            for term, term_weight, name_postings, description_postings in terms:
+                term_scores = self._termScores(term, term_weight, name_postings, description_postings, candidates)
+                if len(terms) == 1:
+                    scores = term_scores
+                    break
+                for document, score in term_scores.items():
+                    if score > scores.get(document, 0.0):
+                        scores[document] = score # the best matching term of the word counts
+
+            candidates = scores.keys() if candidates is None else candidates & scores.keys()
+            if not candidates:
+                return {}
+            word_scores.append((position, scores))
+
+        if len(word_scores) == 1:
+            return word_scores[0][1]
+        word_scores.sort(key=lambda word: word[0]) # summed in the order of the query
+        return {document: sum(scores[document] for _, scores in word_scores) for document in candidates}
+
+    def _filter(self, candidates, filters : dict):
+        """Returns the candidates which pass the filters and the facet counts.
+        A document counts in the facet of a field if it passes every filter but the one on that field"""
+        fields = self.fields
+        min_value = filters.get('min_value')
+        max_value = filters.get('max_value')
+        if min_value is not None or max_value is not None:
+            candidates = [document for document in candidates
+                          if (min_value is None or fields[document][2] >= min_value) and (max_value is None or fields[document][2] <= max_value)]
+
+        # facet -> (position in fields, accepted values) of the filters which are set
+        active = {}
+        if filters.get('rarity'):
+            active['rarity'] = (0, set(filters['rarity']))
+        if filters.get('type'):
+            active['type'] = (1, set(filters['type']))
+        if filters.get('stackable') is not None:
+            active['stackable'] = (3, {bool(filters['stackable'])})
+        if filters.get('unique') is not None:
+            active['unique'] = (4, {bool(filters['unique'])})
+        positions = {'rarity': 0, 'type': 1, 'stackable': 3, 'unique': 4}
+
+        if len(active) <= 1:
+            # the facet of the filtered field counts every candidate, the other facets count the results
+            candidates = list(candidates)
+            results = candidates
+            for position, accepted in active.values():
+                results = [document for document in candidates if fields[document][position] in accepted]
+            facets = {facet: dict(Counter(fields[document][position] for document in (candidates if facet in active else results)))
+                      for facet, position in positions.items()}
+        else:
+            facets = {facet: {} for facet in positions}
+            results = []
+            for document in candidates:
+                info = fields[document]
+                failed = None
+                for facet, (position, accepted) in active.items():
+                    if info[position] not in accepted:
+                        if failed is not None:
+                            break
+                        failed = facet
+                else:
+                    for facet, position in positions.items():
+                        if failed is None or failed == facet:
+                            counts = facets[facet]
+                            counts[info[position]] = counts.get(info[position], 0) + 1
+                    if failed is None:
+                        results.append(document)
+
+        facets['value'] = {"min": min(fields[document][2] for document in results), "max": max(fields[document][2] for document in results)} if results else None
+        return results, facets
+
+    def search(self, query : str = "", filters : dict = None, page : int = 0, page_size : int = 25) -> dict:
+        """Returns one page of the prefabs matching every word of the query and the filters, best matches first.
+
+        filters may contain rarity and type (lists of accepted values), min_value, max_value, stackable and unique.
+        The facet counts of a field are taken over the matches of the query and the other filters, so the
+        client can show how many results selecting another value would give."""
+        filters = filters or {}
+        page_size = min(max(page_size, 1), max_page_size)
+        words = queryWords(query)
+
+        if words:
+            scores = self._score(words)
+            candidates = scores.keys()
+        else:
+            scores = None
+            candidates = range(len(self.prefabs)) if not self.excluded else (d for d in range(len(self.prefabs)) if d not in self.excluded)
+
+        results, facets = self._filter(candidates, filters)
+
+        if scores is not None:
+            key = lambda document: (-scores[document], self.prefabs[document]['name'] or "")
+        else:
+            key = lambda document: self.prefabs[document]['name'] or ""
+        start = page * page_size
+        if start + page_size < len(results):
+            results_page = heapq.nsmallest(start + page_size, results, key=key)[start:]
+        else:
+            results_page = sorted(results, key=key)[start:start + page_size]
+
+        return {
+            "total": len(results),
+            "page": page,
+            "page_size": page_size,
+            "items": [self.prefabs[document] for document in results_page],
+            "facets": facets
+        }
@@ -0,0 +1,350 @@
+from util import LogLevel, token_store_type, token_store_path, token_cache_size, token_cache_ttl
+from log import log
+from objects import run_db
+from collections import OrderedDict
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+
+class TokenStore:
+    """Token -> value store whose entries expire after ttl seconds (never if ttl is None).
+
+    Expired entries are invisible right away and removed by sweep(). Entries for which is_orphaned(value)
+    returns True, e.g. sessions of clients which are gone, are removed by sweep() as well."""
+
+    blocking = False # cheap enough to be used from the event loop
+
+    def __init__(self, name, ttl=None, is_orphaned=None):
+        self.name = name
+        self.ttl = ttl
+        self.is_orphaned = is_orphaned
+        self.entries = {} # token -> (expires_at, value)
+        self.lock = threading.Lock() # registration tokens are issued from db executor threads
+
+        self.swept_expired = 0
+        self.swept_orphaned = 0
+
+    def set(self, token, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[token] = (expires_at, value)
+
+    def add(self, token, value):
+        """Like set, but returns False instead of replacing a live entry"""
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None and not TokenStore._expired(entry, time.monotonic()):
+                return False
+            self.entries[token] = (time.monotonic() + self.ttl if self.ttl is not None else None, value)
+        return True
+
+    def get(self, token, default=None):
+        entry = self.entries.get(token)
+        if entry is None or TokenStore._expired(entry, time.monotonic()):
+            return default
+        return entry[1]
+
+    def pop(self, token, default=None):
+        with self.lock:
+            entry = self.entries.pop(token, None)
+        if entry is None or TokenStore._expired(entry, time.monotonic()):
+            return default
+        return entry[1]
+
+    def touch(self, token):
+        """Restarts the ttl of an entry once less than half of it is left"""
+        entry = self.entries.get(token)
+        if entry is None or self.ttl is None or TokenStore._expired(entry, time.monotonic()):
+            return
+        if entry[0] - time.monotonic() < self.ttl / 2:
+            self.set(token, entry[1])
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def _expired(entry, now):
+        return entry[0] is not None and entry[0] <= now
+
+    def _isOrphaned(self, value):
+        return self.is_orphaned is not None and self.is_orphaned(value)
+
+    def sweep(self):
+        """Removes expired and orphaned entries, returns how many of each were removed"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [token for token, entry in self.entries.items() if TokenStore._expired(entry, now)]
+            for token in expired:
+                del self.entries[token]
+            orphaned = [token for token, entry in self.entries.items() if self._isOrphaned(entry[1])]
+            for token in orphaned:
+                del self.entries[token]
+
+        self.swept_expired += len(expired)
+        self.swept_orphaned += len(orphaned)
+        return len(expired), len(orphaned)
+
+    def getStats(self):
+        now = time.monotonic()
+        with self.lock:
+            entries = list(self.entries.values())
+        expired = sum(1 for entry in entries if TokenStore._expired(entry, now))
+        orphaned = sum(1 for entry in entries if not TokenStore._expired(entry, now) and self._isOrphaned(entry[1]))
+        return {
+            "live": len(entries) - expired - orphaned,
+            "expired": expired,
+            "orphaned": orphaned,
+            "swept_expired": self.swept_expired,
+            "swept_orphaned": self.swept_orphaned
+        }
+
+
+class SQLiteTokenStore:
+    """TokenStore kept in a sqlite file, so tokens survive restarts and are shared by the worker processes.
+
+    Values have to be json serializable. Lookups go through an in-memory LRU cache whose entries are
+    trusted for cache_ttl seconds, so most requests don't touch the file. A token removed by another worker
+    can therefore stay visible here for up to cache_ttl seconds.
+
+    Writes wait up to 5 seconds for the file lock of other workers, use the store through run_blocking."""
+
+    blocking = True
+
+    def __init__(self, name, path, ttl=None, is_orphaned=None, cache_size=10000, cache_ttl=5.0):
+        self.name = name
+        self.path = path
+        self.ttl = ttl
+        self.is_orphaned = is_orphaned
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict() # token -> (expires_at, value, cached_at)
+        self.lock = threading.Lock()
+        self.local = threading.local() # one connection per thread
+
+        self.swept_expired = 0
+        self.swept_orphaned = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                store TEXT NOT NULL,
+                token TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (store, token)
+            )""")
+        self._connection().execute("CREATE INDEX IF NOT EXISTS ix_tokens_expires_at ON tokens (store, expires_at)")
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None) # autocommit
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _cache(self, token, expires_at, value):
+        with self.lock:
+            self.cache[token] = (expires_at, value, time.monotonic())
+            self.cache.move_to_end(token)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _uncache(self, token):
+        with self.lock:
+            self.cache.pop(token, None)
+
+    @staticmethod
+    def _expired(expires_at, now):
+        return expires_at is not None and expires_at <= now
+
+    def _load(self, token):
+        """Returns (expires_at, value) of a token, from the cache if it is recent enough"""
+        with self.lock:
+            entry = self.cache.get(token)
+            if entry is not None and time.monotonic() - entry[2] < self.cache_ttl:
+                self.cache.move_to_end(token)
+                self.cache_hits += 1
+                return entry[0], entry[1]
+
+        self.cache_misses += 1
+        row = self._connection().execute("SELECT expires_at, value FROM tokens WHERE store = ? AND token = ?", (self.name, token)).fetchone()
+        if row is None:
+            self._uncache(token)
+            return None
+        expires_at, value = row[0], json.loads(row[1])
+        self._cache(token, expires_at, value)
+        return expires_at, value
+
+    def set(self, token, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._connection().execute("INSERT OR REPLACE INTO tokens (store, token, value, expires_at) VALUES (?, ?, ?, ?)",
+                                   (self.name, token, json.dumps(value), expires_at))
+        self._cache(token, expires_at, value)
+
+    def add(self, token, value):
+        """Like set, but returns False instead of replacing a live entry"""
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        connection = self._connection()
+        connection.execute("DELETE FROM tokens WHERE store = ? AND token = ? AND expires_at <= ?", (self.name, token, now))
+        if connection.execute("INSERT OR IGNORE INTO tokens (store, token, value, expires_at) VALUES (?, ?, ?, ?)",
+                              (self.name, token, json.dumps(value), expires_at)).rowcount == 0:
+            return False
+        self._cache(token, expires_at, value)
+        return True
+
+    def get(self, token, default=None):
+        entry = self._load(token)
+        if entry is None or SQLiteTokenStore._expired(entry[0], time.time()):
+            return default
+        return entry[1]
+
+    def pop(self, token, default=None):
+        """Removes a token, only one worker gets its value"""
+        self._uncache(token)
+        connection = self._connection()
+        row = connection.execute("SELECT expires_at, value FROM tokens WHERE store = ? AND token = ?", (self.name, token)).fetchone()
+        if row is None:
+            return default
+        if connection.execute("DELETE FROM tokens WHERE store = ? AND token = ?", (self.name, token)).rowcount == 0:
+            return default # another worker was faster
+        if SQLiteTokenStore._expired(row[0], time.time()):
+            return default
+        return json.loads(row[1])
+
+    def touch(self, token):
+        """Restarts the ttl of an entry once less than half of it is left"""
+        entry = self._load(token)
+        if entry is None or self.ttl is None or entry[0] is None:
+            return
+        remaining = entry[0] - time.time()
+        if 0 < remaining < self.ttl / 2:
+            self.set(token, entry[1])
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM tokens WHERE store = ?", (self.name,)).fetchone()[0]
+
+    def clear(self):
+        self._connection().execute("DELETE FROM tokens WHERE store = ?", (self.name,))
+        with self.lock:
+            self.cache.clear()
+
+    def _isOrphaned(self, value):
+        return self.is_orphaned is not None and self.is_orphaned(value)
+
+    def sweep(self):
+        """Removes expired and orphaned entries, returns how many of each were removed"""
+        connection = self._connection()
+        expired = connection.execute("DELETE FROM tokens WHERE store = ? AND expires_at <= ?", (self.name, time.time())).rowcount
+        orphaned = 0
+        if self.is_orphaned is not None:
+            for token, value in connection.execute("SELECT token, value FROM tokens WHERE store = ?", (self.name,)).fetchall():
+                if self._isOrphaned(json.loads(value)):
+                    orphaned += connection.execute("DELETE FROM tokens WHERE store = ? AND token = ?", (self.name, token)).rowcount
+                    self._uncache(token)
+
+        now = time.monotonic()
+        with self.lock:
+            for token in [token for token, entry in self.cache.items() if now - entry[2] >= self.cache_ttl]:
+                del self.cache[token]
+
+        self.swept_expired += expired
+        self.swept_orphaned += orphaned
+        return expired, orphaned
+
+    def getStats(self):
+        now = time.time()
+        rows = self._connection().execute("SELECT expires_at, value FROM tokens WHERE store = ?", (self.name,)).fetchall()
+        expired = sum(1 for expires_at, _ in rows if SQLiteTokenStore._expired(expires_at, now))
+        orphaned = sum(1 for expires_at, value in rows if not SQLiteTokenStore._expired(expires_at, now) and self._isOrphaned(json.loads(value)))
+        with self.lock:
+            cached = len(self.cache)
+        return {
+            "live": len(rows) - expired - orphaned,
+            "expired": expired,
+            "orphaned": orphaned,
+            "swept_expired": self.swept_expired,
+            "swept_orphaned": self.swept_orphaned,
+            "cached": cached,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses
+        }
+
+
+async def run_blocking(store, func, *args, **kwargs):
+    """Runs func, which uses store, in the db executor if the store can block (see SQLiteTokenStore)"""
+    if not store.blocking:
+        return func(*args, **kwargs)
+    return await run_db(func, *args, **kwargs)
+
+
+def createTokenStore(name, ttl=None, is_orphaned=None):
+    """Token store for state which has to survive restarts and be shared by the workers, selected by TOKEN_STORE"""
+    if token_store_type == "memory":
+        return TokenStore(name, ttl=ttl, is_orphaned=is_orphaned)
+    if token_store_type == "sqlite":
+        return SQLiteTokenStore(name, token_store_path, ttl=ttl, is_orphaned=is_orphaned, cache_size=token_cache_size, cache_ttl=token_cache_ttl)
+    raise ValueError(f"Unknown TOKEN_STORE {token_store_type}, use memory or sqlite")
+
+
+class TokenSweeper:
+    """Periodically sweeps token stores from a background task.
+
+    heartbeat is called before every sweep, e.g. to keep the entry of this worker in a shared store alive."""
+
+    def __init__(self, stores, interval=30.0, heartbeat=None):
+        self.stores = stores
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.task = None
+
+    @property
+    def blocking(self):
+        return any(store.blocking for store in self.stores)
+
+    def sweep(self):
+        if self.heartbeat is not None:
+            self.heartbeat()
+        for store in self.stores:
+            expired, orphaned = store.sweep()
+            if expired or orphaned:
+                log(f"Swept {expired} expired and {orphaned} orphaned entries from {store.name}", level=LogLevel.DEBUG)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await run_blocking(self, self.sweep)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def getStats(self):
+        return {store.name: store.getStats() for store in self.stores}
@@ -3,11 +3,17 @@ clientList = []
 clients_to_remove = []
 client_list = {}
 
+# per game / per player indexes over client_list, so broadcasts only touch the clients they target
+game_client_index = {}
+dm_client_index = {}
+player_client_index = {}
+
 from dotenv import load_dotenv
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import base64
+import json
 import os
 
 load_dotenv()
@@ -17,6 +23,57 @@ global_sync_token_key = os.getenv("SYNC_TOKEN_KEY")
 if global_sync_token_key is None:
     global_sync_token_key = "NotReallySecure"
 
+# database, the sqlite settings are only used for sqlite urls
+database_url = os.getenv("DATABASE_URL", "sqlite:///players.db")
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "10"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+sqlite_journal_mode = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+sqlite_synchronous = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+sqlite_busy_timeout = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")) # ms
+sqlite_mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))) # bytes, 0 disables mmap
+# threads for blocking database work, 0 runs it on the event loop. Every thread competes with the event loop for the GIL,
+# sqlite runs one write at a time anyway: more workers only help a server database (see bench_loop_latency_during_writes)
+db_executor_workers = int(os.getenv("DB_EXECUTOR_WORKERS", "2"))
+
+# log lines with LogLevel.DEBUG are only printed if DEBUG_LOG is set
+debug_log = os.getenv("DEBUG_LOG", "false").lower() in ("1", "true", "yes")
+
+# seconds a registration token from selectPlayer / resync can be used to open the event stream
+registration_token_ttl = int(os.getenv("REGISTRATION_TOKEN_TTL", "60"))
+
+# seconds between sweeps of expired registration tokens and sessions of disconnected clients
+token_sweep_interval = float(os.getenv("TOKEN_SWEEP_INTERVAL", "30"))
+
+# where sessions and registration tokens are kept, "memory" or "sqlite" (survives restarts, shared by the workers)
+token_store_type = os.getenv("TOKEN_STORE", "memory")
+token_store_path = os.getenv("TOKEN_STORE_PATH", "tokens.db")
+token_cache_size = int(os.getenv("TOKEN_CACHE_SIZE", "10000")) # tokens cached in memory in front of the sqlite store
+token_cache_ttl = float(os.getenv("TOKEN_CACHE_TTL", "5")) # seconds a cached token is used without checking the store
+
+# seconds a session token stays valid, it is renewed while used. After the event stream closed it can reopen the stream for session_reconnect_grace seconds
+session_token_ttl = int(os.getenv("SESSION_TOKEN_TTL", "28800"))
+session_reconnect_grace = int(os.getenv("SESSION_RECONNECT_GRACE", "300"))
+
+# seconds a validated resync token and the existence of a game / player are cached, a server restart makes every client resync at once
+sync_token_cache_ttl = float(os.getenv("SYNC_TOKEN_CACHE_TTL", "30"))
+existence_cache_ttl = float(os.getenv("EXISTENCE_CACHE_TTL", "600"))
+
+# message bus between worker processes, "local" for a single worker or "socket" for several workers on this machine
+message_bus_type = os.getenv("MESSAGE_BUS", "local")
+message_bus_path = os.getenv("MESSAGE_BUS_PATH", "message_bus.sock")
+# bytes waiting for a worker which stopped reading before it is disconnected, it resets its caches when it reconnects
+message_bus_buffer_limit = int(os.getenv("MESSAGE_BUS_BUFFER_LIMIT", str(4 * 1024 * 1024)))
+
+# per client SSE queues, a client whose backlog grows past the limit gets a full resync instead
+sse_queue_size = int(os.getenv("SSE_QUEUE_SIZE", "256"))
+
+# most items a loot pool can hold after GenerateLootItems
+max_generated_loot = int(os.getenv("MAX_GENERATED_LOOT", "1000"))
+
+# item import, the cache makes re-imports for new games work without any requests
+dnd_api_url = os.getenv("DND_API_URL", "https://www.dnd5eapi.co")
+dnd_api_cache_dir = os.getenv("DND_API_CACHE_DIR", "api_cache")
+
 from enum import Enum, auto
 class LogLevel(Enum):
     DEBUG = auto()
@@ -101,5 +158,69 @@ def remove_disconnected_clients():
             pass
     clients_to_remove.clear()
 
+def register_client(clientid, client):
+    client_list[clientid] = client
+    game_client_index.setdefault(client.gameid, {})[clientid] = client
+    if client.isDM:
+        dm_client_index.setdefault(client.gameid, {})[clientid] = client
+    else:
+        player_client_index.setdefault(client.playerid, {})[clientid] = client
+
+def _remove_from_index(index, key, clientid):
+    bucket = index.get(key)
+    if bucket is None:
+        return
+    bucket.pop(clientid, None)
+    if not bucket:
+        del index[key]
+
+def unregister_client(clientid):
+    client = client_list.pop(clientid, None)
+    if client is None:
+        return None
+    _remove_from_index(game_client_index, client.gameid, clientid)
+    if client.isDM:
+        _remove_from_index(dm_client_index, client.gameid, clientid)
+    else:
+        _remove_from_index(player_client_index, client.playerid, clientid)
+    return client
+
+# these return copies, a client may disconnect while a broadcast is awaiting
+def get_game_clients(gameid):
+    return list(game_client_index.get(gameid, {}).values())
+
+def get_dm_clients(gameid):
+    return list(dm_client_index.get(gameid, {}).values())
+
+def get_player_clients(playerid):
+    return list(player_client_index.get(playerid, {}).values())
+
+class EncodedMessage:
+    """A message which is serialized once and can be queued for any number of clients"""
+
+    def __init__(self, message : dict, data : str = None):
+        self.message = message
+        self.event = message["type"] if "type" in message else message["event"]
+        self.data = json.dumps(message) if data is None else data
+
+    def __getitem__(self, key):
+        return self.message[key]
+
+    def __contains__(self, key):
+        return key in self.message
+
+def encode_message(message):
+    if isinstance(message, EncodedMessage):
+        return message
+    return EncodedMessage(message)
+
+def encode_batch(messages):
+    """Wraps several messages into one batch event, reusing their serialized data"""
+    messages = [encode_message(msg) for msg in messages]
+    return EncodedMessage(
+        {"type": "batch", "msg": [msg.message for msg in messages]},
+        '{"type": "batch", "msg": [' + ", ".join(msg.data for msg in messages) + ']}'
+    )
+
 class NotFoundByIDException(BaseException):
     pass
\ No newline at end of file